@@ -21,6 +21,23 @@ app.conf.result_backend = 'redis://localhost:6379/0'
 app.conf.beat_schedule = {
     'summarize-memories': {
         'task': 'memory.tasks.summarize_memories',
+        # Runs are triggered on insert, this daily sweep catches up on missed users
         'schedule': 86400.0,  # Run daily (24 hours in seconds)
     },
+    'embed-pending-memories': {
+        'task': 'memory.tasks.embed_pending_memories',
+        'schedule': 60.0,  # Sweep memories whose embedding task was never scheduled
+    },
+    'check-contradictions': {
+        'task': 'memory.tasks.check_contradictions',
+        'schedule': 300.0,  # Sweep memories whose check was never scheduled
+    },
+    'archive-memories': {
+        'task': 'memory.tasks.archive_memories',
+        'schedule': 86400.0,
+    },
+    'sync-tenant-indexes': {
+        'task': 'memory.tasks.sync_tenant_indexes',
+        'schedule': 86400.0,
+    },
 } 
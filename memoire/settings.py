@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'memory.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -140,3 +141,145 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
+CELERY_BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': 3600}  # Seconds before an unacknowledged task is redelivered
+
+# Cache Configuration
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://localhost:6379/1',
+        'OPTIONS': {
+            'socket_connect_timeout': 0.5,
+            'socket_timeout': 0.5,
+        },
+    }
+}
+
+# Embedding Configuration
+EMBEDDING_CACHE_SIZE = 2048  # Vectors kept in each process LRU
+EMBEDDING_CACHE_TTL = 3600  # Seconds before an LRU entry expires
+EMBEDDING_CACHE_ALIAS = 'default'  # Shared (Redis) tier, None to disable it
+EMBEDDING_CACHE_SHARED_TTL = 7 * 86400  # Seconds before a shared entry expires
+EMBEDDING_BATCH_ENABLED = True  # Coalesce concurrent embedding calls of a process
+EMBEDDING_BATCH_WINDOW = 0.005  # Seconds to wait for more texts after the first one
+EMBEDDING_BATCH_MAX_SIZE = 32  # Texts per /api/embed call
+EMBEDDING_BATCH_CONCURRENCY = 2  # Batches in flight per process
+EMBEDDING_BULK_BATCH_SIZE = 256  # Texts per /api/embed call for large lists (bulk ingestion)
+EMBEDDING_MODEL = 'nomic-embed-text'  # Used until an EmbeddingModel is activated by a re-embedding cutover
+EMBEDDING_MODEL_CHECK_INTERVAL = 10  # Seconds a process keeps the active model before reading it again
+REEMBED_PARTITIONS = 64  # Id ranges re-embedded by parallel Celery tasks
+REEMBED_BATCH_SIZE = 256  # Memories re-embedded per batch
+REEMBED_BATCH_DELAY = 0.0  # Seconds a task sleeps between batches, to throttle the load on Ollama
+REEMBED_CUTOVER_MAX_REMAINING = 5000  # Memories left to re-embed that a cutover embeds itself, more are refused
+REEMBED_CUTOVER_BATCH_SIZE = 5000  # Memories switched to the new vectors per transaction by a cutover
+
+# Memory Ingestion
+MEMORY_BULK_MAX_ITEMS = 5000  # Memories accepted by one bulk_create request
+MEMORY_BULK_INSERT_BATCH_SIZE = 500  # Rows per INSERT statement
+DATA_UPLOAD_MAX_MEMORY_SIZE = 20 * 1024 * 1024  # Bulk ingestion payloads are larger than Django's 2.5 MB default
+MEMORY_ASYNC_EMBEDDING = False  # Write memories at once and embed them in Celery (per request: "async")
+MEMORY_PENDING_EMBED_DELAY = 2  # Seconds to gather pending memories before embedding them
+MEMORY_PENDING_EMBED_BATCH_SIZE = 256  # Pending memories claimed at once
+MEMORY_PENDING_EMBED_LEASE = 600  # Seconds other workers skip claimed memories, until a crashed worker's come back
+MEMORY_PENDING_EMBED_RETRY_BACKOFF = 60  # Seconds before a failed memory is retried, doubled on each attempt
+MEMORY_PENDING_EMBED_MAX_ATTEMPTS = 8  # Attempts before a pending memory is given up, its error recorded
+DEDUP_ENABLED = True  # Merge near-duplicates into the existing memory (per request: "dedup")
+DEDUP_DISTANCE = 0.05  # Cosine distance under which a new memory is a near-duplicate
+DEDUP_CANDIDATES = 3  # Nearest memories of the scope checked, summaries are skipped
+EXPORT_CHUNK_SIZE = 2000  # Rows fetched per round trip of an export's server-side cursor
+IMPORT_BATCH_SIZE = 5000  # Rows COPied into the staging table at once
+
+# Search Configuration
+SEARCH_PENDING_POLICY = 'exclude'  # "exclude" or "recent": append recent pending memories, unranked
+SEARCH_DEFAULT_K = 3  # Memories returned by search_memories
+SEARCH_MAX_K = 100
+SEARCH_EXACT_MAX_ROWS = 5000  # Scopes up to this size are ranked exactly, larger ones use HNSW
+SEARCH_EF_SEARCH = 40  # hnsw.ef_search for unfiltered searches
+SEARCH_EF_SEARCH_FILTERED = 200  # hnsw.ef_search when user/channel/server filters apply
+SEARCH_ITERATIVE_SCAN = 'relaxed_order'  # hnsw.iterative_scan (pgvector >= 0.8), None to disable
+SEARCH_MAX_SCAN_TUPLES = 20000  # hnsw.max_scan_tuples for iterative scans
+SEARCH_QUANTIZED = False  # Scan the halfvec HNSW index and rerank on full vectors, after quantize_memories enable
+SEARCH_RERANK_FACTOR = 4  # Candidates fetched from the halfvec index per requested result
+SEARCH_QUANTIZE_BATCH_SIZE = 5000  # Rows filled per transaction by quantize_memories enable
+SEARCH_HYBRID_CANDIDATES = 50  # Rows each side of a hybrid search contributes to the fusion
+SEARCH_HYBRID_WEIGHTS = {'vector': 1.0, 'text': 1.0}
+SEARCH_RRF_K = 60  # Reciprocal rank fusion constant, higher flattens the rank differences
+SEARCH_HIERARCHY_FANOUT = 3  # Best summaries a hierarchical search drills into, per level
+SEARCH_HIERARCHY_MAX_FANOUT = 20
+SEARCH_HIERARCHY_DEPTH = 2  # Summary levels a hierarchical search goes down
+SEARCH_HIERARCHY_MAX_DEPTH = 5
+HOT_CACHE_ENABLED = False  # Rank hot users' searches in memory, per worker process
+HOT_CACHE_MAX_ROWS = 50000  # Rows held per process, about 150 MB of float32 vectors
+HOT_CACHE_USER_MAX_ROWS = 5000  # Larger users are searched in the database
+HOT_CACHE_ADMIT_SEARCHES = 2  # Searches within HOT_CACHE_TTL before a user is loaded
+HOT_CACHE_TTL = 600  # Seconds an entry is kept without being reloaded
+HOT_CACHE_VERSION_TTL = 86400  # Seconds a user's version key lives in the shared cache
+SEARCH_PENDING_LIMIT = 3  # Pending memories appended with the "recent" policy
+
+# Pagination
+PAGE_DEFAULT_LIMIT = 20  # Rows per page of the JSON list APIs
+PAGE_MAX_LIMIT = 100
+PAGE_SEARCH_CANDIDATES = 200  # Nearest memories paged through for a query
+
+# Ollama Configuration
+OLLAMA_URL = 'http://llm:11434'
+OLLAMA_TIMEOUTS = {  # (connect, read) seconds per endpoint
+    'default': (3.05, 60),
+    'embed': (3.05, 30),
+    'chat': (3.05, 600),
+}
+OLLAMA_MAX_RETRIES = 3  # Retries on connection errors and 429/5xx responses
+OLLAMA_RETRY_BACKOFF = 0.5  # Seconds, doubled on each retry
+OLLAMA_POOL_SIZE = 10  # Keep-alive connections per process
+OLLAMA_MAX_CONCURRENCY = 8  # Requests in flight per process (per event loop for async)
+
+# Vector Index Configuration
+TENANT_INDEX_MIN_ROWS = 50000  # Searchable rows from which a server/user gets its own HNSW index
+TENANT_INDEX_KEEP_ROWS = 40000  # A tenant index is dropped once the tenant falls under this
+
+# Partitioning
+MEMORY_PARTITIONS = 16  # Hash partitions by user created by partition_memories
+MEMORY_PARTITION_COPY_BATCH_SIZE = 5000  # Rows copied per transaction when partitioning
+
+# Summarization Configuration
+SUMMARY_MIN_MEMORIES = 10  # Users with more unsummarized memories get summarized
+SUMMARY_MAX_CONCURRENCY = 4  # Users summarized at once across all workers
+SUMMARY_RATE_LIMIT = '30/m'  # Celery rate limit of per-user tasks, per worker
+SUMMARY_MAX_RETRIES = 3
+SUMMARY_RETRY_DELAY = 300  # Seconds
+SUMMARY_SLOT_WAIT = 60  # Seconds before a task waiting for a slot is retried
+SUMMARY_LOCK_TIMEOUT = 3600  # Seconds before a lock of a crashed worker expires
+SUMMARY_CHUNK_TOKENS = 8000  # Estimated input tokens per LLM call, well under the 32k num_ctx
+SUMMARY_CHARS_PER_TOKEN = 4  # Used to estimate token counts
+SUMMARY_MAX_PARALLEL_CALLS = 4  # Concurrent LLM calls per level
+SUMMARY_MAX_LEVELS = 5  # The last level reduces everything in one call
+SUMMARY_FINAL_TOKENS = 24000  # Estimated input tokens of that call, cut to fit, the rest of num_ctx left to the prompt and answer
+SUMMARY_BATCH_SIZE = 1000  # Memories loaded and summarized per checkpoint
+SUMMARY_TRIGGER_MEMORIES = 100  # Unsummarized memories that trigger a user's summarization on insert
+SUMMARY_TRIGGER_CHECK_INTERVAL = 60  # Seconds between two unsummarized counts of a user
+SUMMARY_TRIGGER_DELAY = 300  # Seconds a triggered run waits, so a burst of inserts starts one run
+SUMMARY_HOURLY_BUDGET = 120  # Summarization runs started per hour across all workers
+SUMMARY_MAX_COUNTDOWN = 1800  # Longest delay of a postponed run, under the broker's visibility_timeout
+
+# Contradiction Detection
+CONTRADICTION_ENABLED = True  # Compare new memories with their nearest neighbours for contradictions
+CONTRADICTION_MODEL = 'phi4'  # Ollama model judging the pairs
+CONTRADICTION_CANDIDATES = 5  # Nearest memories of the user each new memory is compared with
+CONTRADICTION_MAX_DISTANCE = 0.35  # Cosine distance over which memories are too unrelated to compare
+CONTRADICTION_PAIRS_PER_PROMPT = 10  # Pairs judged per LLM call
+CONTRADICTION_MAX_PARALLEL_CALLS = 4  # Concurrent LLM calls per batch
+CONTRADICTION_BATCH_SIZE = 64  # Memories checked per transaction
+CONTRADICTION_DELAY = 10  # Seconds to gather new memories before checking them
+CONTRADICTION_SUPERSEDE = True  # Hide the older memory of a contradiction, otherwise only record it
+
+# Archive
+ARCHIVE_ENABLED = True  # Move old summarized memories out of the memory table
+ARCHIVE_AFTER_DAYS = 30  # Age of a summarized memory before it is archived
+ARCHIVE_EMBEDDINGS = True  # Keep a half-precision embedding, so searches can still drill into archived memories
+ARCHIVE_BATCH_SIZE = 1000  # Memories moved per transaction
+
+# Metrics Configuration
+METRICS_ENABLED = True
+METRICS_REDIS_URL = 'redis://localhost:6379/2'  # Aggregated counters and histograms of all processes
+METRICS_FLUSH_INTERVAL = 5  # Seconds between two flushes of a process's buffered metrics
+METRICS_ALLOWED_NETWORKS = ['127.0.0.1/32', '::1/128']  # Clients allowed to scrape /metrics, by REMOTE_ADDR
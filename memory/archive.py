@@ -0,0 +1,91 @@
+"""
+Cold archive of summarized memories.
+
+Once a memory is summarized it leaves every search and list, but it
+still weighs on the memory table and its indexes. Summarized memories
+created more than ARCHIVE_AFTER_DAYS ago are moved to ArchivedMemory,
+with their half-precision embedding (or none, ARCHIVE_EMBEDDINGS), in
+batches of ARCHIVE_BATCH_SIZE: each batch is deleted from the memory
+table and inserted in the archive by a single statement, on rows
+claimed with SKIP LOCKED so several workers can share the work.
+
+Summaries are never archived, so no memory ever points at an archived
+one through its summary, and a memory that superseded another one stays
+until that one is archived too: the links of the memory table always
+point at memories. Archived rows are not searchable, the hot user caches
+don't hold them and need no invalidation. Their contradiction checks
+are dropped in the same statement, they are never compared again.
+"""
+from datetime import timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .metrics import MEMORIES_ARCHIVED
+from .models import ArchivedMemory, ContradictionCheck, Memory
+
+COLUMNS = (
+    'id', 'user_id', 'channel_id', 'server_id', 'content', 'metadata', 'embedding_model',
+    'created_at', 'updated_at', 'summary_id', 'superseded_by_id',
+)
+
+def archive_batch(cutoff, batch_size: int, embeddings: bool) -> int:
+    """Move one batch of summarized memories created before ``cutoff``. Returns the number moved."""
+    columns = ', '.join(COLUMNS)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"""
+            WITH moved AS (
+                DELETE FROM {Memory._meta.db_table} m
+                WHERE (m.id, m.user_id) IN (
+                    SELECT id, user_id FROM {Memory._meta.db_table} c
+                    WHERE summary_id IS NOT NULL
+                      AND NOT (metadata ? 'type' AND metadata->>'type' = 'summary')
+                      AND created_at < %s
+                      -- Still hiding a memory it superseded, the link must keep pointing at a memory
+                      AND NOT EXISTS (SELECT 1 FROM {Memory._meta.db_table} s WHERE s.superseded_by_id = c.id)
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING {', '.join(f'm.{column}' for column in COLUMNS)}, m.embeddings, m.embeddings_next
+            ), archived AS (
+                INSERT INTO {ArchivedMemory._meta.db_table} ({columns}, embeddings, embeddings_next, archived_at)
+                -- A re-embedding in progress keeps what it did for them
+                SELECT {columns}, CASE WHEN %s THEN embeddings::halfvec END,
+                       CASE WHEN %s THEN embeddings_next::halfvec END, now()
+                FROM moved
+                -- Imported again after it was archived, the archived copy stays
+                ON CONFLICT (id) DO NOTHING
+            ), checks AS (
+                DELETE FROM {ContradictionCheck._meta.db_table}
+                WHERE first_id IN (SELECT id FROM moved) OR second_id IN (SELECT id FROM moved)
+            )
+            SELECT count(*) FROM moved
+        """, [cutoff, batch_size, embeddings, embeddings])
+        return cursor.fetchone()[0]
+
+def archive_summarized(batch_size: Optional[int] = None, after_days: Optional[int] = None) -> int:
+    """Archive the summarized memories older than ``after_days``, batch after batch. Returns the number archived."""
+    batch_size = batch_size or settings.ARCHIVE_BATCH_SIZE
+    after_days = settings.ARCHIVE_AFTER_DAYS if after_days is None else after_days
+    cutoff = timezone.now() - timedelta(days=after_days)
+    total = 0
+    while True:
+        count = archive_batch(cutoff, batch_size, settings.ARCHIVE_EMBEDDINGS)
+        MEMORIES_ARCHIVED.inc(count)
+        total += count
+        if count < batch_size:
+            return total
+
+def get_memory(memory_id, user_id=None):
+    """
+    The memory with this id, from the memory table or else the archive, or
+    None. With its owner's ``user_id``, a partitioned table only reads the
+    owner's partition instead of probing all of them.
+    """
+    owner = {'user_id': user_id} if user_id else {}
+    memory = Memory.objects.select_related('user').filter(id=memory_id, **owner).first()
+    if memory is None:
+        memory = ArchivedMemory.objects.select_related('user').defer('embeddings', 'embeddings_next').filter(id=memory_id, **owner).first()
+    return memory
@@ -0,0 +1,296 @@
+"""
+Retrieval benchmark: synthetic corpora, latency, throughput and recall.
+
+Corpora are deterministic for a given size and seed. Users follow a Zipf
+distribution, so a few heavy users get large scopes and most get small
+ones. Each user writes about a few topics, so embeddings form clusters
+like real memories. Texts are embedded by the stub Ollama server
+(``memory.stub_ollama``).
+
+Queries go through the ``search_memories`` view. Recall@k compares its
+results with an exact scan of the same scope.
+"""
+import json
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import connection, transaction
+from django.test import RequestFactory
+from pgvector.django import HnswIndex
+
+from .embeddings import active_model
+from .ingest import resolve_users
+from .models import ContradictionCheck, Memory, SEARCHABLE, UserProfile
+from .ollama import OllamaClient
+from .quantization import HALF_INDEX, half_index
+from .search import EXACT, search
+
+USER_PREFIX = 'bench-'
+LIVE_INDEX = 'memory_live_hnsw_idx'
+SCALES = {'10k': 10_000, '100k': 100_000, '1m': 1_000_000}
+VOCABULARY_SIZE = 5000
+TOPICS = 200
+TOPIC_WORDS = 40
+TOPICS_PER_USER = 3
+WORDS_PER_TEXT = 12
+TOPIC_SHARE = 0.75  # Words of a text drawn from one of its author's topics
+
+SYLLABLES = [c + v for c in 'bdfgklmnprstvz' for v in 'aeiou']
+
+@dataclass
+class Corpus:
+    """Deterministic description of a synthetic corpus."""
+    size: int
+    seed: int = 0
+
+    def __post_init__(self):
+        rng = np.random.default_rng(self.seed)
+        self.vocabulary = self._vocabulary(rng)
+        self.topics = rng.integers(0, VOCABULARY_SIZE, size=(TOPICS, TOPIC_WORDS))
+        self.users = max(10, self.size // 100)
+        self.servers = max(1, self.users // 20)
+        self.user_topics = rng.integers(0, TOPICS, size=(self.users, TOPICS_PER_USER))
+        self.user_servers = rng.integers(0, self.servers, size=self.users)
+        weights = 1 / np.arange(1, self.users + 1) ** 1.1
+        self.user_weights = weights / weights.sum()
+
+    @staticmethod
+    def _vocabulary(rng) -> List[str]:
+        words = set()
+        while len(words) < VOCABULARY_SIZE:
+            words.add(''.join(rng.choice(SYLLABLES, size=rng.integers(2, 5))))
+        return sorted(words)
+
+    def username(self, user: int) -> str:
+        return f"{USER_PREFIX}{user:07d}"
+
+    def server_id(self, user: int) -> str:
+        return f"bench-server-{self.user_servers[user]}"
+
+    def channel_id(self, user: int, channel: int) -> str:
+        return f"bench-channel-{self.user_servers[user]}-{channel}"
+
+    def text(self, rng, user: int) -> str:
+        topic = self.topics[rng.choice(self.user_topics[user])]
+        topical = int(WORDS_PER_TEXT * TOPIC_SHARE)
+        words = np.concatenate([
+            rng.choice(topic, size=topical),
+            rng.integers(0, VOCABULARY_SIZE, size=WORDS_PER_TEXT - topical),
+        ])
+        return ' '.join(self.vocabulary[w] for w in words)
+
+    def memories(self, start: int, stop: int) -> List[Dict[str, str]]:
+        """Memories ``start`` to ``stop``, the same for a given corpus whatever the batching."""
+        items = []
+        for i in range(start, stop):
+            rng = np.random.default_rng([self.seed, 0, i])
+            user = int(rng.choice(self.users, p=self.user_weights))
+            items.append({
+                'username': self.username(user),
+                'server_id': self.server_id(user),
+                'channel_id': self.channel_id(user, int(rng.integers(0, 5))),
+                'content': self.text(rng, user),
+            })
+        return items
+
+    def queries(self, count: int) -> List[Dict[str, str]]:
+        """Search payloads over global, user and channel scopes, heavy users drawn more often."""
+        rng = np.random.default_rng([self.seed, 1, 0])
+        payloads = []
+        for i in range(count):
+            user = int(rng.choice(self.users, p=self.user_weights))
+            payload = {'query': self.text(rng, user)}
+            scope = ('global', 'user', 'channel')[i % 3]
+            if scope == 'user':
+                payload['username'] = self.username(user)
+            elif scope == 'channel':
+                payload['channel_id'] = self.channel_id(user, int(rng.integers(0, 5)))
+            payloads.append(payload)
+        return payloads
+
+def scope_of(payload: Dict[str, str]) -> str:
+    if 'username' in payload:
+        return 'user'
+    if 'channel_id' in payload:
+        return 'channel'
+    return 'global'
+
+def generate(corpus: Corpus, client: OllamaClient, batch_size: int = 1000, log=print) -> int:
+    """Insert the corpus, returns the number of memories written."""
+    embed_size = settings.EMBEDDING_BULK_BATCH_SIZE
+    model = active_model()
+    written = 0
+    for start in range(0, corpus.size, batch_size):
+        items = corpus.memories(start, min(start + batch_size, corpus.size))
+        texts = [item['content'] for item in items]
+        embeddings = []
+        for i in range(0, len(texts), embed_size):
+            embeddings.extend(client.embed(texts[i:i + embed_size], model))
+        users = resolve_users(item['username'] for item in items)
+        Memory.objects.bulk_create([
+            Memory(
+                user=users[item['username']],
+                server_id=item['server_id'],
+                channel_id=item['channel_id'],
+                content=item['content'],
+                embeddings=embedding,
+                embedding_model=model,
+                metadata={'benchmark': True},
+            )
+            for item, embedding in zip(items, embeddings)
+        ], batch_size=settings.MEMORY_BULK_INSERT_BATCH_SIZE)
+        written += len(items)
+        log(f"Inserted {written}/{corpus.size} memories")
+    return written
+
+def clean() -> int:
+    """Delete benchmark users and memories, returns the number of memories deleted."""
+    memory_table = Memory._meta.db_table
+    user_table = UserProfile._meta.db_table
+    check_table = ContradictionCheck._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        # Raw DELETE: the ORM would load every row to cascade the links. Checks
+        # only pair memories of one user, so they all go with the memories
+        cursor.execute(f"""
+            WITH memories AS (
+                DELETE FROM {memory_table} WHERE user_id IN (SELECT id FROM {user_table} WHERE username LIKE %s)
+                RETURNING id
+            ), checks AS (
+                DELETE FROM {check_table}
+                WHERE first_id IN (SELECT id FROM memories) OR second_id IN (SELECT id FROM memories)
+            )
+            SELECT count(*) FROM memories
+        """, [USER_PREFIX + '%'])
+        deleted = cursor.fetchone()[0]
+    UserProfile.objects.filter(username__startswith=USER_PREFIX).delete()
+    return deleted
+
+def search_index(m: int, ef_construction: int, quantized: bool = False) -> HnswIndex:
+    """The searchable HNSW index graph scans read: the halfvec one with SEARCH_QUANTIZED."""
+    if quantized:
+        return half_index(m, ef_construction)
+    return HnswIndex(
+        name=LIVE_INDEX,
+        fields=['embeddings'],
+        opclasses=['vector_cosine_ops'],
+        m=m,
+        ef_construction=ef_construction,
+        condition=SEARCHABLE,
+    )
+
+def drop_search_index(quantized: bool = False) -> None:
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP INDEX IF EXISTS "{HALF_INDEX if quantized else LIVE_INDEX}"')
+
+def build_search_index(m: int, ef_construction: int, quantized: bool = False) -> float:
+    """(Re)build the searchable HNSW index with the given parameters, returns the build time."""
+    drop_search_index(quantized)
+    start = time.perf_counter()
+    with connection.schema_editor() as schema_editor:
+        schema_editor.add_index(Memory, search_index(m, ef_construction, quantized))
+    return time.perf_counter() - start
+
+@dataclass
+class RunResult:
+    m: Optional[int]
+    ef_construction: Optional[int]
+    ef_search: int
+    scope: str
+    concurrency: int
+    queries: int
+    p50_ms: float
+    p99_ms: float
+    qps: float
+    recall: float
+    strategies: Dict[str, int]
+
+    def row(self) -> str:
+        strategies = ', '.join(f"{name}={count}" for name, count in sorted(self.strategies.items()))
+        return (f"{self.m or '-':>4} {self.ef_construction or '-':>5} {self.ef_search:>6} {self.scope:>8} "
+                f"{self.concurrency:>4} {self.p50_ms:>9.2f} {self.p99_ms:>9.2f} {self.qps:>9.1f} "
+                f"{self.recall:>7.3f}  {strategies}")
+
+HEADER = f"{'m':>4} {'efc':>5} {'ef':>6} {'scope':>8} {'conc':>4} {'p50 ms':>9} {'p99 ms':>9} {'qps':>9} {'recall':>7}  strategies"
+
+def exact_ids(payloads: List[Dict[str, str]], k: int) -> List[List[str]]:
+    """
+    Ground truth: ids of the ``k`` nearest memories of each scope, by exact
+    scan. This also caches the query embeddings, so runs time the search only.
+    """
+    from .embeddings import compute_embedding
+
+    embeddings = compute_embedding([p['query'] for p in payloads])
+    users = {u.username: u for u in UserProfile.objects.filter(
+        username__in={p['username'] for p in payloads if 'username' in p}
+    )}
+    truth = []
+    for payload, embedding in zip(payloads, embeddings):
+        result = search(
+            embedding, user=users.get(payload.get('username')), channel_id=payload.get('channel_id'),
+            server_id=payload.get('server_id'), k=k, strategy=EXACT,
+        )
+        truth.append([str(m.id) for m in result.memories])
+    return truth
+
+def _call_view(factory: RequestFactory, payload: Dict[str, str]) -> Tuple[float, dict]:
+    from .views import search_memories
+
+    request = factory.post('/memory/search/', json.dumps(payload), content_type='application/json')
+    start = time.perf_counter()
+    response = async_to_sync(search_memories)(request)
+    elapsed = time.perf_counter() - start
+    return elapsed, json.loads(response.content)
+
+def _worker(payloads: List[Tuple[int, Dict[str, str]]]) -> List[Tuple[int, float, dict]]:
+    factory = RequestFactory()
+    try:
+        return [(i, *_call_view(factory, payload)) for i, payload in payloads]
+    finally:
+        connection.close()
+
+def measure(payloads: List[Dict[str, str]], truth: List[List[str]], k: int, concurrency: int,
+            **labels) -> List[RunResult]:
+    """Run every query through search_memories, one result per scope kind."""
+    payloads = [dict(p, k=k) for p in payloads]
+    shares = [list(enumerate(payloads))[i::concurrency] for i in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        calls = [call for share in executor.map(_worker, shares) for call in share]
+    wall = time.perf_counter() - start
+
+    results = []
+    for scope in ('global', 'user', 'channel'):
+        scoped = [(i, elapsed, body) for i, elapsed, body in calls if scope_of(payloads[i]) == scope]
+        if not scoped:
+            continue
+        for _, _, body in scoped:
+            if 'error' in body:
+                raise RuntimeError(f"search_memories failed: {body['error']}")
+        latencies = np.array([elapsed for _, elapsed, _ in scoped]) * 1000
+        recalls = [
+            len({m['id'] for m in body['memories']} & set(truth[i])) / len(truth[i])
+            for i, _, body in scoped if truth[i]
+        ]
+        results.append(RunResult(
+            scope=scope,
+            concurrency=concurrency,
+            queries=len(scoped),
+            p50_ms=float(np.percentile(latencies, 50)),
+            p99_ms=float(np.percentile(latencies, 99)),
+            # Throughput of the whole mixed workload
+            qps=len(calls) / wall,
+            recall=float(np.mean(recalls)) if recalls else 1.0,
+            strategies=dict(Counter(body['strategy'] for _, _, body in scoped)),
+            **labels,
+        ))
+    return results
+
+def save(results: List[RunResult], path: str) -> None:
+    with open(path, 'w') as f:
+        json.dump([asdict(r) for r in results], f, indent=2)
@@ -0,0 +1,223 @@
+"""
+Contradiction detection between the memories of a user.
+
+Comparing every pair of memories with the LLM is quadratic. Instead,
+each new memory (summaries included) is only compared with its
+CONTRADICTION_CANDIDATES nearest searchable memories of the same user
+within CONTRADICTION_MAX_DISTANCE, found through the vector index, so
+the cost grows with k per memory. Every verdict is recorded in
+ContradictionCheck and a pair is never sent to the LLM twice.
+
+Pairs are judged CONTRADICTION_PAIRS_PER_PROMPT at a time, with Ollama's
+JSON output. When two memories contradict, the older one is superseded
+by the newer one and leaves the searches (CONTRADICTION_SUPERSEDE). A
+pair involving a summary is only recorded, since a summary holds many
+facts and is never superseded for one of them.
+"""
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import requests
+from django.conf import settings
+from django.db import transaction
+
+from .embeddings import active_model
+from .hot_cache import invalidate_users
+from .metrics import CONTRADICTION_PAIRS
+from .models import ContradictionCheck, Memory, SEARCHABLE
+from .ollama import get_ollama_client
+from .search import is_summary, search
+
+logger = logging.getLogger(__name__)
+
+PROMPT = """
+You compare facts remembered about the same user, two by two.
+Two facts contradict each other when they can't both be true now, for example "Lives in Paris" and "Moved to Berlin last year", or "Likes coffee" and "Never drinks coffee".
+Facts on different topics, or where one only adds details to the other, don't contradict each other.
+Answer with a JSON object holding one verdict per pair, and nothing else:
+{"verdicts": [{"pair": 1, "contradiction": false}, {"pair": 2, "contradiction": true}]}
+"""
+
+Pair = Tuple[Memory, Memory]
+
+def pair_key(a: Memory, b: Memory) -> tuple:
+    """The pair's ids, lowest first, as stored in ContradictionCheck."""
+    return (a.id, b.id) if a.id < b.id else (b.id, a.id)
+
+def candidates(memory: Memory) -> List[Memory]:
+    """The nearest searchable memories of the user within CONTRADICTION_MAX_DISTANCE."""
+    result = search(memory.embeddings, user=memory.user, k=settings.CONTRADICTION_CANDIDATES + 1)
+    return [
+        other for other in result.memories
+        if other.id != memory.id and other.distance <= settings.CONTRADICTION_MAX_DISTANCE
+    ][:settings.CONTRADICTION_CANDIDATES]
+
+def unchecked_pairs(memories: List[Memory]) -> Tuple[Dict[tuple, Tuple[Memory, Memory, float]], Dict[tuple, set]]:
+    """
+    Pairs of each memory with its candidates, without the ones judged
+    already, and the ids of the memories each pair was found for.
+    """
+    pairs, owners = {}, {}
+    for memory in memories:
+        for other in candidates(memory):
+            key = pair_key(memory, other)
+            pairs.setdefault(key, (memory, other, other.distance))
+            owners.setdefault(key, set()).add(memory.id)
+    if not pairs:
+        return pairs, owners
+
+    firsts = {first for first, _ in pairs}
+    seconds = {second for _, second in pairs}
+    checked = ContradictionCheck.objects.filter(first__in=firsts, second__in=seconds).values_list('first', 'second')
+    for key in checked:
+        pairs.pop(key, None)
+    return pairs, owners
+
+def judge(pairs: List[Pair]) -> Optional[List[Optional[bool]]]:
+    """
+    Ask the LLM which pairs contradict each other, in one call. Returns
+    one verdict per pair, None for a pair left out of the answer, or None
+    when the request failed.
+    """
+    text = "\n\n".join(
+        f"Pair {number}:\nA: {a.content}\nB: {b.content}" for number, (a, b) in enumerate(pairs, 1)
+    )
+    try:
+        response = get_ollama_client().chat({
+            "model": settings.CONTRADICTION_MODEL,
+            "messages": [
+                {"role": "system", "content": PROMPT},
+                {"role": "user", "content": text},
+            ],
+            "format": "json",
+            "stream": False,
+            "options": {
+                "num_ctx": 1024*32,
+                "temperature": 0
+            }
+        })
+    except requests.RequestException as e:
+        logger.warning("Contradiction check request failed: %s", e)
+        return None
+
+    verdicts = [None] * len(pairs)
+    try:
+        answer = json.loads(response.get("message", {}).get("content", ""))
+        for verdict in answer.get("verdicts", []):
+            number, contradiction = verdict.get("pair"), verdict.get("contradiction")
+            if isinstance(number, int) and 1 <= number <= len(pairs) and isinstance(contradiction, bool):
+                verdicts[number - 1] = contradiction
+    except (ValueError, AttributeError):
+        logger.warning("Invalid contradiction check answer: %r", response.get("message"))
+    return verdicts
+
+def supersede(contradicting: List[Pair]) -> int:
+    """Supersede the older memory of each pair with the newer one. Returns the number superseded."""
+    superseded = 0
+    user_ids = set()
+    for a, b in contradicting:
+        if is_summary(a) or is_summary(b):
+            continue
+        older, newer = sorted((a, b), key=lambda m: (m.created_at, m.id))
+        # A memory superseded meanwhile keeps its first successor
+        if Memory.objects.filter(id=older.id, user_id=older.user_id, superseded_by__isnull=True).update(
+            superseded_by=newer.id
+        ):
+            superseded += 1
+            user_ids.add(older.user_id)
+    invalidate_users(user_ids)
+    return superseded
+
+def check(memories: List[Memory]) -> Tuple[set, int, int]:
+    """
+    Judge the unchecked pairs of the memories and record the verdicts.
+    Returns the ids of the memories whose pairs all got a verdict, the
+    number of contradictions and the number of memories superseded.
+    """
+    pairs, owners = unchecked_pairs(memories)
+    keys = list(pairs)
+    size = settings.CONTRADICTION_PAIRS_PER_PROMPT
+    prompts = [[pairs[key][:2] for key in keys[i:i + size]] for i in range(0, len(keys), size)]
+    with ThreadPoolExecutor(max_workers=settings.CONTRADICTION_MAX_PARALLEL_CALLS) as executor:
+        answers = list(executor.map(judge, prompts))
+
+    done = {memory.id for memory in memories}
+    checks, contradicting = [], []
+    for i, answer in enumerate(answers):
+        prompt_keys = keys[i * size:(i + 1) * size]
+        for key, contradiction in zip(prompt_keys, answer or [None] * len(prompt_keys)):
+            if contradiction is None:
+                # Unreachable LLM or pair left out of its answer: the memories
+                # it was found for are checked again on the next run
+                done -= owners[key]
+                continue
+            a, b, distance = pairs[key]
+            verdict = ContradictionCheck.CONTRADICTS if contradiction else ContradictionCheck.CONSISTENT
+            checks.append(ContradictionCheck(first_id=key[0], second_id=key[1], verdict=verdict, distance=distance))
+            CONTRADICTION_PAIRS.inc(verdict=verdict)
+            if contradiction:
+                contradicting.append((a, b))
+
+    ContradictionCheck.objects.bulk_create(checks, ignore_conflicts=True)
+    superseded = supersede(contradicting) if settings.CONTRADICTION_SUPERSEDE else 0
+    return done, len(contradicting), superseded
+
+def claim_pending(batch_size: int) -> List[Memory]:
+    """
+    Claim memories waiting for their check, in a short transaction: their
+    flag is cleared so other workers skip them, and set again by
+    ``check_pending`` for the ones it couldn't check. The memories of a
+    worker dying in between stay unchecked.
+    """
+    with transaction.atomic():
+        memories = list(
+            # Until a cutover switched them, older vectors don't compare with the active model's
+            Memory.objects.filter(contradiction_pending=True, embedding_pending=False, embedding_model=active_model())
+            .select_for_update(skip_locked=True, of=('self',))
+            .select_related('user')
+            .order_by('created_at')[:batch_size]
+        )
+        if memories:
+            Memory.objects.filter(id__in=[m.id for m in memories], user_id__in={m.user_id for m in memories}).update(
+                contradiction_pending=False
+            )
+    return memories
+
+def check_pending(batch_size: Optional[int] = None) -> Tuple[int, int, int]:
+    """
+    Check the memories waiting for their contradiction check, in batches
+    claimed with SKIP LOCKED so several workers can share them. No lock is
+    held during the LLM calls. Returns the number of memories checked,
+    contradictions and memories superseded.
+    """
+    batch_size = batch_size or settings.CONTRADICTION_BATCH_SIZE
+    if not settings.CONTRADICTION_ENABLED:
+        Memory.objects.filter(contradiction_pending=True).update(contradiction_pending=False)
+        return 0, 0, 0
+
+    total = contradictions = superseded = 0
+    while True:
+        memories = claim_pending(batch_size)
+        if not memories:
+            break
+
+        # Summarized or superseded before their turn, nothing to compare
+        searchable = set(
+            Memory.objects.filter(SEARCHABLE, id__in=[m.id for m in memories]).values_list('id', flat=True)
+        )
+        done, found, replaced = check([m for m in memories if m.id in searchable])
+        done |= {m.id for m in memories if m.id not in searchable}
+        left = [m for m in memories if m.id not in done]
+        if left:
+            Memory.objects.filter(id__in=[m.id for m in left], user_id__in={m.user_id for m in left}).update(
+                contradiction_pending=True
+            )
+        total += len(done)
+        contradictions += found
+        superseded += replaced
+        if left:
+            # The LLM is failing, leave the rest to the next run
+            break
+    return total, contradictions, superseded
@@ -0,0 +1,116 @@
+"""
+Near-duplicate detection at ingest.
+
+A new memory whose embedding is within DEDUP_DISTANCE (cosine) of a
+searchable memory of the same user/channel/server scope (a memory
+without a channel only duplicates memories without one) is merged into
+it instead of being inserted: the existing memory counts one more
+``hits`` and records ``last_seen`` in its metadata. Within a bulk batch,
+items are also merged into an earlier item of the same scope.
+
+Summaries are never merged into, and memories written pending (async
+mode) are not deduplicated since they have no embedding yet.
+"""
+from collections import Counter
+from typing import Dict, Hashable, List, Optional, Sequence
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from .hot_cache import invalidate_users
+from .metrics import MEMORIES_MERGED
+from .models import Memory, SEARCHABLE, UserProfile
+from .search import is_summary, nearest
+
+BLOCK_ROWS = 1024  # Rows of the similarity matrix computed at once within a batch
+
+def scope_memories(user: UserProfile, channel_id: Optional[str], server_id: Optional[str]) -> QuerySet:
+    """
+    Searchable memories of exactly this scope: unlike a search filter, a
+    None channel or server only matches memories without one.
+    """
+    return Memory.objects.filter(SEARCHABLE, user=user, channel_id=channel_id, server_id=server_id)
+
+def duplicates(embeddings, *, user: UserProfile, channel_id: Optional[str] = None,
+               server_id: Optional[str] = None) -> List[Optional[Memory]]:
+    """
+    For each embedding, the nearest memory of the scope within
+    DEDUP_DISTANCE among its DEDUP_CANDIDATES nearest, summaries
+    skipped, or None. One query for all of them.
+    """
+    neighbours = nearest(
+        scope_memories(user, channel_id, server_id), embeddings, settings.DEDUP_CANDIDATES,
+        ('dedup', user.pk, channel_id, server_id),
+    )
+    ids = {memory_id for found in neighbours for memory_id, distance in found if distance <= settings.DEDUP_DISTANCE}
+    memories = {m.id: m for m in Memory.objects.filter(id__in=ids, user=user)} if ids else {}
+    matches = []
+    for found in neighbours:
+        match = None
+        for memory_id, distance in found:
+            if distance > settings.DEDUP_DISTANCE:
+                break
+            if not is_summary(memories[memory_id]):
+                match = memories[memory_id]
+                break
+        matches.append(match)
+    return matches
+
+def duplicate_of(embedding, *, user: UserProfile, channel_id: Optional[str] = None,
+                 server_id: Optional[str] = None) -> Optional[Memory]:
+    """The nearest memory of the scope within DEDUP_DISTANCE, if any."""
+    return duplicates([embedding], user=user, channel_id=channel_id, server_id=server_id)[0]
+
+def batch_duplicates(scopes: Sequence[Hashable], embeddings: np.ndarray) -> List[Optional[int]]:
+    """
+    For each item, the index of the first earlier item of the same scope
+    it duplicates (itself a first occurrence), or None.
+    """
+    groups: Dict[Hashable, List[int]] = {}
+    for i, scope in enumerate(scopes):
+        groups.setdefault(scope, []).append(i)
+
+    duplicates: List[Optional[int]] = [None] * len(scopes)
+    min_similarity = 1 - settings.DEDUP_DISTANCE
+    for indexes in groups.values():
+        if len(indexes) < 2:
+            continue
+        vectors = np.asarray(embeddings[indexes], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        vectors /= norms
+        for start in range(0, len(indexes), BLOCK_ROWS):
+            similar = vectors[start:start + BLOCK_ROWS] @ vectors.T >= min_similarity
+            for row, j in enumerate(range(start, min(start + BLOCK_ROWS, len(indexes)))):
+                earlier = np.flatnonzero(similar[row, :j])
+                if len(earlier):
+                    first = indexes[earlier[0]]
+                    # Point at the first occurrence, which is always kept
+                    duplicates[indexes[j]] = first if duplicates[first] is None else duplicates[first]
+    return duplicates
+
+def merge(hits: Counter, user_ids) -> None:
+    """Add ``hits[id]`` hits to each memory and mark it seen now."""
+    if not hits:
+        return
+    now = timezone.now()
+    table = Memory._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            UPDATE {table} m SET
+                metadata = m.metadata || jsonb_build_object(
+                    'hits', COALESCE((m.metadata->>'hits')::int, 1) + t.hits,
+                    'last_seen', %s::text
+                ),
+                updated_at = %s
+            FROM unnest(%s::uuid[], %s::int[]) AS t(id, hits)
+            WHERE m.id = t.id AND m.user_id = ANY(%s::uuid[])
+        """, [
+            now.isoformat(), now, [str(memory_id) for memory_id in hits], list(hits.values()),
+            [str(user_id) for user_id in user_ids],
+        ])
+    MEMORIES_MERGED.inc(sum(hits.values()))
+    invalidate_users(user_ids)
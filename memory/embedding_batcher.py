@@ -0,0 +1,115 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+from django.conf import settings
+
+from .metrics import EMBEDDING_BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+EmbedFunction = Callable[[List[str], str], Sequence[Sequence[float]]]
+
+class EmbeddingBatcher:
+    """
+    Coalesce concurrent embedding requests of a process into batched calls.
+
+    Callers submit texts and get one future per text. A collector thread
+    waits at most ``window`` seconds after the first pending text, or until
+    ``max_batch`` texts are queued, then sends them to ``embed_fn`` in one
+    call per model. Up to ``concurrency`` batches can be in flight at once.
+    """
+
+    def __init__(self, embed_fn: EmbedFunction, window: float, max_batch: int, concurrency: int = 1):
+        self.embed_fn = embed_fn
+        self.window = window
+        self.max_batch = max_batch
+        self.concurrency = concurrency
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_worker(self) -> None:
+        # Threads do not survive a fork (gunicorn, Celery prefork), restart them in the child
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.concurrency, thread_name_prefix="embedding-batch"
+            )
+            thread = threading.Thread(target=self._collect, name="embedding-batcher", daemon=True)
+            thread.start()
+            self._pid = os.getpid()
+
+    def submit(self, texts: Sequence[str], model: str) -> List[Future]:
+        """Queue texts for embedding, returns one future per text."""
+        self._ensure_worker()
+        futures = []
+        for text in texts:
+            future = Future()
+            self._queue.put((model, text, future))
+            futures.append(future)
+        return futures
+
+    def embed(self, texts: Sequence[str], model: str) -> np.ndarray:
+        """Embed texts through the batcher and wait for the vectors."""
+        return np.asarray([f.result() for f in self.submit(texts, model)], dtype=np.float32)
+
+    def _collect(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        batch.append(self._queue.get(timeout=remaining))
+                    else:
+                        batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            by_model = {}
+            for model, text, future in batch:
+                by_model.setdefault(model, []).append((text, future))
+            for model, items in by_model.items():
+                self._executor.submit(self._flush, model, items)
+
+    def _flush(self, model: str, items) -> None:
+        futures = [future for _, future in items]
+        EMBEDDING_BATCH_SIZE.observe(len(items), model=model)
+        try:
+            embeddings = self.embed_fn([text for text, _ in items], model)
+            if len(embeddings) != len(items):
+                raise ValueError(f"Expected {len(items)} embeddings, got {len(embeddings)}")
+        except Exception as e:
+            logger.warning("Embedding batch of %d texts failed: %s", len(items), e)
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future, embedding in zip(futures, embeddings):
+            future.set_result(embedding)
+
+_batcher: Optional[EmbeddingBatcher] = None
+_batcher_lock = threading.Lock()
+
+def get_embedding_batcher(embed_fn: EmbedFunction) -> EmbeddingBatcher:
+    """Return the process-wide batcher, created on first use."""
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = EmbeddingBatcher(
+                    embed_fn,
+                    window=settings.EMBEDDING_BATCH_WINDOW,
+                    max_batch=settings.EMBEDDING_BATCH_MAX_SIZE,
+                    concurrency=settings.EMBEDDING_BATCH_CONCURRENCY,
+                )
+    return _batcher
@@ -0,0 +1,151 @@
+import hashlib
+import logging
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+def normalize_text(text: str) -> str:
+    """Normalize text so trivially different inputs share a cache entry."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+def cache_key(model: str, text: str) -> str:
+    """Build the cache key for a (model, text) pair."""
+    digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+    return f"emb:{model}:{digest}"
+
+class LRUCache:
+    """Thread-safe in-process LRU cache with a per-entry TTL."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache: a per-process LRU in front of a shared
+    Django cache (Redis). The shared tier is best effort, any error there
+    is logged and treated as a miss.
+    """
+
+    def __init__(self):
+        self.local = LRUCache(settings.EMBEDDING_CACHE_SIZE, settings.EMBEDDING_CACHE_TTL)
+        self._stats = {"local_hits": 0, "shared_hits": 0, "misses": 0}
+        self._stats_lock = threading.Lock()
+
+    @property
+    def shared(self):
+        alias = settings.EMBEDDING_CACHE_ALIAS
+        return caches[alias] if alias else None
+
+    def _count(self, name: str, amount: int) -> None:
+        if amount:
+            with self._stats_lock:
+                self._stats[name] += amount
+
+    def stats(self) -> Dict[str, int]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["local_size"] = len(self.local)
+        return stats
+
+    def get_many(self, model: str, texts: Sequence[str]) -> Dict[int, np.ndarray]:
+        """Return the cached vectors for ``texts``, keyed by their index."""
+        keys = [cache_key(model, text) for text in texts]
+        found = {}
+        remote = {}
+        for i, key in enumerate(keys):
+            vector = self.local.get(key)
+            if vector is not None:
+                found[i] = vector
+            else:
+                remote.setdefault(key, []).append(i)
+        self._count("local_hits", len(found))
+
+        if remote and self.shared is not None:
+            try:
+                values = self.shared.get_many(list(remote))
+            except Exception:
+                logger.warning("Shared embedding cache lookup failed", exc_info=True)
+                values = {}
+            for key, raw in values.items():
+                vector = np.frombuffer(raw, dtype=np.float32)
+                self.local.set(key, vector)
+                for i in remote.pop(key):
+                    found[i] = vector
+                    self._count("shared_hits", 1)
+
+        self._count("misses", sum(len(indexes) for indexes in remote.values()))
+        return found
+
+    def set_many(self, model: str, texts: Sequence[str], vectors: Sequence[np.ndarray]) -> None:
+        """Store freshly computed vectors in both tiers."""
+        shared_values = {}
+        for text, vector in zip(texts, vectors):
+            key = cache_key(model, text)
+            vector = np.asarray(vector, dtype=np.float32)
+            self.local.set(key, vector)
+            shared_values[key] = vector.tobytes()
+
+        if shared_values and self.shared is not None:
+            try:
+                self.shared.set_many(shared_values, timeout=settings.EMBEDDING_CACHE_SHARED_TTL)
+            except Exception:
+                logger.warning("Shared embedding cache write failed", exc_info=True)
+
+    def clear(self) -> None:
+        """Clear the in-process tier (the shared tier expires on its own)."""
+        self.local.clear()
+
+_cache: Optional[EmbeddingCache] = None
+_cache_lock = threading.Lock()
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Return the process-wide embedding cache."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = EmbeddingCache()
+    return _cache
+
+def embedding_cache_stats() -> Dict[str, int]:
+    """Hit/miss counters of the process-wide embedding cache."""
+    return get_embedding_cache().stats()
@@ -1,26 +1,128 @@
-import requests
+import asyncio
+import time
 import numpy as np
-from typing import List, Union
+from typing import Dict, List, Optional, Union
+from asgiref.sync import sync_to_async
+from django.conf import settings
 
-OLLAMA_API_URL = "http://llm:11434/api/embed"
+from .embedding_batcher import get_embedding_batcher
+from .embedding_cache import get_embedding_cache, cache_key
+from .metrics import EMBEDDING_SECONDS, EMBEDDING_TEXTS, timer
+from .ollama import get_ollama_client, get_async_ollama_client
 
-def compute_embedding(text: Union[str, List[str]], model: str = "nomic-embed-text") -> np.ndarray:
+_active_model = (None, 0.0)
+
+def active_model() -> str:
     """
-    Compute embeddings for a text or list of texts using Ollama.
+    Model memories and queries are embedded with: the active
+    EmbeddingModel, else EMBEDDING_MODEL. Read at most once per
+    EMBEDDING_MODEL_CHECK_INTERVAL per process.
     """
+    global _active_model
+    name, checked = _active_model
+    if name is None or time.monotonic() - checked > settings.EMBEDDING_MODEL_CHECK_INTERVAL:
+        from .models import EmbeddingModel
+
+        name = (
+            EmbeddingModel.objects.filter(state=EmbeddingModel.ACTIVE).values_list('name', flat=True).first()
+            or settings.EMBEDDING_MODEL
+        )
+        _active_model = (name, time.monotonic())
+    return name
+
+def forget_active_model() -> None:
+    """Read the active model again on next use."""
+    global _active_model
+    _active_model = (None, 0.0)
+
+def _request_embeddings(texts: List[str], model: str) -> List[List[float]]:
+    """Ask Ollama for the embeddings of a list of texts."""
+    return get_ollama_client().embed(texts, model)
+
+def _missing(text: List[str], vectors: Dict[int, np.ndarray], model: str) -> Dict[str, List[int]]:
+    """Group the indexes of texts without a cached vector, one entry per distinct text."""
+    missing = {}
+    for i, t in enumerate(text):
+        if i not in vectors:
+            missing.setdefault(cache_key(model, t), []).append(i)
+    return missing
+
+def _fill(vectors: Dict[int, np.ndarray], missing: Dict[str, List[int]], embeddings) -> None:
+    for indexes, embedding in zip(missing.values(), embeddings):
+        for i in indexes:
+            vectors[i] = embedding
+
+def _use_batcher(texts: List[str]) -> bool:
+    # Lists at least one micro-batch long are already a batch on their own
+    return settings.EMBEDDING_BATCH_ENABLED and len(texts) < settings.EMBEDDING_BATCH_MAX_SIZE
+
+def compute_embedding(text: Union[str, List[str]], model: Optional[str] = None) -> np.ndarray:
+    """
+    Compute embeddings for a text or list of texts using Ollama, with the
+    active model unless ``model`` is given.
+    Vectors are served from the embedding cache when possible, only the
+    missing texts are sent to Ollama.
+    """
+    model = model or active_model()
     if isinstance(text, str):
         text = [text]
-    
-    response = requests.post(
-        OLLAMA_API_URL,
-        json={
-            "model": model,
-            "input": text,
-            "truncate": False
-        },
-    )
-
-    response.raise_for_status()
-    embeddings = response.json()["embeddings"]
-
-    return embeddings 
+    if not text:
+        return np.empty((0, 0), dtype=np.float32)
+
+    EMBEDDING_TEXTS.observe(len(text), model=model)
+    cache = get_embedding_cache()
+    vectors = cache.get_many(model, text)
+    missing = _missing(text, vectors, model)
+
+    if missing:
+        texts = [text[indexes[0]] for indexes in missing.values()]
+        with timer('embed', EMBEDDING_SECONDS, model=model):
+            if _use_batcher(texts):
+                # Coalesce with concurrent callers of this process
+                embeddings = get_embedding_batcher(_request_embeddings).embed(texts, model)
+            else:
+                size = settings.EMBEDDING_BULK_BATCH_SIZE
+                embeddings = np.vstack([
+                    np.asarray(_request_embeddings(texts[i:i + size], model), dtype=np.float32)
+                    for i in range(0, len(texts), size)
+                ])
+        cache.set_many(model, texts, embeddings)
+        _fill(vectors, missing, embeddings)
+
+    return np.vstack([vectors[i] for i in range(len(text))])
+
+async def acompute_embedding(text: Union[str, List[str]], model: Optional[str] = None) -> np.ndarray:
+    """
+    Async counterpart of compute_embedding for async views.
+    The event loop is never blocked: the shared cache tier is read in a
+    thread, batched texts are awaited on the batcher futures and large
+    lists go through the async Ollama client.
+    """
+    model = model or await sync_to_async(active_model)()
+    if isinstance(text, str):
+        text = [text]
+    if not text:
+        return np.empty((0, 0), dtype=np.float32)
+
+    EMBEDDING_TEXTS.observe(len(text), model=model)
+    cache = get_embedding_cache()
+    vectors = await sync_to_async(cache.get_many, thread_sensitive=False)(model, text)
+    missing = _missing(text, vectors, model)
+
+    if missing:
+        texts = [text[indexes[0]] for indexes in missing.values()]
+        with timer('embed', EMBEDDING_SECONDS, model=model):
+            if _use_batcher(texts):
+                futures = get_embedding_batcher(_request_embeddings).submit(texts, model)
+                embeddings = await asyncio.gather(*(asyncio.wrap_future(f) for f in futures))
+            else:
+                client = await get_async_ollama_client()
+                size = settings.EMBEDDING_BULK_BATCH_SIZE
+                embeddings = []
+                for i in range(0, len(texts), size):
+                    embeddings.extend(await client.embed(texts[i:i + size], model))
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        await sync_to_async(cache.set_many, thread_sensitive=False)(model, texts, embeddings)
+        _fill(vectors, missing, embeddings)
+
+    return np.vstack([vectors[i] for i in range(len(text))])
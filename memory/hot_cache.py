@@ -0,0 +1,225 @@
+"""
+Per-process cache of the searchable memories of hot users.
+
+A user searched at least HOT_CACHE_ADMIT_SEARCHES times within
+HOT_CACHE_TTL, with at most HOT_CACHE_USER_MAX_ROWS searchable memories,
+gets their embeddings loaded into a contiguous float32 matrix. Their next
+searches are ranked exactly with one matrix-vector product instead of a
+database query.
+
+Every write that changes a user's searchable memories bumps a version
+key in the shared cache once committed, and entries loaded under an
+older version or another active embedding model are reloaded. Entries
+are evicted least recently used first, once the process holds more than
+HOT_CACHE_MAX_ROWS rows.
+"""
+import copy
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Iterable, List, Optional
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .embedding_cache import LRUCache
+from .embeddings import active_model
+from .models import Memory, SEARCHABLE
+
+logger = logging.getLogger(__name__)
+
+def _version_key(user_id) -> str:
+    return f"memory:hot:version:{user_id}"
+
+def current_version(user_id) -> Optional[str]:
+    """
+    Version of a user's searchable memories, created on first use. None
+    when the shared cache is unavailable: invalidations cannot be seen.
+    """
+    key = _version_key(user_id)
+    try:
+        version = cache.get(key)
+        if version is None:
+            cache.add(key, uuid.uuid4().hex, timeout=settings.HOT_CACHE_VERSION_TTL)
+            version = cache.get(key)
+    except Exception:
+        logger.warning("Could not read the version of hot user %s", user_id, exc_info=True)
+        return None
+    return version
+
+def _bump(user_ids) -> None:
+    try:
+        cache.set_many(
+            {_version_key(user_id): uuid.uuid4().hex for user_id in user_ids},
+            timeout=settings.HOT_CACHE_VERSION_TTL,
+        )
+    except Exception:
+        # Stale entries still expire after HOT_CACHE_TTL
+        logger.warning("Could not invalidate hot users %s", user_ids, exc_info=True)
+
+def invalidate_users(user_ids: Iterable) -> None:
+    """
+    Invalidate the cached memories of users once the transaction commits,
+    so no worker reloads them before the change is visible.
+    """
+    user_ids = {str(user_id) for user_id in user_ids}
+    if user_ids:
+        transaction.on_commit(lambda: _bump(user_ids))
+
+@dataclass
+class HotEntry:
+    version: str
+    model: str  # Active embedding model when loaded
+    loaded_at: float
+    vectors: np.ndarray  # (rows, dims), L2-normalized
+    memories: List[Memory]  # Same order as the vectors, embeddings deferred
+    channel_ids: np.ndarray
+    server_ids: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.memories)
+
+class HotUserCache:
+    """Size-bounded LRU of hot users' memory matrices."""
+
+    def __init__(self, max_rows: int, user_max_rows: int, admit_searches: int, ttl: float):
+        self.max_rows = max_rows
+        self.user_max_rows = user_max_rows
+        self.admit_searches = admit_searches
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._rows = 0
+        self._lock = threading.Lock()
+        # Recent searches of users not cached yet, to admit the hot ones only
+        self._searches = LRUCache(maxsize=10000, ttl=ttl)
+        # Users over user_max_rows, not counted again for a while
+        self._too_large = LRUCache(maxsize=10000, ttl=ttl)
+
+    def _get(self, user_id: str, version: str) -> Optional[HotEntry]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            if (entry.version != version or entry.model != active_model()
+                    or entry.loaded_at + self.ttl < time.monotonic()):
+                self._remove(user_id)
+                return None
+            self._entries.move_to_end(user_id)
+            return entry
+
+    def _remove(self, user_id: str) -> None:
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._rows -= len(entry)
+
+    def _put(self, user_id: str, entry: HotEntry) -> None:
+        with self._lock:
+            self._remove(user_id)
+            self._entries[user_id] = entry
+            self._rows += len(entry)
+            while self._rows > self.max_rows and len(self._entries) > 1:
+                self._remove(next(iter(self._entries)))
+
+    def _admit(self, user_id: str) -> bool:
+        if self._too_large.get(user_id):
+            return False
+        searches = (self._searches.get(user_id) or 0) + 1
+        self._searches.set(user_id, searches)
+        return searches >= self.admit_searches
+
+    def _load(self, user_id: str, version: str) -> Optional[HotEntry]:
+        rows = list(
+            Memory.objects.filter(SEARCHABLE, user_id=user_id, embedding_pending=False, embedding_model=active_model())
+            .select_related('user')
+            .order_by('id')[:self.user_max_rows + 1]
+        )
+        if len(rows) > self.user_max_rows:
+            self._too_large.set(user_id, True)
+            return None
+
+        dims = Memory._meta.get_field('embeddings').dimensions
+        vectors = np.empty((len(rows), dims), dtype=np.float32)
+        for i, memory in enumerate(rows):
+            vectors[i] = memory.embeddings
+            # Deferred from now on, the matrix holds the vector
+            del memory.embeddings
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        entry = HotEntry(
+            version=version,
+            model=active_model(),
+            loaded_at=time.monotonic(),
+            vectors=vectors / norms,
+            memories=rows,
+            channel_ids=np.array([m.channel_id for m in rows], dtype=object),
+            server_ids=np.array([m.server_id for m in rows], dtype=object),
+        )
+        self._put(user_id, entry)
+        return entry
+
+    def search(self, query_embedding, user_id, k: int, channel_id: Optional[str] = None,
+               server_id: Optional[str] = None) -> Optional[List[Memory]]:
+        """
+        Exact top ``k`` of a hot user's searchable memories, with their
+        cosine ``distance``, or None when the user is not cached.
+        """
+        user_id = str(user_id)
+        version = current_version(user_id)
+        if version is None:
+            # Ranked by the database meanwhile
+            return None
+        entry = self._get(user_id, version)
+        if entry is None:
+            if not self._admit(user_id):
+                return None
+            entry = self._load(user_id, version)
+            if entry is None:
+                return None
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        distances = 1 - entry.vectors @ (query / norm if norm else query)
+
+        candidates = np.arange(len(entry))
+        if channel_id:
+            candidates = candidates[entry.channel_ids[candidates] == channel_id]
+        if server_id:
+            candidates = candidates[entry.server_ids[candidates] == server_id]
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(distances[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(distances[candidates], kind='stable')]
+
+        memories = []
+        for i in candidates:
+            # Copies, so callers never share or mutate the cached instances
+            memory = copy.copy(entry.memories[i])
+            memory.distance = float(distances[i])
+            memories.append(memory)
+        return memories
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._rows = 0
+
+_hot_cache: Optional[HotUserCache] = None
+_hot_cache_lock = threading.Lock()
+
+def get_hot_cache() -> HotUserCache:
+    """Return the process-wide hot user cache, created on first use."""
+    global _hot_cache
+    if _hot_cache is None:
+        with _hot_cache_lock:
+            if _hot_cache is None:
+                _hot_cache = HotUserCache(
+                    max_rows=settings.HOT_CACHE_MAX_ROWS,
+                    user_max_rows=settings.HOT_CACHE_USER_MAX_ROWS,
+                    admit_searches=settings.HOT_CACHE_ADMIT_SEARCHES,
+                    ttl=settings.HOT_CACHE_TTL,
+                )
+    return _hot_cache
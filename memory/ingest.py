@@ -0,0 +1,200 @@
+import logging
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from .models import Memory, UserProfile
+from .dedup import batch_duplicates, duplicates, merge
+from .embeddings import active_model, compute_embedding
+from .hot_cache import invalidate_users
+
+logger = logging.getLogger(__name__)
+
+def _enqueue_pending_embeddings() -> None:
+    from .tasks import embed_pending_memories
+
+    # Debounce: one task per window picks up every row written meanwhile
+    window = settings.MEMORY_PENDING_EMBED_DELAY
+    try:
+        if cache.add('memory:embed-pending:scheduled', 1, timeout=window):
+            embed_pending_memories.apply_async(countdown=window)
+    except Exception:
+        # The periodic sweep picks the rows up
+        logger.warning("Could not schedule pending embeddings", exc_info=True)
+
+def schedule_pending_embeddings() -> None:
+    """Schedule the embedding of pending memories once the transaction commits."""
+    transaction.on_commit(_enqueue_pending_embeddings)
+
+def _enqueue_contradiction_checks() -> None:
+    from .tasks import check_contradictions
+
+    # Debounce: one task per window checks every memory written meanwhile
+    window = settings.CONTRADICTION_DELAY
+    try:
+        if cache.add('memory:contradictions:scheduled', 1, timeout=window):
+            check_contradictions.apply_async(countdown=window)
+    except Exception:
+        # The periodic sweep picks the rows up
+        logger.warning("Could not schedule contradiction checks", exc_info=True)
+
+def schedule_contradiction_checks() -> None:
+    """Schedule the contradiction check of new memories once the transaction commits."""
+    if settings.CONTRADICTION_ENABLED:
+        transaction.on_commit(_enqueue_contradiction_checks)
+
+def summary_scheduled_key(user_id) -> str:
+    """Cache key set while a summarization run of the user is queued."""
+    return f"memory:summarize:scheduled:{user_id}"
+
+def _check_summarization(user_ids: Iterable[str]) -> None:
+    from .tasks import summarize_user_memories
+
+    threshold = settings.SUMMARY_TRIGGER_MEMORIES
+    delay = settings.SUMMARY_TRIGGER_DELAY
+    for user_id in user_ids:
+        try:
+            # Count a user's memories at most once per interval
+            if not cache.add(f"memory:summarize:check:{user_id}", 1, timeout=settings.SUMMARY_TRIGGER_CHECK_INTERVAL):
+                continue
+            unsummarized = Memory.objects.filter(user_id=user_id, summary_id__isnull=True)[:threshold + 1].count()
+            if unsummarized <= threshold:
+                continue
+            # Debounce: one run per delay picks up every memory written meanwhile
+            if cache.add(summary_scheduled_key(user_id), 1, timeout=delay):
+                summarize_user_memories.apply_async((str(user_id),), countdown=delay)
+        except Exception:
+            # The daily sweep picks the user up
+            logger.warning("Could not schedule summarization of user %s", user_id, exc_info=True)
+
+def schedule_summarization_checks(user_ids: Iterable[str]) -> None:
+    """
+    Once the transaction commits, schedule the summarization of the given
+    users whose unsummarized memories crossed SUMMARY_TRIGGER_MEMORIES.
+    """
+    user_ids = set(user_ids)
+    transaction.on_commit(lambda: _check_summarization(user_ids))
+
+def resolve_users(usernames: Iterable[str]) -> Dict[str, UserProfile]:
+    """Fetch the profiles for the given usernames, creating the missing ones."""
+    usernames = set(usernames)
+    users = {u.username: u for u in UserProfile.objects.filter(username__in=usernames)}
+    missing = usernames - users.keys()
+    if missing:
+        # Another request may create the same users concurrently, so read them back
+        UserProfile.objects.bulk_create([UserProfile(username=u) for u in missing], ignore_conflicts=True)
+        users.update((u.username, u) for u in UserProfile.objects.filter(username__in=missing))
+    return users
+
+def validate_item(item: Any) -> str:
+    """Return an error message for an invalid bulk item, or an empty string."""
+    if not isinstance(item, dict):
+        return 'item must be an object'
+    for key in ('username', 'content'):
+        if not isinstance(item.get(key), str) or not item[key]:
+            return f'{key} is required'
+    for key in ('channel_id', 'server_id'):
+        if item.get(key) is not None and not isinstance(item[key], str):
+            return f'{key} must be a string'
+    if not isinstance(item.get('metadata', {}), dict):
+        return 'metadata must be an object'
+    return ''
+
+def bulk_ingest(items: List[Any], pending: bool = False, dedup: Optional[bool] = None) -> List[Dict[str, Any]]:
+    """
+    Create memories for many users at once.
+    Users are resolved in a couple of queries, contents are embedded in
+    batches and rows are inserted with bulk_create in one transaction.
+    With ``pending``, rows are written without embeddings and a Celery
+    task embeds them later. Otherwise, with ``dedup`` (default
+    DEDUP_ENABLED), near-duplicates are merged (see memory.dedup).
+    Returns one result per item, with either its ``id`` or an ``error``,
+    and ``merged`` when it was merged into an existing memory.
+    """
+
+    results = [{'index': i} for i in range(len(items))]
+    valid = []
+    for i, item in enumerate(items):
+        error = validate_item(item)
+        if error:
+            results[i]['error'] = error
+        else:
+            valid.append((i, item))
+
+    if not valid:
+        return results
+
+    users = resolve_users(item['username'] for _, item in valid)
+    model = None if pending else active_model()
+    if pending:
+        embeddings = [None] * len(valid)
+    else:
+        embeddings = compute_embedding([item['content'] for _, item in valid], model)
+
+    # Per valid item: index of the earlier item or the existing memory it duplicates
+    earlier = [None] * len(valid)
+    existing = [None] * len(valid)
+    if not pending and (settings.DEDUP_ENABLED if dedup is None else dedup):
+        scopes = [(item['username'], item.get('channel_id'), item.get('server_id')) for _, item in valid]
+        earlier = batch_duplicates(scopes, embeddings)
+        # First occurrences looked up in one query per scope
+        lookups: Dict[tuple, List[int]] = {}
+        for k, scope in enumerate(scopes):
+            if earlier[k] is None:
+                lookups.setdefault(scope, []).append(k)
+        for (username, channel_id, server_id), indexes in lookups.items():
+            found = duplicates(
+                [embeddings[k] for k in indexes], user=users[username], channel_id=channel_id, server_id=server_id,
+            )
+            for k, memory in zip(indexes, found):
+                existing[k] = memory
+
+    memories = {
+        k: Memory(
+            user=users[item['username']],
+            channel_id=item.get('channel_id'),
+            server_id=item.get('server_id'),
+            content=item['content'],
+            embeddings=embeddings[k],
+            embedding_model=model,
+            embedding_pending=pending,
+            metadata=item.get('metadata', {}),
+        )
+        for k, (_, item) in enumerate(valid)
+        if earlier[k] is None and existing[k] is None
+    }
+    hits = Counter()
+    repeats = Counter()
+    for k in range(len(valid)):
+        target = existing[earlier[k]] if earlier[k] is not None else existing[k]
+        if target is not None:
+            hits[target.id] += 1
+        elif earlier[k] is not None:
+            repeats[earlier[k]] += 1
+    # Duplicates of a row inserted by this batch: counted as merge() would
+    now = timezone.now().isoformat()
+    for k, count in repeats.items():
+        metadata = memories[k].metadata
+        memories[k].metadata = {**metadata, 'hits': int(metadata.get('hits', 1)) + count, 'last_seen': now}
+
+    with transaction.atomic():
+        Memory.objects.bulk_create(memories.values(), batch_size=settings.MEMORY_BULK_INSERT_BATCH_SIZE)
+        merge(hits, {memory.user_id for memory in existing if memory is not None})
+        if pending:
+            schedule_pending_embeddings()
+        elif memories:
+            schedule_contradiction_checks()
+        schedule_summarization_checks(memory.user_id for memory in memories.values())
+        invalidate_users(memory.user_id for memory in memories.values())
+
+    for k, (i, _) in enumerate(valid):
+        first = k if earlier[k] is None else earlier[k]
+        if first in memories:
+            results[i]['id'] = str(memories[first].id)
+        else:
+            results[i]['id'] = str(existing[first].id)
+        if k != first or first not in memories:
+            results[i]['merged'] = True
+    return results
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from memory.archive import archive_summarized
+
+class Command(BaseCommand):
+    help = "Move the summarized memories older than ARCHIVE_AFTER_DAYS to the archive table."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--after-days', type=int, help="Archive memories older than this (default: ARCHIVE_AFTER_DAYS)")
+        parser.add_argument('--batch-size', type=int, help="Memories moved per transaction (default: ARCHIVE_BATCH_SIZE)")
+
+    def handle(self, *args, **options):
+        total = archive_summarized(options['batch_size'], options['after_days'])
+        self.stdout.write(self.style.SUCCESS(f"Archived {total} summarized memories"))
@@ -0,0 +1,131 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from memory import benchmark, quantization
+from memory.models import DIMS, HNSW_M, HNSW_EF_CONSTRUCTION
+from memory.ollama import OllamaClient
+from memory.stub_ollama import StubOllamaServer
+
+class Command(BaseCommand):
+    help = "Generate synthetic corpora and benchmark search latency, throughput and recall. Use a dedicated database."
+
+    def add_arguments(self, parser):
+        actions = parser.add_subparsers(dest='action', required=True)
+
+        generate = actions.add_parser('generate', help="Insert a synthetic corpus")
+        generate.add_argument('--scale', choices=sorted(benchmark.SCALES), default='10k')
+        generate.add_argument('--size', type=int, help="Number of memories, overrides --scale")
+        generate.add_argument('--seed', type=int, default=0)
+        generate.add_argument('--rebuild-index', action='store_true',
+                              help="Drop the searchable HNSW indexes during the load and build them once at the end")
+
+        run = actions.add_parser('run', help="Measure search_memories on the generated corpus")
+        run.add_argument('--scale', choices=sorted(benchmark.SCALES), default='10k')
+        run.add_argument('--size', type=int, help="Corpus size the queries are drawn for, overrides --scale")
+        run.add_argument('--seed', type=int, default=0)
+        run.add_argument('--queries', type=int, default=300)
+        run.add_argument('--k', type=int, default=10)
+        run.add_argument('--concurrency', type=int, nargs='+', default=[1, 8])
+        run.add_argument('--ef-search', type=int, nargs='+', default=[settings.SEARCH_EF_SEARCH])
+        run.add_argument('--m', type=int, nargs='+', help="HNSW m values, needs --rebuild-index")
+        run.add_argument('--ef-construction', type=int, nargs='+', help="HNSW ef_construction values, needs --rebuild-index")
+        run.add_argument('--rebuild-index', action='store_true',
+                         help="Rebuild the searched HNSW index (the halfvec one with --quantized) for every "
+                              "(m, ef_construction) pair, then restore the one of the model")
+        run.add_argument('--quantized', action='store_true',
+                         help="Search with SEARCH_QUANTIZED, needs quantize_memories enable")
+        run.add_argument('--json', help="Write the results to this file")
+
+        actions.add_parser('clean', help="Delete the benchmark users and memories")
+
+        for action in (generate, run):
+            action.add_argument('--ollama-url', help="Embed with this server instead of a local stub")
+
+    def handle(self, *args, **options):
+        action = options['action']
+        if action == 'clean':
+            deleted = benchmark.clean()
+            self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} benchmark memories"))
+            return
+
+        if options['ollama_url']:
+            url = options['ollama_url']
+        else:
+            stub = StubOllamaServer(dims=DIMS, seed=options['seed']).start()
+            url = stub.url
+            self.stdout.write(f"Stub Ollama listening on {url}")
+
+        size = options['size'] or benchmark.SCALES[options['scale']]
+        corpus = benchmark.Corpus(size, options['seed'])
+        # Query embeddings of the view go through the shared clients, created on first use
+        with override_settings(OLLAMA_URL=url):
+            if action == 'generate':
+                self.generate(corpus, url, options)
+            else:
+                self.run(corpus, options)
+
+    @staticmethod
+    def index_name(quantized):
+        return quantization.HALF_INDEX if quantized else benchmark.LIVE_INDEX
+
+    def generate(self, corpus, url, options):
+        client = OllamaClient(url, max_retries=settings.OLLAMA_MAX_RETRIES, backoff=settings.OLLAMA_RETRY_BACKOFF,
+                              pool_size=1, max_concurrency=1)
+        # The halfvec index is only kept up once quantization is enabled
+        indexes = [False, True] if quantization.index_state(quantization.HALF_INDEX) is not None else [False]
+        if options['rebuild_index']:
+            for quantized in indexes:
+                benchmark.drop_search_index(quantized)
+        written = benchmark.generate(corpus, client, log=self.stdout.write)
+        if options['rebuild_index']:
+            for quantized in indexes:
+                seconds = benchmark.build_search_index(HNSW_M, HNSW_EF_CONSTRUCTION, quantized)
+                self.stdout.write(f"Built {self.index_name(quantized)} in {seconds:.1f}s")
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {written} memories for {corpus.users} users on {corpus.servers} servers"
+        ))
+
+    def run(self, corpus, options):
+        if (options['m'] or options['ef_construction']) and not options['rebuild_index']:
+            raise CommandError("--m and --ef-construction rebuild the searchable index, pass --rebuild-index")
+        quantized = options['quantized'] or settings.SEARCH_QUANTIZED
+        if quantized and not quantization.is_enabled():
+            raise CommandError("Quantized search reads embeddings_half, run quantize_memories enable first")
+
+        if options['rebuild_index']:
+            builds = [(m, efc) for m in options['m'] or [HNSW_M]
+                      for efc in options['ef_construction'] or [HNSW_EF_CONSTRUCTION]]
+        else:
+            builds = [(None, None)]
+
+        payloads = corpus.queries(options['queries'])
+        truth = benchmark.exact_ids(payloads, options['k'])
+
+        results = []
+        self.stdout.write(benchmark.HEADER)
+        try:
+            for m, ef_construction in builds:
+                if m is not None:
+                    seconds = benchmark.build_search_index(m, ef_construction, quantized)
+                    self.stdout.write(f"Built {self.index_name(quantized)} with m={m}, "
+                                      f"ef_construction={ef_construction} in {seconds:.1f}s")
+                for ef_search in options['ef_search']:
+                    for concurrency in options['concurrency']:
+                        with override_settings(SEARCH_EF_SEARCH=ef_search, SEARCH_EF_SEARCH_FILTERED=ef_search,
+                                               SEARCH_QUANTIZED=quantized):
+                            runs = benchmark.measure(
+                                payloads, truth, options['k'], concurrency,
+                                m=m, ef_construction=ef_construction, ef_search=ef_search,
+                            )
+                        for result in runs:
+                            self.stdout.write(result.row())
+                        results.extend(runs)
+        finally:
+            if options['rebuild_index']:
+                self.stdout.write("Restoring the model's index")
+                benchmark.build_search_index(HNSW_M, HNSW_EF_CONSTRUCTION, quantized)
+
+        if options['json']:
+            benchmark.save(results, options['json'])
+            self.stdout.write(f"Results written to {options['json']}")
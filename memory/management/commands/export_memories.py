@@ -0,0 +1,36 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from memory.models import UserProfile
+from memory.transfer import export_lines, export_queryset
+
+class Command(BaseCommand):
+    help = "Export the memories of a user and/or server (default: all) as NDJSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--username')
+        parser.add_argument('--server-id')
+        parser.add_argument('--no-embeddings', action='store_true',
+                            help="Leave the embeddings out, the import embeds the memories again")
+        parser.add_argument('--output', '-o', help="File to write (default: stdout)")
+
+    def handle(self, *args, **options):
+        user = None
+        if options['username']:
+            user = UserProfile.objects.filter(username=options['username']).first()
+            if user is None:
+                raise CommandError(f"Unknown user {options['username']}")
+
+        embeddings = not options['no_embeddings']
+        memories = export_queryset(user, options['server_id'], embeddings)
+        archived = export_queryset(user, options['server_id'], embeddings, archived=True)
+        out = open(options['output'], 'w', encoding='utf-8') if options['output'] else sys.stdout
+        count = -1  # Not counting the header
+        try:
+            for count, line in enumerate(export_lines(memories, embeddings, archived)):
+                out.write(line)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        self.stderr.write(self.style.SUCCESS(f"Exported {count} memories"))
@@ -0,0 +1,29 @@
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from memory.transfer import import_memories
+
+class Command(BaseCommand):
+    help = "Import an NDJSON export of memories, skipping the ids already present."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Export file, - for stdin")
+        parser.add_argument('--batch-size', type=int, default=settings.IMPORT_BATCH_SIZE,
+                            help="Rows COPied into the staging table at once")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        f = sys.stdin.buffer if path == '-' else open(path, 'rb')
+        try:
+            result = import_memories(f, options['batch_size'])
+        except ValueError as e:
+            raise CommandError(f"Nothing imported: {e}")
+        finally:
+            if f is not sys.stdin.buffer:
+                f.close()
+        self.stdout.write(self.style.SUCCESS(
+            f"Read {result.read} memories: {result.inserted} inserted ({result.pending} to embed), "
+            f"{result.skipped} already present"
+        ))
@@ -0,0 +1,73 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from memory import partitioning
+
+class Command(BaseCommand):
+    help = "Move the memory table online to a table hash partitioned by user, see memory.partitioning."
+
+    def add_arguments(self, parser):
+        actions = parser.add_subparsers(dest='action', required=True)
+        prepare = actions.add_parser('prepare', help="Drop the foreign keys to memories, create the partitioned "
+                                                     "table and the trigger syncing it")
+        prepare.add_argument('--partitions', type=int, default=settings.MEMORY_PARTITIONS)
+        copy = actions.add_parser('copy', help="Copy the existing rows, or resume an interrupted copy")
+        copy.add_argument('--batch-size', type=int, default=settings.MEMORY_PARTITION_COPY_BATCH_SIZE)
+        index = actions.add_parser('index', help="Build the indexes on every partition, concurrently")
+        index.add_argument('--jobs', type=int, default=1, help="Partitions indexed in parallel")
+        swap = actions.add_parser('swap', help="Swap the partitioned table in, keeping the former one")
+        swap.add_argument('--skip-count', action='store_true', help="Don't check that every row was copied")
+        actions.add_parser('drop-old', help="Drop the former table after a swap")
+        actions.add_parser('abort', help="Drop the partitioned table being prepared and its trigger, "
+                                         "restore the foreign keys")
+        actions.add_parser('status', help="Show the progress of the partitioning")
+
+    def handle(self, *args, **options):
+        action = options['action']
+        try:
+            if action == 'prepare':
+                names, keys = partitioning.prepare(options['partitions'])
+                if keys:
+                    self.stdout.write(f"Dropped the foreign keys to memories: {', '.join(keys)}")
+                self.stdout.write(self.style.SUCCESS(f"Created {len(names)} partitions, writes are now mirrored"))
+            elif action == 'copy':
+                total = partitioning.copy(
+                    options['batch_size'], lambda count, last: self.stdout.write(f"{count} rows copied, up to {last}")
+                )
+                self.stdout.write(self.style.SUCCESS(f"Copy done, {total} rows copied"))
+            elif action == 'index':
+                count = partitioning.build_indexes(
+                    options['jobs'], lambda name: self.stdout.write(f"Building {name}")
+                )
+                self.stdout.write(self.style.SUCCESS(f"{count} index(es) built"))
+            elif action == 'swap':
+                partitioning.swap(check_counts=not options['skip_count'])
+                self.stdout.write(self.style.SUCCESS(
+                    f"{partitioning.TABLE} is partitioned, run sync_tenant_indexes and drop-old"
+                ))
+            elif action == 'drop-old':
+                partitioning.drop_old()
+                self.stdout.write(self.style.SUCCESS(f"Dropped {partitioning.OLD_TABLE}"))
+            elif action == 'abort':
+                invalid = partitioning.abort()
+                if invalid:
+                    self.stdout.write(self.style.WARNING(
+                        f"Links left dangling meanwhile, not validated: {', '.join(invalid)}"
+                    ))
+                self.stdout.write(self.style.SUCCESS("Aborted, foreign keys restored"))
+            elif action == 'status':
+                status = partitioning.status()
+                if status['partitioned']:
+                    self.stdout.write(f"{partitioning.TABLE} is partitioned in {status['partitions']} partitions")
+                elif status['preparing']:
+                    built, total = status['indexes']
+                    self.stdout.write(f"Partitioning in {status['partitions']} partitions: "
+                                      f"about {status['copied']:.1%} copied, {built}/{total} indexes built")
+                    if status['invalid_indexes']:
+                        self.stdout.write(f"Indexes being built: {', '.join(status['invalid_indexes'])}")
+                else:
+                    self.stdout.write(f"{partitioning.TABLE} isn't partitioned")
+                if status['old_table']:
+                    self.stdout.write(f"{partitioning.OLD_TABLE} can be dropped")
+        except partitioning.PartitioningError as e:
+            raise CommandError(str(e))
@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from memory import quantization
+
+class Command(BaseCommand):
+    help = "Enable the half-precision embeddings and index of quantized search online, see memory.quantization."
+
+    def add_arguments(self, parser):
+        actions = parser.add_subparsers(dest='action', required=True)
+        enable = actions.add_parser('enable', help="Keep embeddings_half in sync, fill it and build its index, "
+                                                   "or resume an interrupted run")
+        enable.add_argument('--batch-size', type=int, default=settings.SEARCH_QUANTIZE_BATCH_SIZE)
+        enable.add_argument('--jobs', type=int, default=1, help="Partitions indexed in parallel")
+        actions.add_parser('drop-full', help="Drop the full-precision HNSW index, with SEARCH_QUANTIZED on")
+        restore = actions.add_parser('restore-full', help="Rebuild the full-precision HNSW index")
+        restore.add_argument('--jobs', type=int, default=1, help="Partitions indexed in parallel")
+        actions.add_parser('disable', help="Drop the halfvec index and stop filling embeddings_half")
+        actions.add_parser('status', help="Show which indexes exist")
+
+    def handle(self, *args, **options):
+        action = options['action']
+        try:
+            if action == 'enable':
+                filled, built = quantization.enable(
+                    options['batch_size'], options['jobs'],
+                    lambda count, last: self.stdout.write(f"{count} rows filled, up to {last}"),
+                )
+                index = f"built {quantization.HALF_INDEX}" if built else f"{quantization.HALF_INDEX} already built"
+                self.stdout.write(self.style.SUCCESS(f"Quantization enabled, {filled} rows filled, {index}"))
+            elif action == 'drop-full':
+                quantization.drop_full()
+                self.stdout.write(self.style.SUCCESS(f"Dropped {quantization.FULL_INDEX}"))
+            elif action == 'restore-full':
+                built = quantization.restore_full(options['jobs'])
+                self.stdout.write(self.style.SUCCESS(
+                    f"Built {quantization.FULL_INDEX}" if built else f"{quantization.FULL_INDEX} already built"
+                ))
+            elif action == 'disable':
+                quantization.disable()
+                self.stdout.write(self.style.SUCCESS("Quantization disabled"))
+            elif action == 'status':
+                status = quantization.status()
+                self.stdout.write(f"embeddings_half kept in sync: {'yes' if status['enabled'] else 'no'}")
+                for name, state in ((quantization.HALF_INDEX, status['half_index']),
+                                    (quantization.FULL_INDEX, status['full_index'])):
+                    self.stdout.write(f"{name}: {'missing' if state is None else 'valid' if state else 'being built'}")
+        except quantization.QuantizationError as e:
+            raise CommandError(str(e))
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from memory import reembed
+
+class Command(BaseCommand):
+    help = "Re-embed every memory with a new embedding model, online, then cut over to it."
+
+    def add_arguments(self, parser):
+        actions = parser.add_subparsers(dest='action', required=True)
+        start = actions.add_parser('start', help="Dispatch the Celery tasks re-embedding into the shadow column, "
+                                                 "or resume an interrupted run")
+        start.add_argument('model', help="Ollama model tag")
+        actions.add_parser('status', help="Show the progress of the re-embedding")
+        actions.add_parser('cutover', help="Embed the remaining memories and switch to the new model")
+        actions.add_parser('abort', help="Stop the re-embedding and clear the shadow column")
+        actions.add_parser('stragglers', help="Set pending the memories still embedded with a retired model, "
+                                                            "re-embed the archived ones")
+
+    def handle(self, *args, **options):
+        action = options['action']
+        try:
+            if action == 'start':
+                job = reembed.start(options['model'])
+                self.stdout.write(self.style.SUCCESS(f"Re-embedding with {job.name}, tasks dispatched"))
+            elif action == 'status':
+                status = reembed.status()
+                self.stdout.write(f"Active model: {status['active']}")
+                if status['target']:
+                    done = status['done'] / status['embedded'] if status['embedded'] else 1
+                    self.stdout.write(f"Re-embedding with {status['target']}: {status['done']}/{status['embedded']} "
+                                      f"({done:.1%}), {status['remaining']} remaining")
+                else:
+                    self.stdout.write("No re-embedding in progress")
+            elif action == 'cutover':
+                switched, stale = reembed.cutover()
+                self.stdout.write(self.style.SUCCESS(
+                    f"Switched {switched} memories, {stale} written meanwhile set pending"
+                ))
+            elif action == 'abort':
+                cleared = reembed.abort()
+                self.stdout.write(self.style.SUCCESS(f"Aborted, {cleared} shadow vectors cleared"))
+            elif action == 'stragglers':
+                count = reembed.set_stragglers_pending()
+                archived = reembed.embed_archived_stragglers()
+                self.stdout.write(self.style.SUCCESS(f"Set {count} memories pending, re-embedded {archived} archived ones"))
+        except reembed.ReembedError as e:
+            raise CommandError(str(e))
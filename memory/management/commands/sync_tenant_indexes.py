@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from memory.vector_indexes import TENANT_FIELDS, create_index, drop_index, plan
+
+class Command(BaseCommand):
+    help = "Create and drop per-server/per-user partial HNSW indexes as tenants grow and shrink."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', choices=sorted(TENANT_FIELDS), action='append',
+                            help="Tenant kinds to manage (default: server and user)")
+        parser.add_argument('--min-rows', type=int, default=settings.TENANT_INDEX_MIN_ROWS,
+                            help="Searchable rows from which a tenant gets its own index")
+        parser.add_argument('--keep-rows', type=int, default=settings.TENANT_INDEX_KEEP_ROWS,
+                            help="Searchable rows under which an existing tenant index is dropped")
+        parser.add_argument('--dry-run', action='store_true', help="Only print the planned changes")
+
+    def handle(self, *args, **options):
+        kinds = options['kind'] or sorted(TENANT_FIELDS)
+        to_create, to_drop = plan(kinds, options['min_rows'], min(options['keep_rows'], options['min_rows']))
+
+        for kind, value, index in to_create:
+            self.stdout.write(f"Creating {index.name} for {kind} {value}")
+            if not options['dry_run']:
+                create_index(index, user_id=value if kind == 'user' else None)
+        for name in to_drop:
+            self.stdout.write(f"Dropping {name}")
+            if not options['dry_run']:
+                drop_index(name)
+
+        self.stdout.write(self.style.SUCCESS(f"{len(to_create)} index(es) created, {len(to_drop)} dropped"))
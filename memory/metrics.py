@@ -0,0 +1,337 @@
+"""
+Request, task and pipeline instrumentation.
+
+Each request or Celery task gets a ``Timings`` collector in a context
+variable. Database queries (through a connection execute wrapper),
+embedding calls, Ollama calls and searches add their time to it, and
+requests report it in a ``Server-Timing`` header.
+
+Counters and histograms are buffered per process and periodically added
+to hashes in Redis (``METRICS_REDIS_URL``), so ``/metrics`` renders the
+aggregate of every web and worker process in the Prometheus text format,
+or only the totals of the serving process while Redis is unavailable. It
+only answers clients of METRICS_ALLOWED_NETWORKS.
+"""
+import atexit
+import ipaddress
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import redis
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.utils.decorators import sync_and_async_middleware
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'memoire:metrics:'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000, 10000)
+
+class Timings:
+    """Time spent per component during one request or task."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.durations: Dict[str, float] = defaultdict(float)
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.descriptions: Dict[str, str] = {}
+
+    def add(self, name: str, seconds: float, description: Optional[str] = None) -> None:
+        self.durations[name] += seconds
+        self.counts[name] += 1
+        if description:
+            self.descriptions[name] = description
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def server_timing(self) -> str:
+        """Value of the Server-Timing header, durations in milliseconds."""
+        entries = []
+        for name, seconds in self.durations.items():
+            description = self.descriptions.get(name) or f"{self.counts[name]} {'queries' if name == 'db' else 'calls'}"
+            entries.append(f'{name};dur={seconds * 1000:.1f};desc="{description}"')
+        entries.append(f'total;dur={self.elapsed() * 1000:.1f}')
+        return ', '.join(entries)
+
+_current: ContextVar[Optional[Timings]] = ContextVar('memoire_timings', default=None)
+
+def current_timings() -> Optional[Timings]:
+    """Collector of the running request or task, if any."""
+    return _current.get()
+
+def record(name: str, seconds: float, histogram: Optional['Histogram'] = None,
+           description: Optional[str] = None, **labels) -> None:
+    """Add a duration to the current collector and observe it in ``histogram``."""
+    timings = _current.get()
+    if timings is not None:
+        timings.add(name, seconds, description)
+    if histogram is not None:
+        histogram.observe(seconds, **labels)
+
+@contextmanager
+def timer(name: str, histogram: Optional['Histogram'] = None, **labels):
+    """Time the block with ``record``."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start, histogram, **labels)
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(labels: Dict[str, object]) -> str:
+    return ','.join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()))
+
+def _braces(labels: str) -> str:
+    return f'{{{labels}}}' if labels else ''
+
+class Registry:
+    """Process-wide buffer of metric increments, flushed to Redis."""
+
+    def __init__(self):
+        self.metrics: List['Metric'] = []
+        self._pending: Dict[Tuple[str, str], float] = defaultdict(float)
+        self._totals: Dict[Tuple[str, str], float] = defaultdict(float)  # Of this process, rendered without Redis
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._client = None
+
+    @property
+    def client(self) -> redis.Redis:
+        if self._client is None:
+            self._client = redis.Redis.from_url(
+                settings.METRICS_REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5
+            )
+        return self._client
+
+    def increment(self, name: str, field: str, value: float) -> None:
+        if not settings.METRICS_ENABLED:
+            return
+        with self._lock:
+            self._pending[(name, field)] += value
+            self._totals[(name, field)] += value
+        # Requests and tasks flush when they end
+        if _current.get() is None:
+            self.flush_if_due()
+
+    def due(self) -> bool:
+        return time.monotonic() - self._last_flush >= settings.METRICS_FLUSH_INTERVAL
+
+    def flush_if_due(self) -> None:
+        if self.due():
+            self.flush()
+
+    def flush(self) -> None:
+        """Add the buffered increments to the Redis hashes."""
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(float)
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for (name, field), value in pending.items():
+                pipe.hincrbyfloat(KEY_PREFIX + name, field, value)
+            pipe.execute()
+        except redis.RedisError as e:
+            # Metrics are best effort, never fail the request for them
+            logger.warning("Could not flush %d metric series: %s", len(pending), e)
+
+    def _aggregated(self) -> List[Dict[str, float]]:
+        pipe = self.client.pipeline(transaction=False)
+        for metric in self.metrics:
+            pipe.hgetall(KEY_PREFIX + metric.name)
+        return [{k.decode(): float(v) for k, v in values.items()} for values in pipe.execute()]
+
+    def _local(self) -> List[Dict[str, float]]:
+        with self._lock:
+            totals = list(self._totals.items())
+        values = {metric.name: {} for metric in self.metrics}
+        for (name, field), value in totals:
+            values[name][field] = value
+        return [values[metric.name] for metric in self.metrics]
+
+    def render(self) -> str:
+        """
+        All metrics in the Prometheus text exposition format, of every
+        process, or of this one when Redis can't be reached.
+        """
+        self.flush()
+        lines = []
+        try:
+            all_values = self._aggregated()
+        except redis.RedisError as e:
+            logger.warning("Could not read the aggregated metrics, rendering this process's: %s", e)
+            all_values = self._local()
+            lines.append('# Metrics store unavailable: totals of this process only')
+        for metric, values in zip(self.metrics, all_values):
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples(values))
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+class Metric(ABC):
+    kind = ''
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        REGISTRY.metrics.append(self)
+
+    @abstractmethod
+    def samples(self, values: Dict[str, float]) -> List[str]:
+        """Exposition lines of the metric, from its fields as stored."""
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, value: float = 1, **labels) -> None:
+        REGISTRY.increment(self.name, _labels(labels), value)
+
+    def samples(self, values: Dict[str, float]) -> List[str]:
+        return [f'{self.name}{_braces(labels)} {value}' for labels, value in sorted(values.items())]
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        series = _labels(labels)
+        # Buckets are stored cumulative, as exposed
+        for bound in self.buckets:
+            if value <= bound:
+                REGISTRY.increment(self.name, f'{series}|{bound}', 1)
+        REGISTRY.increment(self.name, f'{series}|+Inf', 1)
+        REGISTRY.increment(self.name, f'{series}|sum', value)
+
+    def samples(self, values: Dict[str, float]) -> List[str]:
+        series = defaultdict(dict)
+        for field, value in values.items():
+            labels, suffix = field.rsplit('|', 1)
+            series[labels][suffix] = value
+
+        lines = []
+        for labels, fields in sorted(series.items()):
+            prefix = f'{labels},' if labels else ''
+            for bound in self.buckets + ('+Inf',):
+                count = fields.get(str(bound), 0)
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_sum{_braces(labels)} {fields.get("sum", 0)}')
+            lines.append(f'{self.name}_count{_braces(labels)} {fields.get("+Inf", 0)}')
+        return lines
+
+REQUEST_SECONDS = Histogram('memoire_request_duration_seconds', 'HTTP request duration.')
+REQUEST_DB_QUERIES = Histogram('memoire_request_db_queries', 'Database queries per HTTP request.', SIZE_BUCKETS)
+REQUEST_DB_SECONDS = Histogram('memoire_request_db_seconds', 'Database time per HTTP request.')
+TASK_SECONDS = Histogram('memoire_task_duration_seconds', 'Celery task duration.')
+TASK_DB_QUERIES = Histogram('memoire_task_db_queries', 'Database queries per Celery task.', SIZE_BUCKETS)
+EMBEDDING_SECONDS = Histogram('memoire_embedding_duration_seconds', 'Time to embed the texts missing from the cache.')
+EMBEDDING_TEXTS = Histogram('memoire_embedding_texts', 'Texts per embedding call, before the cache.', SIZE_BUCKETS)
+EMBEDDING_BATCH_SIZE = Histogram('memoire_embedding_batch_size', 'Texts per batched /api/embed call.', SIZE_BUCKETS)
+OLLAMA_SECONDS = Histogram('memoire_ollama_request_duration_seconds', 'Ollama API call duration.')
+SEARCH_SECONDS = Histogram('memoire_search_duration_seconds', 'Vector search duration.')
+SEARCH_SCOPE_ROWS = Histogram('memoire_search_scope_rows', 'Searchable rows in the scope of a filtered search (capped).', SIZE_BUCKETS)
+SEARCHES = Counter('memoire_searches_total', 'Vector searches per strategy.')
+MEMORIES_MERGED = Counter('memoire_memories_merged_total', 'New memories merged into a near-duplicate instead of inserted.')
+CONTRADICTION_PAIRS = Counter('memoire_contradiction_pairs_total', 'Memory pairs judged by the LLM per verdict.')
+MEMORIES_ARCHIVED = Counter('memoire_memories_archived_total', 'Summarized memories moved to the archive table.')
+
+def scrape_allowed(address: Optional[str]) -> bool:
+    """Whether a client may read ``/metrics``: its address is in METRICS_ALLOWED_NETWORKS."""
+    try:
+        address = ipaddress.ip_address(address or '')
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network) for network in settings.METRICS_ALLOWED_NETWORKS)
+
+def _record_request(request, response, timings: Timings) -> None:
+    match = getattr(request, 'resolver_match', None)
+    view = match.url_name if match and match.url_name else 'unmatched'
+    labels = {'view': view, 'method': request.method, 'status': response.status_code}
+    REQUEST_SECONDS.observe(timings.elapsed(), **labels)
+    REQUEST_DB_QUERIES.observe(timings.counts.get('db', 0), view=view)
+    REQUEST_DB_SECONDS.observe(timings.durations.get('db', 0), view=view)
+    response['Server-Timing'] = timings.server_timing()
+
+@sync_and_async_middleware
+def MetricsMiddleware(get_response):
+    """Time each request, add a Server-Timing header and record request metrics."""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            timings = Timings()
+            token = _current.set(timings)
+            try:
+                response = await get_response(request)
+            finally:
+                _current.reset(token)
+            _record_request(request, response, timings)
+            if REGISTRY.due():
+                await sync_to_async(REGISTRY.flush, thread_sensitive=False)()
+            return response
+    else:
+        def middleware(request):
+            timings = Timings()
+            token = _current.set(timings)
+            try:
+                response = get_response(request)
+            finally:
+                _current.reset(token)
+            _record_request(request, response, timings)
+            REGISTRY.flush_if_due()
+            return response
+    return middleware
+
+def _db_wrapper(execute, sql, params, many, context):
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.add('db', time.perf_counter() - start)
+
+def _install_db_wrapper(sender, connection, **kwargs):
+    # Sent for every new connection of the same wrapper, install only once
+    if _db_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_db_wrapper)
+
+_tasks: Dict[str, Tuple[Timings, object]] = {}
+
+def _task_prerun(task_id=None, **kwargs):
+    timings = Timings()
+    _tasks[task_id] = (timings, _current.set(timings))
+
+def _task_postrun(task_id=None, task=None, state=None, **kwargs):
+    started = _tasks.pop(task_id, None)
+    if started is None:
+        return
+    timings, token = started
+    _current.reset(token)
+    TASK_SECONDS.observe(timings.elapsed(), task=task.name, state=state or 'UNKNOWN')
+    TASK_DB_QUERIES.observe(timings.counts.get('db', 0), task=task.name)
+    REGISTRY.flush()
+
+def install() -> None:
+    """Instrument database connections and Celery tasks."""
+    from celery.signals import task_postrun, task_prerun
+
+    atexit.register(REGISTRY.flush)
+    connection_created.connect(_install_db_wrapper, dispatch_uid='memoire_metrics_db')
+    task_prerun.connect(_task_prerun, dispatch_uid='memoire_metrics_task_prerun')
+    task_postrun.connect(_task_postrun, dispatch_uid='memoire_metrics_task_postrun')
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.7 on 2026-10-18 19:59
+
+import pgvector.django.vector
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memory', '0006_rename_summary_id_memory_summary_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='memory',
+            name='embedding_pending',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='memory',
+            name='embeddings',
+            field=pgvector.django.vector.VectorField(dimensions=768, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='memory',
+            index=models.Index(condition=models.Q(('embedding_pending', True)), fields=['created_at'], name='memory_pending_idx'),
+        ),
+    ]
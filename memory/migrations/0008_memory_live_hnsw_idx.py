@@ -0,0 +1,25 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:03
+
+import pgvector.django.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently, RemoveIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Build the partial index next to the old one without blocking writes
+    atomic = False
+
+    dependencies = [
+        ('memory', '0007_memory_embedding_pending'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='memory',
+            index=pgvector.django.indexes.HnswIndex(condition=models.Q(('summary_id__isnull', True), models.Q(('metadata__has_key', 'type'), ('metadata__type', 'summary')), _connector='OR'), ef_construction=64, fields=['embeddings'], m=16, name='memory_live_hnsw_idx', opclasses=['vector_cosine_ops']),
+        ),
+        RemoveIndexConcurrently(
+            model_name='memory',
+            name='memory_embeddings_hnsw_idx',
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:07
+
+import django.db.models.deletion
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Index the memory table without blocking writes
+    atomic = False
+
+    dependencies = [
+        ('memory', '0008_memory_live_hnsw_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SummarizationCheckpoint',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summarization_checkpoint', serialize=False, to='memory.userprofile')),
+                ('cutoff', models.DateTimeField()),
+                ('last_created_at', models.DateTimeField(null=True)),
+                ('last_id', models.UUIDField(null=True)),
+                ('summaries', models.JSONField(default=list)),
+                ('memory_ids', models.JSONField(default=list)),
+                ('chunks', models.IntegerField(default=0)),
+                ('levels', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        AddIndexConcurrently(
+            model_name='memory',
+            index=models.Index(condition=models.Q(('summary_id__isnull', True)), fields=['user', 'created_at', 'id'], name='memory_unsummarized_idx'),
+        ),
+    ]
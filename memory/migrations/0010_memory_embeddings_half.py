@@ -0,0 +1,35 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:15
+
+import pgvector.django.halfvec
+from django.db import migrations
+
+
+def check_pgvector(apps, schema_editor):
+    """The halfvec type of this and later columns (the archive's too) needs pgvector >= 0.7."""
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+        row = cursor.fetchone()
+    version = tuple(int(part) for part in row[0].split('.')[:2]) if row else (0, 0)
+    if version < (0, 7):
+        raise RuntimeError(
+            f"pgvector >= 0.7 is required, {row[0] if row else 'none'} is installed: "
+            f"install a newer pgvector on the server, then run ALTER EXTENSION vector UPDATE"
+        )
+
+
+class Migration(migrations.Migration):
+    # Nullable without a default: added without rewriting the table.
+    # Filled and indexed when quantization is enabled, see memory.quantization
+
+    dependencies = [
+        ('memory', '0009_summarizationcheckpoint'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_pgvector, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='memory',
+            name='embeddings_half',
+            field=pgvector.django.halfvec.HalfVectorField(dimensions=768, null=True),
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:16
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models, transaction
+
+BATCH_SIZE = 5000
+
+# BEFORE: the row is written once, with its tsvector. Cloned to every partition
+CREATE_TRIGGER = """
+    CREATE FUNCTION memory_content_search() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        NEW.content_search := to_tsvector('simple'::regconfig, COALESCE(NEW.content, ''));
+        RETURN NEW;
+    END
+    $$;
+    CREATE TRIGGER memory_content_search BEFORE INSERT OR UPDATE OF content ON memory_memory
+    FOR EACH ROW EXECUTE FUNCTION memory_content_search();
+"""
+
+DROP_TRIGGER = """
+    DROP TRIGGER memory_content_search ON memory_memory;
+    DROP FUNCTION memory_content_search();
+"""
+
+
+def backfill(apps, schema_editor):
+    """Fill the existing rows in id order, one short transaction per batch. Rows written meanwhile are filled by the trigger."""
+    connection = schema_editor.connection
+    last = None
+    while True:
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            after = "AND id > %s" if last else ""
+            cursor.execute(f"""
+                WITH batch AS (
+                    SELECT id FROM memory_memory WHERE content_search IS NULL {after} ORDER BY id LIMIT %s
+                ), filled AS (
+                    UPDATE memory_memory m SET content_search = to_tsvector('simple'::regconfig, COALESCE(m.content, ''))
+                    FROM batch b WHERE m.id = b.id
+                )
+                SELECT id FROM batch ORDER BY id DESC LIMIT 1
+            """, ([last] if last else []) + [BATCH_SIZE])
+            row = cursor.fetchone()
+        if row is None:
+            return
+        last = row[0]
+
+
+class Migration(migrations.Migration):
+    # Nullable column, filled in batches, the index is built without blocking writes:
+    # the table is never rewritten nor locked for long
+    atomic = False
+
+    dependencies = [
+        ('memory', '0010_memory_embeddings_half'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='memory',
+            name='content_search',
+            field=django.contrib.postgres.search.SearchVectorField(null=True),
+        ),
+        migrations.RunSQL(CREATE_TRIGGER, DROP_TRIGGER),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+        AddIndexConcurrently(
+            model_name='memory',
+            index=django.contrib.postgres.indexes.GinIndex(condition=models.Q(('summary_id__isnull', True), models.Q(('metadata__has_key', 'type'), ('metadata__type', 'summary')), _connector='OR'), fields=['content_search'], name='memory_content_search_idx'),
+        ),
+    ]
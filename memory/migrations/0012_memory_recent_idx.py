@@ -0,0 +1,24 @@
+# Generated by Django 5.1.7 on 2026-10-18 21:02
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Built concurrently, without blocking writes
+    atomic = False
+
+    dependencies = [
+        ('memory', '0011_memory_content_search'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='memory',
+            index=models.Index(condition=models.Q(('summary_id__isnull', True), models.Q(('metadata__has_key', 'type'), ('metadata__type', 'summary')), _connector='OR'), fields=['created_at', 'id'], name='memory_recent_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='memory',
+            index=models.Index(condition=models.Q(('summary_id__isnull', True), models.Q(('metadata__has_key', 'type'), ('metadata__type', 'summary')), _connector='OR'), fields=['user', 'created_at', 'id'], name='memory_user_recent_idx'),
+        ),
+    ]
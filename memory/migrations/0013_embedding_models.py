@@ -0,0 +1,46 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:25
+
+import pgvector.django.vector
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memory', '0012_memory_recent_idx'),
+    ]
+
+    operations = [
+        # Existing vectors come from the former default model. A constant
+        # default is only stored in the catalog, the table isn't rewritten
+        migrations.AddField(
+            model_name='memory',
+            name='embedding_model',
+            field=models.CharField(default='nomic-embed-text', max_length=255, null=True),
+            preserve_default=False,
+        ),
+        migrations.RunSQL(
+            "UPDATE memory_memory SET embedding_model = NULL WHERE embedding_pending",
+            migrations.RunSQL.noop,
+        ),
+        migrations.AddField(
+            model_name='memory',
+            name='embeddings_next',
+            field=pgvector.django.vector.VectorField(dimensions=768, null=True),
+        ),
+        migrations.CreateModel(
+            name='EmbeddingModel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('dims', models.PositiveIntegerField()),
+                ('state', models.CharField(choices=[('active', 'Active'), ('reembedding', 'Re-embedding'), ('retired', 'Retired'), ('aborted', 'Aborted')], max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('activated_at', models.DateTimeField(null=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(condition=models.Q(('state__in', ['active', 'reembedding'])), fields=('state',), name='embedding_model_one_per_state')],
+            },
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:31
+
+import django.contrib.postgres.indexes
+import django.db.models.deletion
+import pgvector.django.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently, RemoveIndexConcurrently
+from django.db import migrations, models
+
+# memory.models.SEARCHABLE, which now leaves superseded memories out
+SEARCHABLE = models.Q(models.Q(('summary_id__isnull', True), models.Q(('metadata__has_key', 'type'), ('metadata__type', 'summary')), _connector='OR'), ('superseded_by__isnull', True))
+
+
+def rebuild(index):
+    """
+    Build the index with the new condition under a temporary name, then
+    swap it for the old one, so searches never run without it.
+    """
+    name = index.name
+    index.name = name.replace('_idx', '_new')
+    return [
+        AddIndexConcurrently(model_name='memory', index=index),
+        RemoveIndexConcurrently(model_name='memory', name=name),
+        migrations.RenameIndex(model_name='memory', new_name=name, old_name=index.name),
+    ]
+
+
+class Migration(migrations.Migration):
+    # Indexes are built concurrently, without blocking writes
+    atomic = False
+
+    dependencies = [
+        ('memory', '0013_embedding_models'),
+    ]
+
+    operations = [
+        # Existing memories aren't checked, only the ones written from now on
+        migrations.AddField(
+            model_name='memory',
+            name='contradiction_pending',
+            field=models.BooleanField(db_default=False),
+        ),
+        migrations.AlterField(
+            model_name='memory',
+            name='contradiction_pending',
+            field=models.BooleanField(db_default=True),
+        ),
+        migrations.AddField(
+            model_name='memory',
+            name='superseded_by',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='superseded_memories', to='memory.memory'),
+        ),
+        AddIndexConcurrently(
+            model_name='memory',
+            index=models.Index(condition=models.Q(('contradiction_pending', True)), fields=['created_at'], name='memory_unchecked_idx'),
+        ),
+        *rebuild(pgvector.django.indexes.HnswIndex(condition=SEARCHABLE, ef_construction=64, fields=['embeddings'], m=16, name='memory_live_hnsw_idx', opclasses=['vector_cosine_ops'])),
+        *rebuild(django.contrib.postgres.indexes.GinIndex(condition=SEARCHABLE, fields=['content_search'], name='memory_content_search_idx')),
+        *rebuild(models.Index(condition=SEARCHABLE, fields=['created_at', 'id'], name='memory_recent_idx')),
+        *rebuild(models.Index(condition=SEARCHABLE, fields=['user', 'created_at', 'id'], name='memory_user_recent_idx')),
+        migrations.CreateModel(
+            name='ContradictionCheck',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('verdict', models.CharField(choices=[('contradicts', 'Contradicts'), ('consistent', 'Consistent')], max_length=20)),
+                ('distance', models.FloatField()),
+                ('checked_at', models.DateTimeField(auto_now_add=True)),
+                ('first', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='memory.memory')),
+                ('second', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='memory.memory')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('first', 'second'), name='contradiction_check_pair')],
+            },
+        ),
+    ]
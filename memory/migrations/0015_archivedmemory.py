@@ -0,0 +1,33 @@
+# Generated by Django 5.1.7 on 2026-10-18 20:43
+
+import django.db.models.deletion
+import pgvector.django.halfvec
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memory', '0014_contradictions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMemory',
+            fields=[
+                ('id', models.UUIDField(editable=False, primary_key=True, serialize=False)),
+                ('channel_id', models.CharField(max_length=255, null=True)),
+                ('server_id', models.CharField(max_length=255, null=True)),
+                ('content', models.TextField()),
+                ('metadata', models.JSONField()),
+                ('embeddings', pgvector.django.halfvec.HalfVectorField(dimensions=768, null=True)),
+                ('embedding_model', models.CharField(max_length=255, null=True)),
+                ('created_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('summary', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='archived_memories', to='memory.memory')),
+                ('superseded_by', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='memory.memory')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_memories', to='memory.userprofile')),
+            ],
+        ),
+    ]
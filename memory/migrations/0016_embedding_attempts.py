@@ -0,0 +1,29 @@
+# Generated by Django 5.1.7 on 2026-10-18 21:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Nullable or constant defaults: added without rewriting the table
+
+    dependencies = [
+        ('memory', '0015_archivedmemory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='memory',
+            name='embedding_attempts',
+            field=models.SmallIntegerField(db_default=0),
+        ),
+        migrations.AddField(
+            model_name='memory',
+            name='embedding_error',
+            field=models.TextField(null=True),
+        ),
+        migrations.AddField(
+            model_name='memory',
+            name='embedding_retry_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.1.7 on 2026-10-18 21:06
+
+from django.db import migrations, models
+
+# memory.models.SEARCHABLE
+SEARCHABLE = models.Q(models.Q(('summary_id__isnull', True), models.Q(('metadata__has_key', 'type'), ('metadata__type', 'summary')), _connector='OR'), ('superseded_by__isnull', True))
+
+INDEXES = [
+    models.Index(condition=SEARCHABLE, fields=['server_id'], name='memory_server_idx'),
+    models.Index(condition=SEARCHABLE, fields=['channel_id'], name='memory_channel_idx'),
+]
+
+
+def add_indexes(apps, schema_editor):
+    # Concurrently, or partition by partition once the table is partitioned,
+    # where AddIndexConcurrently fails
+    from memory.partitioning import add_index
+    for index in INDEXES:
+        add_index(index)
+
+
+def remove_indexes(apps, schema_editor):
+    from memory.partitioning import remove_index
+    for index in INDEXES:
+        remove_index(index.name)
+
+
+class Migration(migrations.Migration):
+    # Indexes are built concurrently, without blocking writes
+    atomic = False
+
+    dependencies = [
+        ('memory', '0016_embedding_attempts'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[migrations.AddIndex(model_name='memory', index=index) for index in INDEXES],
+            database_operations=[migrations.RunPython(add_indexes, remove_indexes)],
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.1.7 on 2026-10-18 21:08
+
+import pgvector.django.halfvec
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # Nullable without a default: added without rewriting the table
+
+    dependencies = [
+        ('memory', '0017_memory_scope_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedmemory',
+            name='embeddings_next',
+            field=pgvector.django.halfvec.HalfVectorField(dimensions=768, null=True),
+        ),
+    ]
@@ -1,9 +1,19 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
-from pgvector.django import VectorField, HnswIndex
+from pgvector.django import HalfVectorField, VectorField, HnswIndex
 import uuid
-from .embeddings import compute_embedding
+from .embeddings import active_model, compute_embedding
 
 DIMS = 768  # nomic-embed-text dimensions
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 64
+
+# Rows shown by searches and lists: summaries and memories not summarized yet,
+# unless a newer memory contradicting them superseded them
+SEARCHABLE = (
+    models.Q(summary_id__isnull=True) | models.Q(metadata__has_key='type', metadata__type='summary')
+) & models.Q(superseded_by__isnull=True)
 
 class UserProfile(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, auto_created=True)
@@ -15,6 +25,11 @@ class UserProfile(models.Model):
     def __str__(self):
         return f"{self.username}"
 
+class MemoryManager(models.Manager):
+    def get_queryset(self):
+        # Only read by the database, don't ship it with every row
+        return super().get_queryset().defer('embeddings_half', 'content_search', 'embeddings_next')
+
 class Memory(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, auto_created=True)
     user = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='memories')
@@ -22,29 +37,175 @@ class Memory(models.Model):
     server_id = models.CharField(max_length=255, null=True)   # Discord server ID
     content = models.TextField()
     metadata = models.JSONField()
-    embeddings = VectorField(dimensions=DIMS)
+    embeddings = VectorField(dimensions=DIMS, null=True)  # NULL while the embedding is pending
+    embedding_pending = models.BooleanField(default=False)
+    # Claims of a pending memory since it was last embedded, given up at MEMORY_PENDING_EMBED_MAX_ATTEMPTS
+    embedding_attempts = models.SmallIntegerField(db_default=0)
+    embedding_retry_at = models.DateTimeField(null=True)  # Pending memory claimed, or backing off, until then
+    embedding_error = models.TextField(null=True)  # Why its last embedding attempt failed
+    embedding_model = models.CharField(max_length=255, null=True)  # Model of the embeddings, NULL while pending
+    # Re-embedding with the next model, copied over the embeddings at cutover
+    embeddings_next = VectorField(dimensions=DIMS, null=True)
+    # Half-precision copy for quantized search (pgvector >= 0.7), NULL until
+    # quantization is enabled, then kept by a trigger, see memory.quantization
+    embeddings_half = HalfVectorField(dimensions=DIMS, null=True)
+    # Lexical side of hybrid search, 'simple' keeps names and IDs unstemmed.
+    # Set from the content by a trigger (migration 0011), on every write path
+    content_search = SearchVectorField(null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     summary = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='summarized_memories')
+    # Newer memory contradicting this one, see memory.contradictions
+    superseded_by = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='superseded_memories')
+    # Waiting for its contradiction check, set by the database so every write path gets it
+    contradiction_pending = models.BooleanField(db_default=True)
+
+    objects = MemoryManager()
     
     class Meta:
         indexes = [
+            # Only searchable rows are ever ranked, summarized originals stay out of the graph
             HnswIndex(
-                name='memory_embeddings_hnsw_idx',
+                name='memory_live_hnsw_idx',
                 fields=['embeddings'],
                 opclasses=['vector_cosine_ops'],
-                m=16,
-                ef_construction=64,
+                m=HNSW_M,
+                ef_construction=HNSW_EF_CONSTRUCTION,
+                condition=SEARCHABLE,
             ),
+            GinIndex(name='memory_content_search_idx', fields=['content_search'], condition=SEARCHABLE),
             models.Index(fields=['user', 'channel_id', 'server_id']),
-            models.Index(fields=['summary_id'])
+            # Scopes filtered on a server or a channel alone: counted, and ranked exactly, without a scan
+            models.Index(fields=['server_id'], condition=SEARCHABLE, name='memory_server_idx'),
+            models.Index(fields=['channel_id'], condition=SEARCHABLE, name='memory_channel_idx'),
+            models.Index(fields=['summary_id']),
+            models.Index(fields=['created_at'], condition=models.Q(embedding_pending=True), name='memory_pending_idx'),
+            models.Index(fields=['created_at'], condition=models.Q(contradiction_pending=True), name='memory_unchecked_idx'),
+            # Keyset pagination of the searchable memories, newest first
+            models.Index(fields=['created_at', 'id'], condition=SEARCHABLE, name='memory_recent_idx'),
+            models.Index(fields=['user', 'created_at', 'id'], condition=SEARCHABLE, name='memory_user_recent_idx'),
+            # Keyset scan of a user's unsummarized memories during summarization
+            models.Index(
+                fields=['user', 'created_at', 'id'],
+                condition=models.Q(summary_id__isnull=True),
+                name='memory_unsummarized_idx',
+            ),
         ]
         
     def __str__(self):
         return f"Memory for {self.user.username} in {self.channel_id}"
     
     def save(self, *args, **kwargs):
-        if not self.embeddings:
-            self.embeddings = compute_embedding(self.content)[0]
+        if self.embeddings is None and not self.embedding_pending:
+            self.embedding_model = active_model()
+            self.embeddings = compute_embedding(self.content, self.embedding_model)[0]
         super().save(*args, **kwargs)
-	
+
+
+class ArchivedMemory(models.Model):
+    """
+    Summarized memory moved out of the memory table once older than
+    ARCHIVE_AFTER_DAYS, see memory.archive. Never searched, only read by
+    id and when a search drills into its summary.
+    """
+    id = models.UUIDField(primary_key=True, editable=False)  # Id of the memory it was
+    user = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='archived_memories')
+    channel_id = models.CharField(max_length=255, null=True)
+    server_id = models.CharField(max_length=255, null=True)
+    content = models.TextField()
+    metadata = models.JSONField()
+    # Half precision, NULL when archived without embeddings (ARCHIVE_EMBEDDINGS)
+    embeddings = HalfVectorField(dimensions=DIMS, null=True)
+    embedding_model = models.CharField(max_length=255, null=True)
+    # Re-embedding with the next model, as Memory.embeddings_next
+    embeddings_next = HalfVectorField(dimensions=DIMS, null=True)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+    # No constraints: a partitioned memory table can't be referenced by id alone (see memory.partitioning)
+    summary = models.ForeignKey(
+        Memory, on_delete=models.SET_NULL, null=True, blank=True, related_name='archived_memories', db_constraint=False
+    )
+    # May be archived itself
+    superseded_by = models.ForeignKey(
+        Memory, on_delete=models.DO_NOTHING, null=True, blank=True, related_name='+', db_constraint=False
+    )
+
+    embedding_pending = False  # Read like a memory's, archived memories are never embedded again
+
+    def __str__(self):
+        return f"Archived memory for {self.user.username} in {self.channel_id}"
+
+
+class SummarizationCheckpoint(models.Model):
+    """
+    Progress of a user's summarization run, saved after every batch so a
+    crashed run resumes where it stopped instead of calling the LLM again.
+    """
+    user = models.OneToOneField(UserProfile, on_delete=models.CASCADE, primary_key=True, related_name='summarization_checkpoint')
+    cutoff = models.DateTimeField()  # Memories created later are left to the next run
+    last_created_at = models.DateTimeField(null=True)  # Keyset position of the last summarized memory
+    last_id = models.UUIDField(null=True)
+    summaries = models.JSONField(default=list)  # One summary per batch
+    memory_ids = models.JSONField(default=list)  # Memories covered by the summaries
+    chunks = models.IntegerField(default=0)
+    levels = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Summarization checkpoint for {self.user_id}"
+
+class EmbeddingModel(models.Model):
+    """
+    Embedding models the memories were embedded with. The active one
+    embeds memories and queries, at most one other is being re-embedded
+    into ``Memory.embeddings_next`` until its cutover.
+    """
+    ACTIVE = 'active'
+    REEMBEDDING = 'reembedding'
+    RETIRED = 'retired'
+    ABORTED = 'aborted'
+    STATES = [(ACTIVE, 'Active'), (REEMBEDDING, 'Re-embedding'), (RETIRED, 'Retired'), (ABORTED, 'Aborted')]
+
+    name = models.CharField(max_length=255, unique=True)  # Ollama model tag
+    dims = models.PositiveIntegerField()
+    state = models.CharField(max_length=20, choices=STATES)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    activated_at = models.DateTimeField(null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['state'],
+                condition=models.Q(state__in=['active', 'reembedding']),
+                name='embedding_model_one_per_state',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.state})"
+
+class ContradictionCheck(models.Model):
+    """
+    LLM verdict on a pair of memories of a user, recorded so a pair is
+    never sent to the LLM twice. ``first`` is the memory with the lower id.
+    """
+    CONTRADICTS = 'contradicts'
+    CONSISTENT = 'consistent'
+    VERDICTS = [(CONTRADICTS, 'Contradicts'), (CONSISTENT, 'Consistent')]
+
+    first = models.ForeignKey(Memory, on_delete=models.CASCADE, related_name='+')
+    second = models.ForeignKey(Memory, on_delete=models.CASCADE, related_name='+')
+    verdict = models.CharField(max_length=20, choices=VERDICTS)
+    distance = models.FloatField()  # Cosine distance of the pair when it was checked
+    checked_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['first', 'second'], name='contradiction_check_pair'),
+        ]
+
+    def __str__(self):
+        return f"{self.first_id} {self.verdict} {self.second_id}"
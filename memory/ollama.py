@@ -0,0 +1,151 @@
+"""
+Shared HTTP transport for the Ollama API.
+
+Both clients keep connections alive in a pool, apply per-endpoint
+timeouts, retry connection errors and overloaded responses with
+exponential backoff and cap the number of requests in flight.
+
+The async client is bound to an event loop and closed when the loop
+shuts down: under ASGI it lives as long as the server, under WSGI (where
+``async_to_sync`` runs each async view in a loop of its own) as long as
+the request.
+"""
+import asyncio
+import os
+import threading
+import weakref
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .metrics import OLLAMA_SECONDS, timer
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def _timeout(endpoint: str) -> Tuple[float, float]:
+    """(connect, read) timeout in seconds for an endpoint."""
+    timeouts = settings.OLLAMA_TIMEOUTS
+    return tuple(timeouts.get(endpoint, timeouts['default']))
+
+class OllamaClient:
+    """Thread-safe, pooled Ollama client for sync code (views, Celery tasks)."""
+
+    def __init__(self, base_url: str, max_retries: int, backoff: float, pool_size: int, max_concurrency: int):
+        self.base_url = base_url.rstrip('/')
+        retry = Retry(
+            total=max_retries,
+            read=0,  # Never replay a request the model may still be working on
+            backoff_factor=backoff,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset({'POST'}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+    def post(self, endpoint: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """POST a JSON payload to ``/api/<endpoint>`` and return the JSON response."""
+        with self._slots, timer('ollama', OLLAMA_SECONDS, endpoint=endpoint):
+            response = self.session.post(
+                f"{self.base_url}/api/{endpoint}",
+                json=payload,
+                timeout=_timeout(endpoint),
+            )
+        response.raise_for_status()
+        return response.json()
+
+    def embed(self, texts: List[str], model: str) -> List[List[float]]:
+        return self.post('embed', {'model': model, 'input': texts, 'truncate': False})['embeddings']
+
+    def chat(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        return self.post('chat', payload)
+
+class AsyncOllamaClient:
+    """Pooled Ollama client for async views, bound to one event loop."""
+
+    def __init__(self, base_url: str, max_retries: int, backoff: float, pool_size: int, max_concurrency: int):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.client = httpx.AsyncClient(
+            base_url=base_url.rstrip('/'),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+    async def post(self, endpoint: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """POST a JSON payload to ``/api/<endpoint>`` and return the JSON response."""
+        connect, read = _timeout(endpoint)
+        timeout = httpx.Timeout(read, connect=connect)
+        attempt = 0
+        while True:
+            try:
+                async with self._slots:
+                    with timer('ollama', OLLAMA_SECONDS, endpoint=endpoint):
+                        response = await self.client.post(f"/api/{endpoint}", json=payload, timeout=timeout)
+                if response.status_code not in RETRY_STATUSES or attempt >= self.max_retries:
+                    response.raise_for_status()
+                    return response.json()
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError):
+                if attempt >= self.max_retries:
+                    raise
+            await asyncio.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+
+    async def embed(self, texts: List[str], model: str) -> List[List[float]]:
+        response = await self.post('embed', {'model': model, 'input': texts, 'truncate': False})
+        return response['embeddings']
+
+    async def chat(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        return await self.post('chat', payload)
+
+def _client_options() -> Dict[str, Any]:
+    return {
+        'base_url': settings.OLLAMA_URL,
+        'max_retries': settings.OLLAMA_MAX_RETRIES,
+        'backoff': settings.OLLAMA_RETRY_BACKOFF,
+        'pool_size': settings.OLLAMA_POOL_SIZE,
+        'max_concurrency': settings.OLLAMA_MAX_CONCURRENCY,
+    }
+
+_client: Optional[OllamaClient] = None
+_client_pid: Optional[int] = None
+_client_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+
+def get_ollama_client() -> OllamaClient:
+    """Return the process-wide client, recreated after a fork so pooled sockets are never shared."""
+    global _client, _client_pid
+    if _client_pid != os.getpid():
+        with _client_lock:
+            if _client_pid != os.getpid():
+                _client = OllamaClient(**_client_options())
+                _client_pid = os.getpid()
+    return _client
+
+async def _close_on_shutdown(loop: asyncio.AbstractEventLoop, client: AsyncOllamaClient) -> AsyncIterator[None]:
+    # Once started, the loop finalizes it in shutdown_asyncgens(), before
+    # closing (asyncio.run, uvicorn): the client is closed on its own loop
+    try:
+        yield
+    finally:
+        # The client references its loop, the entry would never be collected
+        _async_clients.pop(loop, None)
+        await client.client.aclose()
+
+async def get_async_ollama_client() -> AsyncOllamaClient:
+    """Return the client of the running event loop, closed when the loop shuts down."""
+    loop = asyncio.get_running_loop()
+    entry = _async_clients.get(loop)
+    if entry is None:
+        client = AsyncOllamaClient(**_client_options())
+        closer = _close_on_shutdown(loop, client)
+        entry = _async_clients[loop] = (client, closer)
+        await closer.asend(None)
+    return entry[0]
@@ -0,0 +1,96 @@
+"""
+Keyset (cursor) pagination.
+
+Pages are read after the last row of the previous page instead of at an
+OFFSET, and nothing is counted, so every page costs the same. Cursors are
+opaque: the sort key of that last row, as URL-safe base64 JSON.
+
+``keyset_page`` pages a queryset on one or two fields, the last one
+unique (``('-created_at', '-id')``, ``('username',)``). ``ranked_page``
+pages a bounded list already ranked by ``(distance, id)``, such as the
+candidates of a vector search.
+"""
+import base64
+import json
+from dataclasses import dataclass
+from typing import Any, List, Optional, Sequence
+
+from django.db.models import QuerySet
+
+class InvalidCursor(ValueError):
+    pass
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    data = json.dumps([str(v) if not isinstance(v, (int, float)) else v for v in values])
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor: str, length: int) -> List[Any]:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        raise InvalidCursor('invalid cursor')
+    if not isinstance(values, list) or len(values) != length:
+        raise InvalidCursor('invalid cursor')
+    return values
+
+@dataclass
+class Page:
+    items: List[Any]
+    next_cursor: Optional[str]
+
+    @property
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+def _after(queryset: QuerySet, fields: Sequence[str], values: List[Any]) -> QuerySet:
+    """Rows after ``values`` in the ``fields`` order."""
+    names = [f.lstrip('-') for f in fields]
+    ops = ['lt' if f.startswith('-') else 'gt' for f in fields]
+    if len(fields) == 1:
+        return queryset.filter(**{f'{names[0]}__{ops[0]}': values[0]})
+    # Bound the first field so the index scan starts at the cursor, and
+    # only skip the ties already shown (an OR would scan from the start)
+    first, last = names
+    return queryset.filter(**{f'{first}__{ops[0]}e': values[0]}).exclude(**{
+        first: values[0],
+        f'{last}__{"gt" if ops[1] == "lt" else "lt"}e': values[1],
+    })
+
+def keyset_page(queryset: QuerySet, fields: Sequence[str], cursor: Optional[str], limit: int) -> Page:
+    """The ``limit`` rows of ``queryset`` following ``cursor``, in the ``fields`` order."""
+    if not 1 <= len(fields) <= 2:
+        raise ValueError('keyset pagination takes one or two fields')
+    queryset = queryset.order_by(*fields)
+    if cursor:
+        queryset = _after(queryset, fields, decode_cursor(cursor, len(fields)))
+    items = list(queryset[:limit + 1])
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = encode_cursor([getattr(last, f.lstrip('-')) for f in fields])
+    return Page(items=items, next_cursor=next_cursor)
+
+def ranked_page(items: Sequence[Any], cursor: Optional[str], limit: int) -> Page:
+    """
+    The ``limit`` items following ``cursor`` in a list ranked by
+    ``(distance, id)``. The list is the whole candidate set, so pages end
+    with it.
+    """
+    items = sorted(items, key=lambda m: (m.distance, str(m.id)))
+    if cursor:
+        distance, id = decode_cursor(cursor, 2)
+        if not isinstance(distance, (int, float)):
+            raise InvalidCursor('invalid cursor')
+        items = [m for m in items if (m.distance, str(m.id)) > (distance, id)]
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor([items[-1].distance, items[-1].id])
+    return Page(items=list(items), next_cursor=next_cursor)
@@ -0,0 +1,383 @@
+"""
+Online hash partitioning of the memory table by user_id.
+
+Each user's memories live in one of MEMORY_PARTITIONS partitions, each
+with its own copy of every index, so vacuums, index builds and bloat
+scale with a partition instead of the whole table, and queries filtered
+on user_id only read one partition.
+
+An existing table is moved online, in steps run by the
+``partition_memories`` command:
+
+``prepare``
+    Drop the foreign keys referencing the memory table, then create the
+    partitioned ``memory_memory_new`` and its partitions, with a primary
+    key on (id, user_id), and a trigger mirroring every write on the
+    current table into it.
+``copy``
+    Copy the existing rows in batches, in id order. Rows are locked
+    while copied, so a concurrent update or delete is never lost, and
+    the progress is saved with each batch: an interrupted copy resumes.
+``index``
+    Build the indexes of the current table on every partition,
+    concurrently, and attach them to the partitioned indexes.
+``swap``
+    Swap the tables and their index names in one short transaction. The
+    former table is kept as ``memory_memory_old`` until ``drop-old``.
+
+Foreign keys can't reference a partitioned table by id alone, so the
+links to memories (summaries, superseding memories, contradiction
+checks) lose their database constraints at ``prepare``, ``abort``
+restores them. Django still cascades deletions, raw deletes must clean
+up the links themselves. A lookup by id alone
+probes the primary key of every partition: filter on user_id as well
+when it is known. Postgres can't build an index concurrently on a
+partitioned table, so later index changes go through ``add_index``,
+one partition at a time.
+"""
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from django.db import IntegrityError, connection, transaction
+
+from .models import Memory
+
+TABLE = Memory._meta.db_table
+NEW_TABLE = f'{TABLE}_new'
+OLD_TABLE = f'{TABLE}_old'
+PROGRESS_TABLE = f'{TABLE}_partition_progress'
+KEYS_TABLE = f'{TABLE}_partition_keys'  # Foreign keys dropped by prepare, restored by abort
+TRIGGER = 'memory_partition_sync'
+SUFFIX = '_new'  # Of the names of the new table's indexes and constraints, until the swap
+TENANT_INDEX_PREFIX = 'memory_tenant_'  # As in memory.vector_indexes, rebuilt per partition by sync_tenant_indexes
+
+class PartitioningError(Exception):
+    """A partitioning step can't run in the current state."""
+
+def _fetch(sql: str, params=None) -> list:
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+def _exists(relation: str) -> bool:
+    return _fetch("SELECT to_regclass(%s) IS NOT NULL", [relation])[0][0]
+
+def is_partitioned(table: str = TABLE) -> bool:
+    rows = _fetch("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [table])
+    return bool(rows) and rows[0][0] == 'p'
+
+def partitions(table: str = TABLE) -> List[str]:
+    """Partitions of the table, none when it isn't partitioned."""
+    return [row[0] for row in _fetch("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s) ORDER BY c.relname
+    """, [table])]
+
+def partition_of(user_id) -> Optional[str]:
+    """The partition holding a user's memories, None if they have none."""
+    rows = _fetch(f"SELECT tableoid::regclass::text FROM {TABLE} WHERE user_id = %s LIMIT 1", [str(user_id)])
+    return rows[0][0] if rows else None
+
+def partition_index_name(name: str, partition: str) -> str:
+    """Name of the copy of an index on a partition: ``<name>_p07``."""
+    suffix = '_' + partition.rsplit('_', 1)[1]
+    return name[:63 - len(suffix)] + suffix
+
+def _columns() -> List[str]:
+    # Generated columns are computed by each partition
+    return [f'"{f.column}"' for f in Memory._meta.concrete_fields if not f.generated]
+
+def _qualified(table: str) -> str:
+    """The table's schema-qualified name, as trigger definitions print it."""
+    return _fetch("""
+        SELECT quote_ident(n.nspname) || '.' || quote_ident(c.relname)
+        FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace WHERE c.oid = to_regclass(%s)
+    """, [table])[0][0]
+
+def _indexes(table: str) -> List[Tuple[str, str]]:
+    """(name, definition after USING) of the secondary indexes of a table, tenant indexes aside."""
+    indexes = []
+    for name, unique, definition in _fetch("""
+        SELECT c.relname, x.indisunique, pg_get_indexdef(x.indexrelid)
+        FROM pg_index x JOIN pg_class c ON c.oid = x.indexrelid
+        WHERE x.indrelid = to_regclass(%s) AND NOT x.indisprimary
+        ORDER BY c.relname
+    """, [table]):
+        if name.startswith(TENANT_INDEX_PREFIX):
+            continue
+        if unique:
+            raise PartitioningError(f"{name} is unique, a partitioned table can't enforce it without user_id")
+        indexes.append((name, definition.split(' USING ', 1)[1]))
+    return indexes
+
+def _foreign_keys(table: str) -> List[Tuple[str, str]]:
+    return _fetch("""
+        SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE conrelid = to_regclass(%s) AND contype = 'f' ORDER BY conname
+    """, [table])
+
+def _referencing_keys() -> List[Tuple[str, str, str]]:
+    """(table, name, definition) of the foreign keys referencing the memory table."""
+    return _fetch("""
+        SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) FROM pg_constraint
+        WHERE confrelid = to_regclass(%s) AND contype = 'f' ORDER BY conrelid::regclass::text, conname
+    """, [TABLE])
+
+def _triggers(table: str) -> List[str]:
+    """Definitions of the row triggers of a table, such as the content_search one or memory.quantization's."""
+    return [row[0] for row in _fetch("""
+        SELECT pg_get_triggerdef(oid) FROM pg_trigger
+        WHERE tgrelid = to_regclass(%s) AND NOT tgisinternal ORDER BY tgname
+    """, [table])]
+
+def _sync_function() -> str:
+    columns = _columns()
+    updates = ', '.join(f'{c} = EXCLUDED.{c}' for c in columns if c not in ('"id"', '"user_id"'))
+    return f"""
+        CREATE FUNCTION {TRIGGER}() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.user_id IS DISTINCT FROM NEW.user_id) THEN
+                DELETE FROM {NEW_TABLE} WHERE id = OLD.id AND user_id = OLD.user_id;
+            END IF;
+            IF TG_OP <> 'DELETE' THEN
+                -- Upsert: the row may be in a batch being copied, waited for here
+                INSERT INTO {NEW_TABLE} ({', '.join(columns)})
+                VALUES ({', '.join('NEW.' + c for c in columns)})
+                ON CONFLICT (id, user_id) DO UPDATE SET {updates};
+            END IF;
+            RETURN NULL;
+        END
+        $$
+    """
+
+def prepare(count: int) -> Tuple[List[str], List[str]]:
+    """
+    Drop the foreign keys referencing the memory table, create the
+    partitioned table and the sync trigger. Returns the partitions and
+    the foreign keys dropped.
+    """
+    if is_partitioned():
+        raise PartitioningError(f"{TABLE} is already partitioned")
+    if _exists(NEW_TABLE):
+        raise PartitioningError(f"{NEW_TABLE} already exists, copy or abort")
+
+    width = len(str(count - 1))
+    names = [f'{TABLE}_p{i:0{width}d}' for i in range(count)]
+    with transaction.atomic(), connection.cursor() as cursor:
+        # Kept for abort. The self-references go too, so they aren't copied to the new table
+        keys = _referencing_keys()
+        cursor.execute(f"CREATE TABLE {KEYS_TABLE} (table_name text, name text, definition text)")
+        for table, name, definition in keys:
+            cursor.execute(f"INSERT INTO {KEYS_TABLE} VALUES (%s, %s, %s)", [table, name, definition])
+            cursor.execute(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"')
+        cursor.execute(f"""
+            CREATE TABLE {NEW_TABLE} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING GENERATED INCLUDING CONSTRAINTS INCLUDING STORAGE)
+            PARTITION BY HASH (user_id)
+        """)
+        for i, name in enumerate(names):
+            cursor.execute(f"CREATE TABLE {name} PARTITION OF {NEW_TABLE} FOR VALUES WITH (MODULUS {count}, REMAINDER {i})")
+        # Unique constraints of a partitioned table must include the partition key
+        cursor.execute(f"ALTER TABLE {NEW_TABLE} ADD CONSTRAINT {TABLE}_pkey{SUFFIX} PRIMARY KEY (id, user_id)")
+        for name, definition in _foreign_keys(TABLE):
+            cursor.execute(f'ALTER TABLE {NEW_TABLE} ADD CONSTRAINT "{name}{SUFFIX}" {definition}')
+        # LIKE doesn't copy triggers, the new table needs them once swapped in
+        for definition in _triggers(TABLE):
+            cursor.execute(definition.replace(f' ON {_qualified(TABLE)} ', f' ON {NEW_TABLE} ', 1))
+        cursor.execute(f"CREATE TABLE {PROGRESS_TABLE} (last_id uuid)")
+        cursor.execute(f"INSERT INTO {PROGRESS_TABLE} VALUES (NULL)")
+        cursor.execute(_sync_function())
+        cursor.execute(f"""
+            CREATE TRIGGER {TRIGGER} AFTER INSERT OR UPDATE OR DELETE ON {TABLE}
+            FOR EACH ROW EXECUTE FUNCTION {TRIGGER}()
+        """)
+    return names, [name for _, name, _ in keys]
+
+def copy(batch_size: int, report: Optional[Callable[[int, str], None]] = None) -> int:
+    """Copy the rows of the current table not copied yet. Returns the number of rows read."""
+    if not _exists(PROGRESS_TABLE):
+        raise PartitioningError("Nothing to copy, prepare first")
+    columns = ', '.join(_columns())
+    total = 0
+    while True:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"SELECT last_id FROM {PROGRESS_TABLE} FOR UPDATE")
+            last = cursor.fetchone()[0]
+            after = "WHERE id > %s" if last else ""
+            # FOR SHARE: an update or delete of a row being copied waits for
+            # the batch, so the trigger sees the copied row and mirrors it
+            cursor.execute(f"""
+                WITH batch AS (
+                    SELECT {columns} FROM {TABLE} {after} ORDER BY id LIMIT %s FOR SHARE
+                ), copied AS (
+                    INSERT INTO {NEW_TABLE} ({columns}) SELECT {columns} FROM batch
+                    ON CONFLICT (id, user_id) DO NOTHING
+                )
+                SELECT count(*), (SELECT id FROM batch ORDER BY id DESC LIMIT 1) FROM batch
+            """, ([last] if last else []) + [batch_size])
+            count, last = cursor.fetchone()
+            if not count:
+                return total
+            cursor.execute(f"UPDATE {PROGRESS_TABLE} SET last_id = %s", [last])
+        total += count
+        if report:
+            report(total, str(last))
+
+def _attached(index: str) -> bool:
+    return bool(_fetch("SELECT 1 FROM pg_inherits WHERE inhrelid = to_regclass(%s)", [index]))
+
+def _build_partition_index(parent: Optional[str], name: str, partition: str, definition: str) -> None:
+    try:
+        if not _exists(name):
+            with connection.cursor() as cursor:
+                cursor.execute(f'CREATE INDEX CONCURRENTLY "{name}" ON {partition} USING {definition}')
+        if parent and not _attached(name):
+            with connection.cursor() as cursor:
+                cursor.execute(f'ALTER INDEX "{parent}" ATTACH PARTITION "{name}"')
+    finally:
+        # Built from worker threads, each with its own connection
+        connection.close()
+
+def build_index(name: str, definition: str, table: str = TABLE, parent: Optional[str] = None, jobs: int = 1,
+                only: Optional[List[str]] = None) -> None:
+    """
+    Build an index on every partition of a partitioned table (or ``only``
+    on some), concurrently, ``jobs`` partitions at a time. With ``parent``,
+    the partition indexes are attached to that partitioned index, created
+    invalid beforehand. ``definition`` is the index definition after ``USING``.
+    """
+    if parent and not _exists(parent):
+        with connection.cursor() as cursor:
+            cursor.execute(f'CREATE INDEX "{parent}" ON ONLY {table} USING {definition}')
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(
+            lambda partition: _build_partition_index(parent, partition_index_name(name, partition), partition, definition),
+            only or partitions(table),
+        ))
+
+def add_index(index, jobs: int = 1) -> None:
+    """
+    Build one of the memory table's indexes without blocking writes:
+    concurrently, or partition by partition once the table is partitioned.
+    """
+    with connection.schema_editor(atomic=False) as schema_editor:
+        if not is_partitioned():
+            schema_editor.add_index(Memory, index, concurrently=True)
+            return
+        definition = str(index.create_sql(Memory, schema_editor)).split(f' ON {schema_editor.quote_name(TABLE)} ', 1)[1]
+    # Django leaves out the default method
+    definition = definition[len('USING '):] if definition.startswith('USING ') else f'btree {definition}'
+    build_index(index.name, definition, parent=index.name, jobs=jobs)
+
+def remove_index(name: str) -> None:
+    """
+    Drop one of the memory table's indexes, concurrently unless the table
+    is partitioned: a partitioned index is dropped under a short lock of every partition.
+    """
+    concurrently = '' if is_partitioned() else 'CONCURRENTLY '
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP INDEX {concurrently}IF EXISTS "{name}"')
+
+def build_indexes(jobs: int = 1, report: Optional[Callable[[str], None]] = None) -> int:
+    """Build the indexes of the current table on the new one. Returns the number of indexes."""
+    if not _exists(NEW_TABLE):
+        raise PartitioningError("Nothing to index, prepare first")
+    indexes = _indexes(TABLE)
+    for name, definition in indexes:
+        if report:
+            report(name)
+        build_index(name, definition, NEW_TABLE, name + SUFFIX, jobs)
+    return len(indexes)
+
+def _invalid_indexes(table: str) -> List[str]:
+    return [row[0] for row in _fetch("""
+        SELECT c.relname FROM pg_index x JOIN pg_class c ON c.oid = x.indexrelid
+        WHERE x.indrelid = to_regclass(%s) AND NOT x.indisvalid
+    """, [table])]
+
+def swap(check_counts: bool = True) -> None:
+    """Make the partitioned table the memory table, keeping the former one as OLD_TABLE."""
+    if not _exists(NEW_TABLE):
+        raise PartitioningError("Nothing to swap, prepare first")
+    if _exists(OLD_TABLE):
+        raise PartitioningError(f"{OLD_TABLE} exists, drop it first")
+    indexes = _indexes(TABLE)
+    missing = [name for name, _ in indexes if not _exists(name + SUFFIX)] + _invalid_indexes(NEW_TABLE)
+    if missing:
+        raise PartitioningError(f"Indexes missing or being built: {', '.join(missing)}, run index")
+    if check_counts:
+        # One snapshot: the trigger keeps both tables equal once the copy is done
+        current, copied = _fetch(f"SELECT (SELECT count(*) FROM {TABLE}), (SELECT count(*) FROM {NEW_TABLE})")[0]
+        if current != copied:
+            raise PartitioningError(f"{copied}/{current} rows copied, run copy")
+
+    foreign_keys = [name for name, _ in _foreign_keys(TABLE)]
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE")
+        cursor.execute(f"DROP TRIGGER {TRIGGER} ON {TABLE}")
+        cursor.execute(f"DROP FUNCTION {TRIGGER}()")
+        cursor.execute(f"DROP TABLE {PROGRESS_TABLE}")
+        cursor.execute(f"DROP TABLE {KEYS_TABLE}")
+        for name, _ in indexes:
+            cursor.execute(f'ALTER INDEX "{name}" RENAME TO "{name}_old"')
+        for name in [f'{TABLE}_pkey'] + foreign_keys:
+            cursor.execute(f'ALTER TABLE {TABLE} RENAME CONSTRAINT "{name}" TO "{name}_old"')
+        cursor.execute(f"ALTER TABLE {TABLE} RENAME TO {OLD_TABLE}")
+        cursor.execute(f"ALTER TABLE {NEW_TABLE} RENAME TO {TABLE}")
+        for name, _ in indexes:
+            cursor.execute(f'ALTER INDEX "{name}{SUFFIX}" RENAME TO "{name}"')
+        for name in [f'{TABLE}_pkey'] + foreign_keys:
+            cursor.execute(f'ALTER TABLE {TABLE} RENAME CONSTRAINT "{name}{SUFFIX}" TO "{name}"')
+    with connection.cursor() as cursor:
+        cursor.execute(f"ANALYZE {TABLE}")
+
+def drop_old() -> None:
+    if not _exists(OLD_TABLE):
+        raise PartitioningError(f"{OLD_TABLE} doesn't exist")
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE {OLD_TABLE}")
+
+def abort() -> List[str]:
+    """
+    Drop the trigger and the partitioned table being prepared, and restore
+    the foreign keys. Returns the foreign keys that couldn't be validated,
+    because of links left dangling meanwhile: they are enforced on new
+    writes only until the links are fixed and they are validated.
+    """
+    if not _exists(NEW_TABLE):
+        raise PartitioningError("No partitioning in progress")
+    keys = _fetch(f"SELECT table_name, name, definition FROM {KEYS_TABLE}") if _exists(KEYS_TABLE) else []
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"DROP TRIGGER IF EXISTS {TRIGGER} ON {TABLE}")
+        cursor.execute(f"DROP FUNCTION IF EXISTS {TRIGGER}()")
+        cursor.execute(f"DROP TABLE IF EXISTS {PROGRESS_TABLE}")
+        cursor.execute(f"DROP TABLE {NEW_TABLE}")
+        # NOT VALID: added without scanning the tables under lock, validated below
+        for table, name, definition in keys:
+            cursor.execute(f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition} NOT VALID')
+        cursor.execute(f"DROP TABLE IF EXISTS {KEYS_TABLE}")
+
+    invalid = []
+    for table, name, _ in keys:
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(f'ALTER TABLE {table} VALIDATE CONSTRAINT "{name}"')
+        except IntegrityError:
+            invalid.append(name)
+    return invalid
+
+def status() -> Dict[str, object]:
+    state = {
+        'partitioned': is_partitioned(),
+        'partitions': len(partitions()) or len(partitions(NEW_TABLE)),
+        'preparing': _exists(NEW_TABLE),
+        'old_table': _exists(OLD_TABLE),
+    }
+    if state['preparing']:
+        last = _fetch(f"SELECT last_id FROM {PROGRESS_TABLE}")[0][0]
+        # Ids are random UUIDs, spread evenly over the key space
+        state['copied'] = uuid.UUID(str(last)).int / 2 ** 128 if last else 0.0
+        built = [name for name, _ in _indexes(TABLE) if _exists(name + SUFFIX)]
+        state['indexes'] = (len(built), len(_indexes(TABLE)))
+        state['invalid_indexes'] = _invalid_indexes(NEW_TABLE)
+    return state
@@ -0,0 +1,165 @@
+"""
+Opt-in half-precision copy of the embeddings for quantized search.
+
+``embeddings_half`` is a plain nullable column, empty until quantization
+is enabled, so installations that don't use SEARCH_QUANTIZED pay neither
+its storage nor a second HNSW index. The ``quantize_memories`` command
+enables it online:
+
+``enable``
+    Install a trigger computing ``embeddings_half`` on every write of
+    ``embeddings``, fill the existing rows in batches, in id order, then
+    build the halfvec index concurrently (partition by partition once the
+    table is partitioned). Interrupted, it resumes where it stopped.
+``drop-full``
+    With SEARCH_QUANTIZED on, graph scans only read the halfvec index:
+    drop the full-precision one, twice the size. ``restore-full``
+    rebuilds it before SEARCH_QUANTIZED is turned off again.
+``disable``
+    Drop the halfvec index and the trigger. The column keeps its values
+    until the next ``enable``, which refreshes the stale ones.
+"""
+from typing import Callable, Dict, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection, transaction
+from pgvector.django import HnswIndex
+
+from .models import HNSW_EF_CONSTRUCTION, HNSW_M, Memory, SEARCHABLE
+from .partitioning import add_index, remove_index
+
+TABLE = Memory._meta.db_table
+TRIGGER = 'memory_quantize'
+FULL_INDEX = 'memory_live_hnsw_idx'
+HALF_INDEX = 'memory_half_hnsw_idx'
+
+class QuantizationError(Exception):
+    """A quantization step can't run in the current state."""
+
+def half_index(m: int = HNSW_M, ef_construction: int = HNSW_EF_CONSTRUCTION) -> HnswIndex:
+    """The halfvec counterpart of the full-precision index, scanned with SEARCH_QUANTIZED."""
+    return HnswIndex(
+        name=HALF_INDEX,
+        fields=['embeddings_half'],
+        opclasses=['halfvec_cosine_ops'],
+        m=m,
+        ef_construction=ef_construction,
+        condition=SEARCHABLE,
+    )
+
+def full_index() -> HnswIndex:
+    return next(index for index in Memory._meta.indexes if index.name == FULL_INDEX)
+
+def index_state(name: str) -> Optional[bool]:
+    """Whether the index is valid, None when it doesn't exist."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", [name])
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+def is_enabled() -> bool:
+    """Whether the trigger keeps ``embeddings_half`` in sync."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_trigger WHERE tgrelid = to_regclass(%s) AND tgname = %s", [TABLE, TRIGGER]
+        )
+        return cursor.fetchone() is not None
+
+def install_trigger() -> None:
+    # BEFORE: the row is written once, with its half-precision copy. Cloned to every partition
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"""
+            CREATE OR REPLACE FUNCTION {TRIGGER}() RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                NEW.embeddings_half := NEW.embeddings::halfvec;
+                RETURN NEW;
+            END
+            $$
+        """)
+        cursor.execute(f"DROP TRIGGER IF EXISTS {TRIGGER} ON {TABLE}")
+        cursor.execute(f"""
+            CREATE TRIGGER {TRIGGER} BEFORE INSERT OR UPDATE OF embeddings ON {TABLE}
+            FOR EACH ROW EXECUTE FUNCTION {TRIGGER}()
+        """)
+
+def backfill(batch_size: int, report: Optional[Callable[[int, str], None]] = None) -> int:
+    """Fill ``embeddings_half`` where it is missing or stale, in id order. Returns the number of rows filled."""
+    filled, last = 0, None
+    while True:
+        with transaction.atomic(), connection.cursor() as cursor:
+            after = "WHERE id > %s" if last else ""
+            # Rows written meanwhile are filled by the trigger
+            cursor.execute(f"""
+                WITH batch AS (
+                    SELECT id, user_id FROM {TABLE} {after} ORDER BY id LIMIT %s
+                ), filled AS (
+                    UPDATE {TABLE} m SET embeddings_half = m.embeddings::halfvec
+                    FROM batch b
+                    WHERE m.id = b.id AND m.user_id = b.user_id
+                      AND m.embeddings_half IS DISTINCT FROM m.embeddings::halfvec
+                    RETURNING 1
+                )
+                SELECT (SELECT count(*) FROM filled), (SELECT id FROM batch ORDER BY id DESC LIMIT 1)
+            """, ([last] if last else []) + [batch_size])
+            count, last = cursor.fetchone()
+        if last is None:
+            return filled
+        filled += count
+        if report:
+            report(filled, str(last))
+
+def _build(index: HnswIndex, jobs: int) -> bool:
+    state = index_state(index.name)
+    if state:
+        return False
+    if state is False and not _partitioned_index(index.name):
+        # Left invalid by an interrupted concurrent build. A partitioned one
+        # is completed instead, partition by partition
+        remove_index(index.name)
+    add_index(index, jobs)
+    return True
+
+def _partitioned_index(name: str) -> bool:
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind = 'I' FROM pg_class WHERE oid = to_regclass(%s)", [name])
+        row = cursor.fetchone()
+    return bool(row and row[0])
+
+def enable(batch_size: int, jobs: int = 1, report: Optional[Callable[[int, str], None]] = None) -> Tuple[int, bool]:
+    """
+    Keep ``embeddings_half`` in sync, fill it and index it. Returns the
+    number of rows filled and whether the index was built.
+    """
+    install_trigger()
+    filled = backfill(batch_size, report)
+    return filled, _build(half_index(), jobs)
+
+def drop_full() -> None:
+    """Drop the full-precision index, only read by graph scans without SEARCH_QUANTIZED."""
+    if not settings.SEARCH_QUANTIZED:
+        raise QuantizationError("SEARCH_QUANTIZED is off, searches still scan the full-precision index")
+    if not (is_enabled() and index_state(HALF_INDEX)):
+        raise QuantizationError("Quantization isn't enabled, run enable first")
+    remove_index(FULL_INDEX)
+
+def restore_full(jobs: int = 1) -> bool:
+    """Rebuild the full-precision index concurrently. Returns False when it exists."""
+    return _build(full_index(), jobs)
+
+def disable() -> None:
+    """Drop the halfvec index and the trigger."""
+    if settings.SEARCH_QUANTIZED:
+        raise QuantizationError("SEARCH_QUANTIZED is on, searches still scan the halfvec index")
+    if not index_state(FULL_INDEX):
+        raise QuantizationError(f"{FULL_INDEX} was dropped, run restore-full first")
+    remove_index(HALF_INDEX)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"DROP TRIGGER IF EXISTS {TRIGGER} ON {TABLE}")
+        cursor.execute(f"DROP FUNCTION IF EXISTS {TRIGGER}()")
+
+def status() -> Dict[str, object]:
+    return {
+        'enabled': is_enabled(),
+        'half_index': index_state(HALF_INDEX),
+        'full_index': index_state(FULL_INDEX),
+    }
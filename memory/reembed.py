@@ -0,0 +1,337 @@
+"""
+Online re-embedding of every memory with a new embedding model.
+
+``start`` registers the model as the re-embedding target and dispatches
+one Celery task per id range (REEMBED_PARTITIONS). Each task reads its
+rows in batches, embeds them without holding any lock, then writes the
+new vectors to the ``embeddings_next`` shadow column in a short
+transaction, skipping the rows another worker filled meanwhile. Searches
+keep using ``embeddings``. Archived memories with an embedding are
+re-embedded the same way, into their own shadow column, so hierarchical
+searches still rank them after the cutover. Rows already done are
+skipped: starting again resumes an interrupted run, and tasks stop on
+their own when the run is aborted.
+
+``cutover`` embeds the rows written since and activates the new model in
+one short transaction, then copies the shadow columns over ``embeddings``
+in id order, REEMBED_CUTOVER_BATCH_SIZE rows per transaction. Searches
+only rank rows of the active model, so until its batch is copied a
+memory is left out of them rather than compared across models.
+Interrupted, ``cutover`` resumes the copy. Memories embedded with the old
+model meanwhile are set pending and embedded again, or re-embedded in
+place once archived. The shadow column has the same dimensions as
+``embeddings``: a model with other dimensions needs a schema migration.
+"""
+import logging
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from celery import group
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .embeddings import active_model, forget_active_model
+from .hot_cache import invalidate_users
+from .ingest import schedule_pending_embeddings
+from .metrics import EMBEDDING_SECONDS, timer
+from .models import DIMS, ArchivedMemory, EmbeddingModel, Memory
+from .ollama import get_ollama_client
+
+logger = logging.getLogger(__name__)
+
+class ReembedError(Exception):
+    """A re-embedding can't be started or cut over in the current state."""
+
+def id_ranges(partitions: int) -> List[Tuple[Optional[str], Optional[str]]]:
+    """Split the UUID space into ``partitions`` [start, stop) ranges, open at both ends."""
+    bounds = [str(uuid.UUID(int=(i << 128) // partitions)) for i in range(1, partitions)]
+    return list(zip([None] + bounds, bounds + [None]))
+
+def embed(texts: List[str], model: str) -> np.ndarray:
+    """Embed without the embedding cache, which re-embedded texts would only flush."""
+    size = settings.EMBEDDING_BULK_BATCH_SIZE
+    with timer('embed', EMBEDDING_SECONDS, model=model):
+        return np.vstack([
+            np.asarray(get_ollama_client().embed(texts[i:i + size], model), dtype=np.float32)
+            for i in range(0, len(texts), size)
+        ])
+
+def target() -> Optional[EmbeddingModel]:
+    """The model being re-embedded, if any."""
+    return EmbeddingModel.objects.filter(state=EmbeddingModel.REEMBEDDING).first()
+
+def _todo(model=Memory):
+    if model is ArchivedMemory:
+        # Archived without an embedding (ARCHIVE_EMBEDDINGS), they stay without
+        return ArchivedMemory.objects.filter(embeddings_next__isnull=True, embeddings__isnull=False)
+    return Memory.objects.filter(embeddings_next__isnull=True, embedding_pending=False, embeddings__isnull=False)
+
+def _remaining() -> int:
+    return _todo().count() + _todo(ArchivedMemory).count()
+
+def _copying() -> bool:
+    """Whether shadow vectors are left to copy by an interrupted cutover."""
+    return (
+        Memory.objects.filter(embeddings_next__isnull=False).exists()
+        or ArchivedMemory.objects.filter(embeddings_next__isnull=False).exists()
+    )
+
+def start(name: str) -> EmbeddingModel:
+    """Make ``name`` the re-embedding target and dispatch the range tasks."""
+    from .tasks import reembed_range
+
+    dims = embed(['dimension check'], name).shape[1]
+    if dims != DIMS:
+        raise ReembedError(f"{name} embeds in {dims} dimensions, the vector columns have {DIMS}: "
+                           f"change DIMS and migrate instead")
+
+    with transaction.atomic():
+        current = active_model()
+        if not EmbeddingModel.objects.filter(state=EmbeddingModel.ACTIVE).exists():
+            # Record the model the existing vectors come from
+            EmbeddingModel.objects.update_or_create(name=current, defaults={
+                'dims': DIMS, 'state': EmbeddingModel.ACTIVE, 'activated_at': timezone.now(),
+            })
+        if name == current:
+            raise ReembedError(f"{name} is already the active model")
+        job = EmbeddingModel.objects.select_for_update().filter(state=EmbeddingModel.REEMBEDDING).first()
+        if job and job.name != name:
+            raise ReembedError(f"{job.name} is being re-embedded, abort it first")
+        job, _ = EmbeddingModel.objects.update_or_create(name=name, defaults={
+            'dims': dims, 'state': EmbeddingModel.REEMBEDDING,
+        })
+        ranges = id_ranges(settings.REEMBED_PARTITIONS)
+        transaction.on_commit(lambda: group(reembed_range.s(name, *r) for r in ranges).apply_async())
+    return job
+
+def embed_range(name: str, start: Optional[str] = None, stop: Optional[str] = None) -> int:
+    """
+    Write the ``name`` embeddings of the memories with an id in [start, stop),
+    archived ones included, to the shadow columns. Returns the number of
+    memories embedded.
+    """
+    return _embed_range(Memory, name, start, stop) + _embed_range(ArchivedMemory, name, start, stop)
+
+def _embed_range(model, name: str, start: Optional[str], stop: Optional[str]) -> int:
+    batch_size = settings.REEMBED_BATCH_SIZE
+    total = 0
+    last = None
+    while True:
+        memories = _todo(model)
+        if last:
+            memories = memories.filter(id__gt=last)
+        elif start:
+            memories = memories.filter(id__gte=start)
+        if stop:
+            memories = memories.filter(id__lt=stop)
+        memories = list(memories.only('id', 'user_id', 'content').order_by('id')[:batch_size])
+        if not memories:
+            break
+
+        # No lock is held during the call, writes to these rows go on
+        for memory, embedding in zip(memories, embed([m.content for m in memories], name)):
+            memory.embeddings_next = embedding
+        if not _save_next(model, memories, name):
+            break
+        last = memories[-1].id
+        total += len(memories)
+        if settings.REEMBED_BATCH_DELAY:
+            time.sleep(settings.REEMBED_BATCH_DELAY)
+    return total
+
+def _save_next(model, memories, name: str) -> bool:
+    """
+    Write the shadow vectors of the rows no other worker filled meanwhile.
+    Returns False, writing nothing, once the run was cut over or aborted.
+    """
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            # Conflicts with the FOR UPDATE of cutover and abort only: no
+            # vector lands after they changed the state, writers don't wait for each other
+            cursor.execute(
+                f"SELECT 1 FROM {EmbeddingModel._meta.db_table} WHERE name = %s AND state = %s FOR KEY SHARE",
+                [name, EmbeddingModel.REEMBEDDING],
+            )
+            if cursor.fetchone() is None:
+                return False
+        model.objects.filter(
+            user_id__in={m.user_id for m in memories}, embeddings_next__isnull=True
+        ).bulk_update(memories, ['embeddings_next'])
+    return True
+
+def status() -> Dict[str, object]:
+    job = target()
+    embedded = (
+        Memory.objects.filter(embedding_pending=False, embeddings__isnull=False).count()
+        + ArchivedMemory.objects.filter(embeddings__isnull=False).count()
+    )
+    remaining = _remaining() if job else None
+    return {
+        'active': active_model(),
+        'target': job.name if job else None,
+        'embedded': embedded,
+        'done': embedded - remaining if job else None,
+        'remaining': remaining,
+    }
+
+def cutover() -> Tuple[int, int]:
+    """
+    Switch the queries, then every memory, to the target model, or resume
+    the copy of an interrupted cutover. Returns the number of memories
+    switched and the number set pending.
+    """
+    job = target()
+    if job is None:
+        if not _copying():
+            raise ReembedError("No re-embedding in progress")
+        return _switch(active_model())
+
+    remaining = _remaining()
+    if remaining > settings.REEMBED_CUTOVER_MAX_REMAINING:
+        raise ReembedError(f"{remaining} memories left to re-embed, wait for the tasks or start again")
+    # Rows written while the range tasks went by
+    embed_range(job.name)
+
+    with transaction.atomic():
+        job = EmbeddingModel.objects.select_for_update().get(pk=job.pk)
+        if job.state != EmbeddingModel.REEMBEDDING:
+            raise ReembedError(f"{job.name} is no longer being re-embedded")
+        EmbeddingModel.objects.filter(state=EmbeddingModel.ACTIVE).update(state=EmbeddingModel.RETIRED)
+        job.state = EmbeddingModel.ACTIVE
+        job.activated_at = timezone.now()
+        job.save()
+        transaction.on_commit(forget_active_model)
+    return _switch(job.name)
+
+def _switch(name: str) -> Tuple[int, int]:
+    """Copy the shadow vectors of the ``name`` model over the embeddings, batch after batch."""
+    switched = stale = 0
+    last = None
+    while True:
+        count, pending, last = _switch_batch(name, last)
+        switched += count
+        stale += pending
+        if last is None:
+            break
+    last = None
+    while True:
+        count, last = _switch_archived_batch(name, last)
+        switched += count
+        if last is None:
+            break
+    if stale:
+        schedule_pending_embeddings()
+    # Once every row is copied, or the sweep would set pending the ones still to copy
+    _schedule_stragglers()
+    return switched - stale, stale
+
+def _switch_batch(name: str, last) -> Tuple[int, int, Optional[str]]:
+    """
+    Switch the next REEMBED_CUTOVER_BATCH_SIZE memories after ``last``: the
+    ones without a shadow vector of ``name`` are set pending. Returns the
+    number switched, the number set pending and the last id, None at the end.
+    """
+    table = Memory._meta.db_table
+    after = "WHERE id > %s" if last else ""
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"""
+            WITH batch AS (
+                SELECT id, user_id FROM {table} {after} ORDER BY id LIMIT %s
+            ), updated AS (
+                UPDATE {table} m SET
+                    embeddings = COALESCE(m.embeddings_next, m.embeddings),
+                    embedding_model = CASE WHEN m.embeddings_next IS NULL THEN NULL ELSE %s END,
+                    embedding_pending = m.embedding_pending OR m.embeddings_next IS NULL,
+                    embeddings_next = NULL
+                FROM batch b
+                WHERE m.id = b.id AND m.user_id = b.user_id
+                  AND (m.embeddings_next IS NOT NULL
+                       OR (NOT m.embedding_pending AND m.embedding_model IS DISTINCT FROM %s))
+                RETURNING m.user_id, m.embedding_pending
+            )
+            SELECT (SELECT count(*) FROM updated), (SELECT count(*) FROM updated WHERE embedding_pending),
+                   (SELECT array_agg(DISTINCT user_id) FROM updated), (SELECT id FROM batch ORDER BY id DESC LIMIT 1)
+        """, ([last] if last else []) + [settings.REEMBED_CUTOVER_BATCH_SIZE, name, name])
+        count, pending, user_ids, last = cursor.fetchone()
+        invalidate_users(user_ids or [])
+    return count, pending, last
+
+def _switch_archived_batch(name: str, last) -> Tuple[int, Optional[str]]:
+    table = ArchivedMemory._meta.db_table
+    after = "AND id > %s" if last else ""
+    # Archived meanwhile without a shadow vector: re-embedded by the straggler sweep
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"""
+            WITH batch AS (
+                SELECT id FROM {table} WHERE embeddings_next IS NOT NULL {after} ORDER BY id LIMIT %s
+            ), updated AS (
+                UPDATE {table} a SET embeddings = a.embeddings_next, embedding_model = %s, embeddings_next = NULL
+                FROM batch b WHERE a.id = b.id
+                RETURNING 1
+            )
+            SELECT (SELECT count(*) FROM updated), (SELECT id FROM batch ORDER BY id DESC LIMIT 1)
+        """, ([last] if last else []) + [settings.REEMBED_CUTOVER_BATCH_SIZE, name])
+        return cursor.fetchone()
+
+def _schedule_stragglers() -> None:
+    from .tasks import reembed_stragglers
+
+    # Other processes embed with the old model for up to EMBEDDING_MODEL_CHECK_INTERVAL
+    try:
+        reembed_stragglers.apply_async(countdown=2 * settings.EMBEDDING_MODEL_CHECK_INTERVAL)
+    except Exception:
+        logger.warning("Could not schedule the straggler sweep, run `reembed stragglers`", exc_info=True)
+
+def set_stragglers_pending() -> int:
+    """Set pending the memories embedded with another model than the active one."""
+    model = active_model()
+    with transaction.atomic():
+        # Rows with a shadow vector are switched by the (resumed) cutover
+        stragglers = Memory.objects.filter(embedding_pending=False, embeddings_next__isnull=True).exclude(embedding_model=model)
+        user_ids = set(stragglers.values_list('user_id', flat=True).distinct())
+        count = stragglers.update(embedding_pending=True, embedding_model=None)
+        if count:
+            schedule_pending_embeddings()
+            invalidate_users(user_ids)
+    return count
+
+def embed_archived_stragglers() -> int:
+    """
+    Re-embed in place the archived memories embedded with another model
+    than the active one: archived, they are never set pending. Returns the
+    number re-embedded.
+    """
+    model = active_model()
+    stragglers = ArchivedMemory.objects.exclude(embeddings=None).exclude(embedding_model=model)
+    total = 0
+    last = None
+    while True:
+        memories = stragglers.filter(id__gt=last) if last else stragglers
+        memories = list(memories.only('id', 'user_id', 'content').order_by('id')[:settings.REEMBED_BATCH_SIZE])
+        if not memories:
+            return total
+        # Embedded without a lock, written unless another sweep did meanwhile
+        for memory, embedding in zip(memories, embed([m.content for m in memories], model)):
+            memory.embeddings = embedding
+            memory.embedding_model = model
+        with transaction.atomic():
+            stragglers.bulk_update(memories, ['embeddings', 'embedding_model'])
+        last = memories[-1].id
+        total += len(memories)
+
+def abort() -> int:
+    """Stop the re-embedding and clear the shadow columns. Returns the number of vectors dropped."""
+    with transaction.atomic():
+        # FOR UPDATE waits for the shadow vectors being written, see _save_next
+        job = EmbeddingModel.objects.select_for_update().filter(state=EmbeddingModel.REEMBEDDING).first()
+        if job is None:
+            raise ReembedError("No re-embedding in progress")
+        job.state = EmbeddingModel.ABORTED
+        job.save()
+        return (
+            Memory.objects.filter(embeddings_next__isnull=False).update(embeddings_next=None)
+            + ArchivedMemory.objects.filter(embeddings_next__isnull=False).update(embeddings_next=None)
+        )
@@ -0,0 +1,390 @@
+"""
+Vector search over the searchable memories of a scope.
+
+pgvector's HNSW index filters *after* walking the graph, so a selective
+scope (one user, one channel) can come back with fewer than ``k`` rows or
+with poor recall. ``search`` picks a strategy per query from the size of
+the scope: small scopes are ranked exactly from the ``(user, channel_id,
+server_id)`` index, or the ``server_id`` and ``channel_id`` ones for
+scopes without a user, large ones walk the HNSW index with a request-scoped
+``hnsw.ef_search`` (and iterative scans on pgvector >= 0.8).
+
+With SEARCH_QUANTIZED, graph scans use the half-precision index, half
+the size of the full one, and rerank its candidates exactly.
+
+``hybrid_search`` adds full-text retrieval on the content, for exact
+tokens (names, titles, IDs) embeddings rank poorly, and fuses both
+rankings with reciprocal rank fusion in a single query.
+
+``hierarchical_search`` drills from the best summaries down into the
+memories they summarize, for precise answers out of a long history,
+archived ones included.
+"""
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db.models import F, QuerySet, prefetch_related_objects
+from pgvector import HalfVector, Vector
+from pgvector.django import CosineDistance
+
+from .embedding_cache import LRUCache
+from .embeddings import active_model
+from .hot_cache import get_hot_cache
+from .metrics import SEARCH_SCOPE_ROWS, SEARCH_SECONDS, SEARCHES, record
+from .models import ArchivedMemory, Memory, SEARCHABLE, UserProfile
+
+EXACT = 'exact'
+HNSW = 'hnsw'
+HNSW_EXACT_FALLBACK = 'hnsw+exact'
+HNSW_HALF = 'hnsw_half'
+HYBRID = 'hybrid'
+HOT_CACHE = 'hot_cache'
+HIERARCHICAL = 'hierarchical'
+
+# Bounded scope sizes, kept briefly per process to save a COUNT per search
+_scope_sizes = LRUCache(maxsize=10000, ttl=60)
+_vector_version = None
+
+@dataclass
+class SearchResult:
+    memories: List[Memory]
+    strategy: str
+    scope_size: Optional[int] = None  # Capped at SEARCH_EXACT_MAX_ROWS + 1, None when not counted
+
+def is_summary(memory: Memory) -> bool:
+    return isinstance(memory.metadata, dict) and memory.metadata.get('type') == 'summary'
+
+def scope_queryset(user: Optional[UserProfile] = None, channel_id: Optional[str] = None,
+                   server_id: Optional[str] = None) -> QuerySet:
+    """Searchable memories of a user/channel/server scope."""
+    memories = Memory.objects.all()
+    if channel_id:
+        memories = memories.filter(channel_id=channel_id)
+    if server_id:
+        memories = memories.filter(server_id=server_id)
+    if user:
+        memories = memories.filter(user=user)
+    return memories.filter(SEARCHABLE)
+
+def rankable(scope: QuerySet) -> QuerySet:
+    """
+    The rows of the scope embedded with the active model. During a cutover
+    the others are left out, vectors of two models don't compare.
+    """
+    return scope.filter(embedding_pending=False, embedding_model=active_model())
+
+def scope_size(scope: QuerySet, key: tuple) -> int:
+    """Number of rows in the scope, counted up to SEARCH_EXACT_MAX_ROWS + 1."""
+    size = _scope_sizes.get(key)
+    if size is None:
+        size = scope.values('pk')[:settings.SEARCH_EXACT_MAX_ROWS + 1].count()
+        _scope_sizes.set(key, size)
+    return size
+
+def vector_version() -> tuple:
+    """Installed pgvector version, read once per process."""
+    global _vector_version
+    if _vector_version is None:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+            row = cursor.fetchone()
+        _vector_version = tuple(int(part) for part in row[0].split('.')[:2]) if row else (0, 0)
+    return _vector_version
+
+def _configure(strategy: str, filtered: bool, limit: int) -> None:
+    """Set the planner and pgvector options of the current transaction."""
+    with connection.cursor() as cursor:
+        if strategy == EXACT:
+            # Plain index scans off: the scope is read through a bitmap scan
+            # on the btree indexes and sorted, HNSW can't be used
+            cursor.execute("SELECT set_config('enable_indexscan', 'off', true)")
+            return
+
+        ef_search = settings.SEARCH_EF_SEARCH_FILTERED if filtered else settings.SEARCH_EF_SEARCH
+        # A scan returns at most ef_search rows
+        ef_search = max(ef_search, limit)
+        cursor.execute("SELECT set_config('hnsw.ef_search', %s, true)", [str(ef_search)])
+        if settings.SEARCH_ITERATIVE_SCAN and vector_version() >= (0, 8):
+            # Keep walking the graph until enough rows pass the filters
+            cursor.execute("SELECT set_config('hnsw.iterative_scan', %s, true)", [settings.SEARCH_ITERATIVE_SCAN])
+            cursor.execute("SELECT set_config('hnsw.max_scan_tuples', %s, true)", [str(settings.SEARCH_MAX_SCAN_TUPLES)])
+
+def _rank(scope: QuerySet, query_embedding, k: int, strategy: str, filtered: bool) -> List[Memory]:
+    scope = rankable(scope)
+    limit = k
+    if strategy == HNSW_HALF:
+        # Over-fetch candidates from the compact halfvec index, then rerank
+        # them below on the full-precision vectors, in the same query. The
+        # scope filters are kept, so the partition of the user is pruned too
+        limit = k * settings.SEARCH_RERANK_FACTOR
+        candidates = scope.order_by(
+            CosineDistance('embeddings_half', HalfVector(query_embedding))
+        ).values('pk')[:limit]
+        scope = scope.filter(pk__in=candidates)
+
+    ranked = (
+        scope.select_related('user')
+        .annotate(distance=CosineDistance('embeddings', query_embedding))
+        .order_by('distance')[:k]
+    )
+    with transaction.atomic():
+        _configure(strategy, filtered, limit)
+        memories = list(ranked)
+    # Iterative scans in relaxed order may return rows slightly out of order
+    return sorted(memories, key=lambda m: m.distance)
+
+def _choose(scope: QuerySet, filtered: bool, key: tuple) -> Tuple[str, Optional[int]]:
+    """Strategy for the scope, and its bounded size when it was counted."""
+    size = None
+    if filtered:
+        size = scope_size(scope, key)
+        strategy = EXACT if size <= settings.SEARCH_EXACT_MAX_ROWS else HNSW
+    else:
+        strategy = HNSW
+    if strategy == HNSW and settings.SEARCH_QUANTIZED:
+        strategy = HNSW_HALF
+    return strategy, size
+
+def _record(start: float, strategy: str, size: Optional[int]) -> None:
+    SEARCHES.inc(strategy=strategy)
+    if size is not None:
+        SEARCH_SCOPE_ROWS.observe(size)
+    description = strategy if size is None else f"{strategy}, {size} rows in scope"
+    record('search', time.perf_counter() - start, SEARCH_SECONDS, description, strategy=strategy)
+
+def _search(query_embedding, user: Optional[UserProfile], channel_id: Optional[str],
+            server_id: Optional[str], k: int, strategy: Optional[str]) -> SearchResult:
+    if strategy is None and user and settings.HOT_CACHE_ENABLED:
+        memories = get_hot_cache().search(query_embedding, user.pk, k, channel_id, server_id)
+        if memories is not None:
+            return SearchResult(memories=memories, strategy=HOT_CACHE)
+
+    scope = scope_queryset(user, channel_id, server_id)
+    filtered = bool(user or channel_id or server_id)
+
+    size = None
+    if strategy is None:
+        strategy, size = _choose(scope, filtered, (user.pk if user else None, channel_id, server_id))
+
+    memories = _rank(scope, query_embedding, k, strategy, filtered)
+
+    if strategy in (HNSW, HNSW_HALF) and filtered and len(memories) < k:
+        # The filters dropped too many graph candidates, rank the scope exactly
+        memories = _rank(scope, query_embedding, k, EXACT, filtered)
+        strategy = HNSW_EXACT_FALLBACK
+
+    return SearchResult(memories=memories, strategy=strategy, scope_size=size)
+
+def search(query_embedding, *, user: Optional[UserProfile] = None, channel_id: Optional[str] = None,
+           server_id: Optional[str] = None, k: int = 3, strategy: Optional[str] = None) -> SearchResult:
+    """
+    Return the ``k`` searchable memories of the scope closest to
+    ``query_embedding``, with the strategy that produced them.
+    ``strategy`` forces EXACT, HNSW or HNSW_HALF instead of choosing from
+    the scope size. With SEARCH_QUANTIZED, HNSW scans use HNSW_HALF.
+    With HOT_CACHE_ENABLED, hot users are ranked in memory (HOT_CACHE).
+    """
+    start = time.perf_counter()
+    result = _search(query_embedding, user, channel_id, server_id, k, strategy)
+    _record(start, result.strategy, result.scope_size)
+    return result
+
+def nearest(scope: QuerySet, embeddings, k: int, key: tuple) -> List[List[Tuple[object, float]]]:
+    """
+    The ``k`` memories of the scope nearest to each of ``embeddings``, as
+    (id, distance) pairs, in one query: a LATERAL scan per embedding, with
+    the strategy ``search`` would choose for the scope, cached by ``key``.
+    """
+    if not len(embeddings):
+        return []
+    scope = rankable(scope)
+    strategy, _ = _choose(scope, True, key)
+    limit = k
+    order = 'embeddings <=> q.embedding'
+    if strategy == HNSW_HALF:
+        # Candidates from the halfvec index, reranked on the full vectors
+        limit = k * settings.SEARCH_RERANK_FACTOR
+        order = 'embeddings_half <=> q.embedding::halfvec'
+    compiler = scope.query.get_compiler(connection=connection)
+    where, where_params = compiler.compile(scope.query.where)
+    table = Memory._meta.db_table
+    sql = f"""
+        SELECT q.ord, d.id, d.distance
+        FROM unnest(%s::vector[]) WITH ORDINALITY AS q(embedding, ord)
+        CROSS JOIN LATERAL (
+            SELECT c.id, c.distance FROM (
+                SELECT {table}.id, {table}.embeddings <=> q.embedding AS distance
+                FROM {table} WHERE {where}
+                ORDER BY {table}.{order}
+                LIMIT %s
+            ) c
+            ORDER BY c.distance
+            LIMIT %s
+        ) d
+        ORDER BY q.ord, d.distance
+    """
+    params = [[Vector(e).to_text() for e in embeddings], *where_params, limit, k]
+    found = [[] for _ in range(len(embeddings))]
+    with transaction.atomic():
+        _configure(strategy, True, limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            for position, memory_id, distance in cursor.fetchall():
+                found[position - 1].append((memory_id, distance))
+    return found
+
+def summarized_memories(summary_ids: List, channel_id: Optional[str] = None,
+                        server_id: Optional[str] = None) -> QuerySet:
+    """Memories summarized by the given summaries, within the channel/server filters."""
+    memories = Memory.objects.filter(summary_id__in=summary_ids, superseded_by__isnull=True)
+    if channel_id:
+        memories = memories.filter(channel_id=channel_id)
+    if server_id:
+        memories = memories.filter(server_id=server_id)
+    return memories
+
+def archived_children(summary_ids: List, query_embedding, k: int, channel_id: Optional[str] = None,
+                      server_id: Optional[str] = None) -> List[ArchivedMemory]:
+    """
+    The ``k`` archived memories of the given summaries closest to
+    ``query_embedding``, ranked exactly on their half-precision embeddings.
+    Archived without an embedding or with a retired model, they can't be ranked.
+    """
+    memories = ArchivedMemory.objects.filter(
+        summary_id__in=summary_ids, superseded_by__isnull=True, embedding_model=active_model(),
+    ).exclude(embeddings=None)
+    if channel_id:
+        memories = memories.filter(channel_id=channel_id)
+    if server_id:
+        memories = memories.filter(server_id=server_id)
+    ranked = (
+        memories.select_related('user').defer('embeddings', 'embeddings_next')
+        .annotate(distance=CosineDistance('embeddings', HalfVector(query_embedding)))
+        .order_by('distance')[:k]
+    )
+    return list(ranked)
+
+def hierarchical_search(query_embedding, *, user: Optional[UserProfile] = None, channel_id: Optional[str] = None,
+                        server_id: Optional[str] = None, k: int = 3, fanout: Optional[int] = None,
+                        depth: Optional[int] = None) -> SearchResult:
+    """
+    Return the ``k`` memories closest to ``query_embedding``, searching
+    coarse to fine down the summary hierarchy. The searchable memories of
+    the scope are ranked as by ``search``, then the ``fanout`` best
+    summaries are replaced by their closest summarized memories, ranked
+    exactly from the ``summary_id`` index, and so on for summaries of
+    summaries, down to ``depth`` levels. Summaries that were not drilled
+    into compete with the memories found on the way, archived memories of
+    a drilled summary with the ones still in the memory table.
+    """
+    start = time.perf_counter()
+    fanout = settings.SEARCH_HIERARCHY_FANOUT if fanout is None else fanout
+    depth = settings.SEARCH_HIERARCHY_DEPTH if depth is None else depth
+    limit = k + fanout  # Enough rows for k results, and fanout summaries to drill into
+
+    result = _search(query_embedding, user, channel_id, server_id, limit, None)
+    found, drilled, level = {}, set(), result.memories
+    for _ in range(depth):
+        # Summaries of summaries stay searchable, so a summary can be met twice
+        summaries = [m.id for m in level if is_summary(m) and m.id not in drilled][:fanout]
+        if not summaries:
+            break
+        drilled.update(summaries)
+        for memory in level:
+            found.setdefault(memory.id, memory)
+        children = summarized_memories(summaries, channel_id, server_id)
+        level = _rank(children, query_embedding, limit, EXACT, True)
+        archived = archived_children(summaries, query_embedding, limit, channel_id, server_id)
+        if archived:
+            level = sorted(level + archived, key=lambda m: m.distance)[:limit]
+    for memory in level:
+        found.setdefault(memory.id, memory)
+    memories = sorted((m for m in found.values() if m.id not in drilled), key=lambda m: m.distance)[:k]
+
+    strategy = f'{HIERARCHICAL}+{result.strategy}'
+    _record(start, strategy, result.scope_size)
+    return SearchResult(memories=memories, strategy=strategy, scope_size=result.scope_size)
+
+def hybrid_search(query: str, query_embedding, *, user: Optional[UserProfile] = None,
+                  channel_id: Optional[str] = None, server_id: Optional[str] = None, k: int = 3,
+                  weights: Optional[Dict[str, float]] = None, rrf_k: Optional[int] = None) -> SearchResult:
+    """
+    Return the ``k`` searchable memories of the scope with the best
+    reciprocal rank fusion of their vector and full-text ranks:
+    ``weights['vector'] / (rrf_k + vector rank) + weights['text'] / (rrf_k + text rank)``.
+    Each side contributes its SEARCH_HYBRID_CANDIDATES best rows. Memories
+    still waiting for their embedding can be found by the text side, with
+    a null distance.
+    """
+    start = time.perf_counter()
+    weights = {**settings.SEARCH_HYBRID_WEIGHTS, **(weights or {})}
+    rrf_k = settings.SEARCH_RRF_K if rrf_k is None else rrf_k
+    candidates = max(k, settings.SEARCH_HYBRID_CANDIDATES)
+
+    scope = scope_queryset(user, channel_id, server_id)
+    filtered = bool(user or channel_id or server_id)
+    strategy, size = _choose(scope, filtered, (user.pk if user else None, channel_id, server_id))
+
+    if strategy == HNSW_HALF:
+        vector_distance = CosineDistance('embeddings_half', HalfVector(query_embedding))
+    else:
+        vector_distance = CosineDistance('embeddings', query_embedding)
+    vector_side = (
+        rankable(scope)
+        .annotate(score=vector_distance)
+        .order_by('score')
+        .values('pk', 'score')[:candidates]
+    )
+    text_query = SearchQuery(query, config='simple', search_type='websearch')
+    text_side = (
+        scope.filter(content_search=text_query)
+        .annotate(score=SearchRank(F('content_search'), text_query))
+        .order_by('-score')
+        .values('pk', 'score')[:candidates]
+    )
+    vector_sql, vector_params = vector_side.query.sql_with_params()
+    text_sql, text_params = text_side.query.sql_with_params()
+
+    table = Memory._meta.db_table
+    # Columns only read by the database are left deferred, as by Memory.objects
+    columns = ', '.join(
+        f'm."{f.column}"' for f in Memory._meta.concrete_fields
+        if f.name not in ('embeddings_half', 'content_search', 'embeddings_next')
+    )
+    sql = f"""
+        WITH vector_side AS (
+            SELECT id, row_number() OVER (ORDER BY score) AS rank FROM ({vector_sql}) v
+        ), text_side AS (
+            SELECT id, row_number() OVER (ORDER BY score DESC) AS rank FROM ({text_sql}) t
+        ), fused AS (
+            SELECT COALESCE(v.id, t.id) AS id,
+                   COALESCE(%s::float8 / (%s + v.rank), 0) + COALESCE(%s::float8 / (%s + t.rank), 0) AS fusion
+            FROM vector_side v FULL OUTER JOIN text_side t ON v.id = t.id
+            ORDER BY fusion DESC
+            LIMIT %s
+        )
+        SELECT {columns}, CASE WHEN m.embedding_model = %s THEN m."embeddings" <=> %s END AS distance, fused.fusion
+        FROM fused JOIN {table} m ON m.id = fused.id {'AND m.user_id = %s' if user else ''}
+        ORDER BY fused.fusion DESC
+    """
+    params = (
+        *vector_params, *text_params,
+        float(weights['vector']), rrf_k, float(weights['text']), rrf_k, k,
+        # Found by their text, rows of another model get no distance
+        active_model(), Vector(query_embedding).to_text(),
+        # Prunes the join to the user's partition
+        *([user.pk] if user else []),
+    )
+
+    with transaction.atomic():
+        _configure(strategy, filtered, candidates)
+        memories = list(Memory.objects.raw(sql, params))
+    prefetch_related_objects(memories, 'user')
+
+    strategy = f'{HYBRID}+{strategy}'
+    _record(start, strategy, size)
+    return SearchResult(memories=memories, strategy=strategy, scope_size=size)
@@ -0,0 +1,116 @@
+"""
+Stand-in for the Ollama API, for benchmarks and runs without a model server.
+
+``/api/embed`` returns deterministic vectors: every word maps to a fixed
+random unit vector and a text embeds to the normalized sum of its words,
+so texts sharing words are close to each other, as with a real model.
+``/api/chat`` answers with the tail of the last message, or, when JSON
+output is requested, with a "no contradiction" verdict for every pair
+of a contradiction check.
+
+Run it on its own with ``python -m memory.stub_ollama --port 11435`` and
+point ``OLLAMA_URL`` at it.
+"""
+import argparse
+import hashlib
+import json
+import re
+import threading
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+import numpy as np
+
+class FakeEmbedder:
+    """Deterministic bag-of-words embeddings."""
+
+    def __init__(self, dims: int = 768, seed: int = 0):
+        self.dims = dims
+        self.seed = seed
+        self.word_vector = lru_cache(maxsize=100000)(self._word_vector)
+
+    def _word_vector(self, word: str) -> np.ndarray:
+        digest = hashlib.sha256(f"{self.seed}:{word}".encode('utf-8')).digest()
+        vector = np.random.default_rng(int.from_bytes(digest[:8], 'little')).standard_normal(self.dims)
+        return (vector / np.linalg.norm(vector)).astype(np.float32)
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dims), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in text.lower().split():
+                vectors[i] += self.word_vector(word)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        # Empty texts get a constant vector rather than zeros, which have no cosine distance
+        vectors[norms[:, 0] == 0] = 1 / np.sqrt(self.dims)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+class StubOllamaServer(ThreadingHTTPServer):
+    """Threaded HTTP server answering the Ollama endpoints memoire uses."""
+
+    daemon_threads = True
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, dims: int = 768, seed: int = 0):
+        self.embedder = FakeEmbedder(dims, seed)
+        super().__init__((host, port), StubOllamaHandler)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> 'StubOllamaServer':
+        """Serve from a daemon thread."""
+        threading.Thread(target=self.serve_forever, name='stub-ollama', daemon=True).start()
+        return self
+
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like Ollama
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError:
+            return self._reply(400, {'error': 'invalid JSON'})
+
+        if self.path == '/api/embed':
+            texts = body.get('input', [])
+            if isinstance(texts, str):
+                texts = [texts]
+            embeddings = self.server.embedder.embed(texts)
+            return self._reply(200, {'model': body.get('model'), 'embeddings': embeddings.tolist()})
+        if self.path == '/api/chat':
+            messages = body.get('messages') or [{}]
+            content = messages[-1].get('content', '')[-500:]
+            if body.get('format') == 'json':
+                # Contradiction checks: every pair of the prompt is consistent
+                pairs = re.findall(r'^Pair (\d+):', messages[-1].get('content', ''), re.MULTILINE)
+                content = json.dumps({'verdicts': [{'pair': int(n), 'contradiction': False} for n in pairs]})
+            return self._reply(200, {'model': body.get('model'), 'message': {'role': 'assistant', 'content': content}})
+        self._reply(404, {'error': f'unknown endpoint {self.path}'})
+
+    def _reply(self, status: int, payload: dict) -> None:
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11435)
+    parser.add_argument('--dims', type=int, default=768)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    server = StubOllamaServer(args.host, args.port, args.dims, args.seed)
+    print(f"Stub Ollama listening on {server.url}")
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
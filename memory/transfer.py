@@ -0,0 +1,251 @@
+"""
+NDJSON export and import of memories, to move tenants between
+environments or take backups.
+
+An export is a header line followed by one JSON object per memory,
+archived ones included, they are imported back summarized and archived
+again later. Embeddings are optional, as base64 little-endian float32.
+Rows are read through a server-side cursor, so exports stream with flat
+memory.
+
+Imports COPY each batch into a temporary staging table and insert it
+with ``ON CONFLICT DO NOTHING``, so a file can be imported again
+safely. Rows with an embedding of the active model are not embedded
+again, the others are written pending for the ``embed_pending_memories``
+task. A file is
+imported in one transaction: an invalid line aborts the whole import.
+"""
+import base64
+import io
+import json
+import uuid
+from dataclasses import dataclass
+from typing import AsyncIterator, Iterable, Iterator, Optional
+
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import BooleanField, QuerySet, Value
+from pgvector import HalfVector, Vector
+
+from .embeddings import active_model
+from .hot_cache import invalidate_users
+from .ingest import (
+    resolve_users, schedule_contradiction_checks, schedule_pending_embeddings, schedule_summarization_checks,
+    validate_item,
+)
+from .models import DIMS, ArchivedMemory, Memory, UserProfile
+
+FORMAT_VERSION = 1
+FIELDS = (
+    'id', 'user__username', 'channel_id', 'server_id', 'content', 'metadata',
+    'embedding_pending', 'embedding_model', 'created_at', 'updated_at', 'summary_id', 'superseded_by',
+)
+STAGING_COLUMNS = (
+    'id', 'user_id', 'channel_id', 'server_id', 'content', 'metadata',
+    'embeddings', 'embedding_model', 'created_at', 'updated_at', 'summary_id', 'superseded_by',
+)
+
+def export_queryset(user: Optional[UserProfile] = None, server_id: Optional[str] = None,
+                    embeddings: bool = True, archived: bool = False) -> QuerySet:
+    """Rows of every memory of a user and/or server, summarized ones included, or of the archived ones."""
+    if archived:
+        memories = ArchivedMemory.objects.annotate(embedding_pending=Value(False, output_field=BooleanField()))
+    else:
+        memories = Memory.objects.all()
+    if user:
+        memories = memories.filter(user=user)
+    if server_id:
+        memories = memories.filter(server_id=server_id)
+    fields = FIELDS + ('embeddings',) if embeddings else FIELDS
+    # No ORDER BY, rows stream in physical order without a sort
+    return memories.order_by().values(*fields)
+
+def encode_embedding(embedding) -> str:
+    if isinstance(embedding, HalfVector):
+        embedding = embedding.to_numpy()
+    return base64.b64encode(np.asarray(embedding, dtype='<f4').tobytes()).decode('ascii')
+
+def decode_embedding(value: str) -> np.ndarray:
+    embedding = np.frombuffer(base64.b64decode(value, validate=True), dtype='<f4')
+    if len(embedding) != DIMS:
+        raise ValueError(f'embedding must have {DIMS} dimensions, got {len(embedding)}')
+    return embedding
+
+def header(embeddings: bool) -> str:
+    return json.dumps({'memoire_export': FORMAT_VERSION, 'dims': DIMS, 'embeddings': embeddings}) + '\n'
+
+def export_line(row: dict) -> str:
+    record = {
+        'id': str(row['id']),
+        'username': row['user__username'],
+        'channel_id': row['channel_id'],
+        'server_id': row['server_id'],
+        'content': row['content'],
+        'metadata': row['metadata'],
+        'embedding_pending': row['embedding_pending'],
+        'embedding_model': row['embedding_model'],
+        'created_at': row['created_at'].isoformat(),
+        'updated_at': row['updated_at'].isoformat(),
+        'summary_id': str(row['summary_id']) if row['summary_id'] else None,
+        'superseded_by': str(row['superseded_by']) if row['superseded_by'] else None,
+    }
+    if row.get('embeddings') is not None:
+        record['embedding'] = encode_embedding(row['embeddings'])
+    return json.dumps(record) + '\n'
+
+def export_lines(memories: QuerySet, embeddings: bool = True,
+                 archived: Optional[QuerySet] = None) -> Iterator[str]:
+    """The header, then one line per row of ``export_queryset``, then of the archived rows."""
+    yield header(embeddings)
+    for queryset in (memories, archived) if archived is not None else (memories,):
+        for row in queryset.iterator(chunk_size=settings.EXPORT_CHUNK_SIZE):
+            yield export_line(row)
+
+async def aexport_lines(memories: QuerySet, embeddings: bool = True,
+                        archived: Optional[QuerySet] = None) -> AsyncIterator[str]:
+    """``export_lines`` for ASGI, where a synchronous iterator would be read whole before the response starts."""
+    yield header(embeddings)
+    for queryset in (memories, archived) if archived is not None else (memories,):
+        async for row in queryset.aiterator(chunk_size=settings.EXPORT_CHUNK_SIZE):
+            yield export_line(row)
+
+@dataclass
+class ImportResult:
+    read: int = 0
+    inserted: int = 0
+    skipped: int = 0  # Ids already present
+    pending: int = 0  # Inserted without an embedding, embedded later
+
+def _staging_row(record: dict, users: dict, model: str) -> list:
+    embedding = record.get('embedding')
+    if record.get('embedding_model', model) != model:
+        # Vectors of another model don't compare with this instance's
+        embedding = None
+    return [
+        record.get('id') or str(uuid.uuid4()),
+        str(users[record['username']].id),
+        record.get('channel_id'),
+        record.get('server_id'),
+        record['content'],
+        json.dumps(record.get('metadata', {})),
+        Vector(decode_embedding(embedding)).to_text() if embedding else None,
+        model if embedding else None,
+        record.get('created_at'),
+        record.get('updated_at'),
+        record.get('summary_id'),
+        record.get('superseded_by'),
+    ]
+
+def _csv_line(values: list) -> str:
+    # Every value quoted and NULLs as an unquoted \N, so no string reads as NULL
+    return ','.join(
+        r'\N' if value is None else '"' + value.replace('"', '""') + '"' for value in values
+    ) + '\n'
+
+def _parse(line_number: int, line) -> Optional[dict]:
+    if isinstance(line, bytes):
+        line = line.decode('utf-8')
+    if not line.strip():
+        return None
+    try:
+        record = json.loads(line)
+    except ValueError as e:
+        raise ValueError(f'line {line_number}: invalid JSON: {e}')
+    if isinstance(record, dict) and 'memoire_export' in record:
+        if record['memoire_export'] != FORMAT_VERSION or record.get('dims', DIMS) != DIMS:
+            raise ValueError(f'line {line_number}: unsupported export {record}')
+        return None
+    error = validate_item(record)
+    for key in ('id', 'summary_id', 'superseded_by'):
+        if not error and record.get(key) is not None:
+            try:
+                uuid.UUID(record[key])
+            except (TypeError, ValueError, AttributeError):
+                error = f'{key} must be a UUID'
+    if error:
+        raise ValueError(f'line {line_number}: {error}')
+    return record
+
+def _import_batch(cursor, records: list, result: ImportResult, user_ids: set, model: str) -> None:
+    users = resolve_users(record['username'] for record in records)
+    user_ids.update(user.id for user in users.values())
+
+    buffer = io.StringIO(''.join(_csv_line(_staging_row(record, users, model)) for record in records))
+    cursor.execute('TRUNCATE memory_import')
+    cursor.copy_expert(
+        f"COPY memory_import ({', '.join(STAGING_COLUMNS)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer
+    )
+
+    table = Memory._meta.db_table
+    cursor.execute(f"""
+        WITH inserted AS (
+            INSERT INTO {table} (
+                id, user_id, channel_id, server_id, content, metadata, embeddings, embedding_model,
+                embedding_pending, created_at, updated_at, summary_id, superseded_by_id
+            )
+            SELECT id, user_id, channel_id, server_id, content, metadata, embeddings, embedding_model,
+                   embeddings IS NULL, COALESCE(created_at, now()), COALESCE(updated_at, now()), summary_id,
+                   superseded_by
+            FROM memory_import
+            -- No conflict target: the primary key is (id, user_id) once partitioned
+            ON CONFLICT DO NOTHING
+            RETURNING id, embedding_pending
+        ), recorded AS (
+            INSERT INTO memory_imported SELECT id FROM inserted
+        )
+        SELECT count(*), count(*) FILTER (WHERE embedding_pending) FROM inserted
+    """)
+    inserted, pending = cursor.fetchone()
+    result.inserted += inserted
+    result.pending += pending
+    result.skipped += len(records) - inserted
+
+def import_memories(lines: Iterable, batch_size: Optional[int] = None) -> ImportResult:
+    """Import an NDJSON export, see the module docstring."""
+    batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+    result = ImportResult()
+    user_ids = set()
+    model = active_model()
+    table = Memory._meta.db_table
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"""
+            CREATE TEMPORARY TABLE memory_import (
+                id uuid, user_id uuid, channel_id varchar(255), server_id varchar(255), content text,
+                metadata jsonb, embeddings vector({DIMS}), embedding_model varchar(255),
+                created_at timestamptz, updated_at timestamptz, summary_id uuid, superseded_by uuid
+            ) ON COMMIT DROP
+        """)
+        cursor.execute('CREATE TEMPORARY TABLE memory_imported (id uuid) ON COMMIT DROP')
+
+        records = []
+        for line_number, line in enumerate(lines, 1):
+            record = _parse(line_number, line)
+            if record is None:
+                continue
+            records.append(record)
+            result.read += 1
+            if len(records) >= batch_size:
+                _import_batch(cursor, records, result, user_ids, model)
+                records = []
+        if records:
+            _import_batch(cursor, records, result, user_ids, model)
+
+        # Summaries outside the export (a server's memories link to user-level
+        # summaries) don't exist here: unlink them before the deferred FK check
+        for column in ('summary_id', 'superseded_by_id'):
+            cursor.execute(f"""
+                UPDATE {table} m SET {column} = NULL
+                FROM memory_imported i
+                WHERE m.id = i.id AND m.{column} IS NOT NULL
+                  AND NOT EXISTS (SELECT 1 FROM {table} s WHERE s.id = m.{column})
+            """)
+
+        if result.pending:
+            schedule_pending_embeddings()
+        if result.inserted:
+            schedule_contradiction_checks()
+        schedule_summarization_checks(user_ids)
+        invalidate_users(user_ids)
+    return result
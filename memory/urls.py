@@ -6,6 +6,7 @@ urlpatterns = [
     path('', views.memory_list, name='memory_list'),
     path('memory/<uuid:memory_id>/', views.memory_detail, name='memory_detail'),
     path('memory/create/', views.create_memory, name='create_memory'),
+    path('memory/bulk_create/', views.bulk_create_memories, name='bulk_create_memories'),
     path('memory/search/', views.search_memories, name='search_memories'),
     path('memory/add/', views.memory_add, name='memory_add'),
     # New user profile endpoints
@@ -13,4 +14,7 @@ urlpatterns = [
     path('users/<str:username>/', views.profile_view, name='profile'),
     path('api/users/', views.user_profile_list_api, name='user_profile_list_api'),
     path('api/users/<str:username>/', views.user_profile_api, name='user_profile_api'),
+    path('api/memories/', views.memory_list_api, name='memory_list_api'),
+    path('api/export/', views.export_memories, name='export_memories'),
+    path('metrics', views.metrics, name='metrics'),
 ]
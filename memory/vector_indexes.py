@@ -0,0 +1,112 @@
+"""
+Per-tenant partial HNSW indexes.
+
+Large servers and users get their own partial index over their searchable
+rows, so a filtered search walks a graph that only holds matching rows
+instead of post-filtering the global one. Once the table is partitioned
+(see memory.partitioning), a user's index is built on their partition
+only and a server's on every partition, suffixed with the partition.
+"""
+import hashlib
+import re
+from typing import Dict, Iterable, Set
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, Q
+from pgvector.django import HnswIndex
+
+from .models import Memory, SEARCHABLE, HNSW_M, HNSW_EF_CONSTRUCTION
+from .partitioning import build_index, is_partitioned, partition_index_name, partition_of, partitions
+
+# Bump when the index definition changes so stale indexes get rebuilt
+TENANT_INDEX_VERSION = 2  # 2: superseded memories left out
+TENANT_INDEX_PREFIX = 'memory_tenant_'
+TENANT_FIELDS = {'server': 'server_id', 'user': 'user_id'}
+
+def tenant_index(kind: str, value) -> HnswIndex:
+    """
+    Partial HNSW index over the searchable rows of one server or user, on
+    the halfvec column with SEARCH_QUANTIZED.
+    """
+    field = TENANT_FIELDS[kind]
+    digest = hashlib.sha1(str(value).encode('utf-8')).hexdigest()[:12]
+    # Switching SEARCH_QUANTIZED changes the names, so the next sync rebuilds them
+    if settings.SEARCH_QUANTIZED:
+        version, column, opclass = f'v{TENANT_INDEX_VERSION}h', 'embeddings_half', 'halfvec_cosine_ops'
+    else:
+        version, column, opclass = f'v{TENANT_INDEX_VERSION}', 'embeddings', 'vector_cosine_ops'
+    return HnswIndex(
+        name=f'{TENANT_INDEX_PREFIX}{version}_{kind}_{digest}',
+        fields=[column],
+        opclasses=[opclass],
+        m=HNSW_M,
+        ef_construction=HNSW_EF_CONSTRUCTION,
+        condition=Q(**{field: value}) & SEARCHABLE,
+    )
+
+def tenant_sizes(kind: str, min_rows: int) -> Dict[str, int]:
+    """Searchable row count of every server or user with at least ``min_rows`` rows."""
+    field = TENANT_FIELDS[kind]
+    rows = (
+        Memory.objects.filter(SEARCHABLE)
+        .exclude(**{f'{field}__isnull': True})
+        .values(field)
+        .annotate(count=Count('id'))
+        .filter(count__gte=min_rows)
+        .values_list(field, 'count')
+    )
+    return dict(rows)
+
+def existing_tenant_indexes() -> Set[str]:
+    """Names of the tenant indexes, without their partition suffix."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = ANY(%s) AND indexname LIKE %s",
+            [[Memory._meta.db_table] + partitions(), TENANT_INDEX_PREFIX.replace('_', r'\_') + '%'],
+        )
+        return {re.sub(r'_p\d+$', '', row[0]) for row in cursor.fetchall()}
+
+def create_index(index: HnswIndex, user_id=None) -> None:
+    """Build a tenant index concurrently, on ``user_id``'s partition only for a user index."""
+    if not is_partitioned():
+        with connection.schema_editor(atomic=False) as schema_editor:
+            schema_editor.add_index(Memory, index, concurrently=True)
+        return
+
+    only = None
+    if user_id is not None:
+        partition = partition_of(user_id)
+        if partition is None:
+            return
+        only = [partition]
+    with connection.schema_editor(atomic=False) as schema_editor:
+        definition = str(index.create_sql(Memory, schema_editor)).split(' USING ', 1)[1]
+    build_index(index.name, definition, only=only)
+
+def drop_index(name: str) -> None:
+    if not is_partitioned():
+        with connection.schema_editor(atomic=False) as schema_editor:
+            schema_editor.remove_index(Memory, HnswIndex(name=name, fields=['embeddings']), concurrently=True)
+        return
+    with connection.cursor() as cursor:
+        for partition in partitions():
+            cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{partition_index_name(name, partition)}"')
+
+def plan(kinds: Iterable[str], min_rows: int, keep_rows: int):
+    """
+    Return the (kind, tenant, index) to create and the index names to drop.
+    Tenants index once they reach ``min_rows`` searchable rows and keep
+    their index until they fall under ``keep_rows``, so tenants hovering
+    around the threshold don't get rebuilt every run.
+    """
+    existing = existing_tenant_indexes()
+    wanted = {}
+    for kind in kinds:
+        for value, count in tenant_sizes(kind, keep_rows).items():
+            index = tenant_index(kind, value)
+            if index.name in existing or count >= min_rows:
+                wanted[index.name] = (kind, value, index)
+    to_create = [item for name, item in wanted.items() if name not in existing]
+    to_drop = sorted(existing - wanted.keys())
+    return to_create, to_drop
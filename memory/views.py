@@ -1,13 +1,73 @@
-from django.http import HttpRequest, HttpResponse, JsonResponse
-from django.shortcuts import render, get_object_or_404, redirect
+from django.http import Http404, HttpRequest, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import render, get_object_or_404, aget_object_or_404, redirect
 from django.views.decorators.http import require_http_methods
-from django.core.paginator import Paginator
 from django.contrib import messages
-from .models import Memory, UserProfile
-from django.db.models import Q
-from pgvector.django import CosineDistance
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from .models import ArchivedMemory, Memory, UserProfile
+from .archive import get_memory
+from .metrics import REGISTRY, scrape_allowed
+from .dedup import duplicate_of, merge
+from .hot_cache import invalidate_users
+from .ingest import (
+    bulk_ingest, schedule_contradiction_checks, schedule_pending_embeddings, schedule_summarization_checks,
+)
+from .pagination import InvalidCursor, Page, keyset_page, ranked_page
+from .search import hierarchical_search, hybrid_search, scope_queryset, search
+from .transfer import aexport_lines, export_lines, export_queryset
+from django.db.models import Count, FloatField, Value
+from asgiref.sync import sync_to_async
 
 import json
+import uuid
+from collections import Counter
+from typing import Optional
+
+def memory_page(user: Optional[UserProfile], channel_id: Optional[str], server_id: Optional[str],
+                query_embedding, cursor: Optional[str], limit: int) -> Page:
+    """
+    A page of the searchable memories of a scope: newest first, or by
+    distance to ``query_embedding`` among its PAGE_SEARCH_CANDIDATES
+    nearest memories.
+    """
+    if query_embedding is not None:
+        result = search(
+            query_embedding, user=user, channel_id=channel_id, server_id=server_id,
+            k=settings.PAGE_SEARCH_CANDIDATES,
+        )
+        return ranked_page(result.memories, cursor, limit)
+    memories = scope_queryset(user, channel_id, server_id).select_related('user')
+    return keyset_page(memories, ('-created_at', '-id'), cursor, limit)
+
+def page_limit(value: Optional[str]) -> int:
+    if not value:
+        return settings.PAGE_DEFAULT_LIMIT
+    return max(1, min(int(value), settings.PAGE_MAX_LIMIT))
+
+def json_flag(data: dict, key: str, default: bool) -> bool:
+    """A boolean option of a JSON payload, ``default`` when absent or null."""
+    value = data.get(key)
+    if value is None:
+        return default
+    if not isinstance(value, bool):
+        raise ValueError(f'{key} must be true or false')
+    return value
+
+def memory_json(m: Memory) -> dict:
+    return {
+        'id': str(m.id),
+        'content': m.content,
+        'metadata': m.metadata,
+        'created_at': m.created_at.isoformat(),
+        'distance': getattr(m, 'distance', None),
+        'score': getattr(m, 'fusion', None),
+        'embedding_pending': m.embedding_pending,
+        'channel_id': m.channel_id,
+        'server_id': m.server_id,
+        'user': m.user.username if m.user else None,
+        'summary_id': str(m.summary_id) if m.summary_id else None,
+        'archived': isinstance(m, ArchivedMemory),
+    }
 
 def memory_list(request: HttpRequest) -> HttpResponse:
     """Display a list of memories for the selected user."""
@@ -17,77 +77,157 @@ def memory_list(request: HttpRequest) -> HttpResponse:
     channel_id = request.GET.get('channel_id')
     server_id = request.GET.get('server_id')
     
-    memories = Memory.objects.all()
-    
-    if channel_id and channel_id != 'None':
-        memories = memories.filter(channel_id=channel_id)
-
-    if server_id and server_id != 'None':
-        memories = memories.filter(server_id=server_id)
-
+    user = None
     if username and username != 'None':
         user = get_object_or_404(UserProfile, username=username)
-        memories = memories.filter(user=user)
-
-    # Show summaries and hide summarized memories
-    memories = memories.filter(
-        Q(summary_id__isnull=True) | Q(metadata__has_key='type', metadata__type='summary')
-    )
 
+    query_embedding = None
     if query and query != 'None':
         from .embeddings import compute_embedding
         query_embedding = compute_embedding(query)[0]
-        memories = memories.annotate(distance=CosineDistance("embeddings", query_embedding)).order_by("-distance")
-    else:
-        memories = memories.order_by('-created_at')
-    
-    paginator = Paginator(memories, 5)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+
+    try:
+        page_obj = memory_page(
+            user,
+            channel_id if channel_id != 'None' else None,
+            server_id if server_id != 'None' else None,
+            query_embedding,
+            request.GET.get('cursor'),
+            5,
+        )
+    except InvalidCursor as e:
+        return HttpResponse(str(e), status=400)
     
     return render(request, 'memory/memory_list.html', {
         'page_obj': page_obj,
+        'cursor': request.GET.get('cursor'),
         'username': username if username != 'None' else '',
         'query': query if query != 'None' else '',
         'channel_id': channel_id if channel_id != 'None' else '',
         'server_id': server_id if server_id != 'None' else '',
     })
 
+@require_http_methods(["GET"])
+async def memory_list_api(request: HttpRequest) -> JsonResponse:
+    """API endpoint to page through the searchable memories of a scope."""
+    try:
+        username = request.GET.get('username')
+        query = request.GET.get('query')
+        limit = page_limit(request.GET.get('limit'))
+
+        user = None
+        if username:
+            user = await aget_object_or_404(UserProfile, username=username)
+
+        query_embedding = None
+        if query:
+            from .embeddings import acompute_embedding
+            query_embedding = (await acompute_embedding(query))[0]
+
+        page = await sync_to_async(memory_page)(
+            user, request.GET.get('channel_id'), request.GET.get('server_id'),
+            query_embedding, request.GET.get('cursor'), limit,
+        )
+        return JsonResponse({
+            'memories': [memory_json(m) for m in page],
+            'next_cursor': page.next_cursor,
+        })
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
 def memory_detail(request: HttpRequest, memory_id: str) -> HttpResponse:
-    """Display details of a specific memory."""
-    memory = get_object_or_404(Memory, id=memory_id)
+    """
+    Display details of a specific memory, archived or not. Links pass the
+    owner's id as ``user``, so the lookup reads a single partition.
+    """
+    try:
+        user_id = uuid.UUID(request.GET['user']) if request.GET.get('user') else None
+    except ValueError:
+        raise Http404("No memory matches the given query.")
+    memory = get_memory(memory_id, user_id)
+    if memory is None:
+        raise Http404("No memory matches the given query.")
     return render(request, 'memory/memory_detail.html', {
         'memory': memory,
+        'archived': isinstance(memory, ArchivedMemory),
     })
 
 def memory_add(request: HttpRequest) -> HttpResponse:
     """Display the memory add page."""
     return render(request, 'memory/memory_add.html')
 
+async def pending_memories(memories):
+    """
+    Memories of the searched scope that are still waiting for their embedding.
+    They can't be ranked, so depending on SEARCH_PENDING_POLICY they are either
+    left out ("exclude") or the most recent ones are returned after the ranked
+    results with a null distance ("recent").
+    """
+    if settings.SEARCH_PENDING_POLICY != 'recent':
+        return []
+    pending = memories.filter(embedding_pending=True).order_by('-created_at')[:settings.SEARCH_PENDING_LIMIT]
+    return [m async for m in pending.annotate(distance=Value(None, output_field=FloatField()))]
+
 @require_http_methods(["POST"])
-def create_memory(request: HttpRequest) -> JsonResponse:
+async def create_memory(request: HttpRequest) -> JsonResponse:
     """Create a new memory."""
     try:
         data = json.loads(request.body)
         username = data['username']
-        user, created = UserProfile.objects.get_or_create(username=username)
-        
-        from .embeddings import compute_embedding
+        user, created = await UserProfile.objects.aget_or_create(username=username)
         
-        memory = Memory.objects.create(
+        from .embeddings import acompute_embedding, active_model
+
+        # In async mode the row is written right away and embedded by a Celery task
+        pending = json_flag(data, 'async', settings.MEMORY_ASYNC_EMBEDDING)
+        model = None if pending else await sync_to_async(active_model)()
+        embedding = None if pending else (await acompute_embedding(data['content'], model))[0]
+        if not pending and json_flag(data, 'dedup', settings.DEDUP_ENABLED):
+            duplicate = await sync_to_async(duplicate_of)(
+                embedding, user=user, channel_id=data.get('channel_id'), server_id=data.get('server_id')
+            )
+            if duplicate is not None:
+                await sync_to_async(merge)(Counter({duplicate.id: 1}), [user.id])
+                return JsonResponse({'id': str(duplicate.id), 'embedding_pending': False, 'merged': True})
+        memory = await Memory.objects.acreate(
             user=user,
             channel_id=data.get('channel_id'),
             server_id=data.get('server_id'),
             content=data['content'],
-            embeddings=compute_embedding(data['content'])[0],
+            embeddings=embedding,
+            embedding_model=model,
+            embedding_pending=pending,
             metadata=data.get('metadata', {})
         )
-        return JsonResponse({'id': str(memory.id)})
+        if pending:
+            await sync_to_async(schedule_pending_embeddings)()
+        else:
+            await sync_to_async(schedule_contradiction_checks)()
+        await sync_to_async(schedule_summarization_checks)([user.id])
+        await sync_to_async(invalidate_users)([user.id])
+        return JsonResponse({'id': str(memory.id), 'embedding_pending': pending})
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=400)
 
 @require_http_methods(["POST"])
-def search_memories(request: HttpRequest) -> JsonResponse:
+def bulk_create_memories(request: HttpRequest) -> JsonResponse:
+    """Create many memories, possibly for many users, in one request."""
+    try:
+        data = json.loads(request.body)
+        items = data['memories']
+        if not isinstance(items, list):
+            raise ValueError('memories must be a list')
+        if len(items) > settings.MEMORY_BULK_MAX_ITEMS:
+            raise ValueError(f'at most {settings.MEMORY_BULK_MAX_ITEMS} memories per request')
+
+        pending = json_flag(data, 'async', settings.MEMORY_ASYNC_EMBEDDING)
+        dedup = json_flag(data, 'dedup', settings.DEDUP_ENABLED)
+        return JsonResponse({'results': bulk_ingest(items, pending=pending, dedup=dedup)})
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+@require_http_methods(["POST"])
+async def search_memories(request: HttpRequest) -> JsonResponse:
     """Search memories using vector similarity."""
     try:
         data = json.loads(request.body)
@@ -95,40 +235,63 @@ def search_memories(request: HttpRequest) -> JsonResponse:
         username = data.get('username')
         channel_id = data.get('channel_id')
         server_id = data.get('server_id')
-        
-        memories = Memory.objects.all()
-        
-        if channel_id:
-            memories = memories.filter(channel_id=channel_id)
-        if server_id:
-            memories = memories.filter(server_id=server_id)
+        k = max(1, min(int(data.get('k', settings.SEARCH_DEFAULT_K)), settings.SEARCH_MAX_K))
+        mode = data.get('mode', 'vector')
+        if mode not in ('vector', 'hybrid', 'hierarchical'):
+            raise ValueError('mode must be "vector", "hybrid" or "hierarchical"')
+        fanout = data.get('fanout')
+        if fanout is not None:
+            fanout = max(1, min(int(fanout), settings.SEARCH_HIERARCHY_MAX_FANOUT))
+        depth = data.get('depth')
+        if depth is not None:
+            depth = max(0, min(int(depth), settings.SEARCH_HIERARCHY_MAX_DEPTH))
+        weights = data.get('weights')
+        if weights is not None and (
+            not isinstance(weights, dict)
+            or not set(weights) <= {'vector', 'text'}
+            or not all(isinstance(w, (int, float)) and w >= 0 for w in weights.values())
+        ):
+            raise ValueError('weights must map "vector" and/or "text" to non-negative numbers')
+        rrf_k = data.get('rrf_k')
+        if rrf_k is not None:
+            rrf_k = max(1, int(rrf_k))
 
+        user = None
         if username:
-            user = get_object_or_404(UserProfile, username=username)
-            memories = memories.filter(user=user)
+            user = await aget_object_or_404(UserProfile, username=username)
 
         # Show summaries and hide summarized memories
-        memories = memories.filter(
-            Q(summary_id__isnull=True) | Q(metadata__has_key='type', metadata__type='summary')
-        )
+        memories = scope_queryset(user, channel_id, server_id).select_related('user')
+        strategy = None
 
         if query:
             # Compute query embedding
-            from .embeddings import compute_embedding
-            query_embedding = compute_embedding(query)[0]
-            memories = memories.annotate(distance=CosineDistance("embeddings", query_embedding)).order_by("distance")[:3]
+            from .embeddings import acompute_embedding
+            query_embedding = (await acompute_embedding(query))[0]
+            if mode == 'hybrid':
+                result = await sync_to_async(hybrid_search)(
+                    query, query_embedding, user=user, channel_id=channel_id, server_id=server_id,
+                    k=k, weights=weights, rrf_k=rrf_k,
+                )
+            elif mode == 'hierarchical':
+                result = await sync_to_async(hierarchical_search)(
+                    query_embedding, user=user, channel_id=channel_id, server_id=server_id,
+                    k=k, fanout=fanout, depth=depth,
+                )
+            else:
+                result = await sync_to_async(search)(
+                    query_embedding, user=user, channel_id=channel_id, server_id=server_id, k=k
+                )
+            strategy = result.strategy
+            # Hybrid searches can already return pending memories found by their text
+            found = {m.id for m in result.memories}
+            memories = result.memories + [m for m in await pending_memories(memories) if m.id not in found]
+        else:
+            memories = [m async for m in memories]
         
         return JsonResponse({
-            'memories': [{
-                'id': str(m.id),
-                'content': m.content,
-                'metadata': m.metadata,
-                'created_at': m.created_at.isoformat(),
-                'distance': m.distance,
-                'channel_id': m.channel_id,
-                'server_id': m.server_id,
-                'user': m.user.username if m.user else None
-            } for m in memories]
+            'memories': [memory_json(m) for m in memories],
+            'strategy': strategy,
         })
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=400)
@@ -149,45 +312,95 @@ def profile_view(request: HttpRequest, username: str) -> HttpResponse:
 @require_http_methods(["GET"])
 def user_profile_list(request: HttpRequest) -> HttpResponse:
     """Display a list of all user profiles."""
-    profiles = UserProfile.objects.all().order_by('username')
-    paginator = Paginator(profiles, 20)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    try:
+        page_obj = keyset_page(UserProfile.objects.all(), ('username',), request.GET.get('cursor'), 20)
+    except InvalidCursor as e:
+        return HttpResponse(str(e), status=400)
     
     return render(request, 'memory/user_profile_list.html', {
         'page_obj': page_obj,
+        'cursor': request.GET.get('cursor'),
     })
 
+def profile_json(p: UserProfile, memory_count: int) -> dict:
+    return {
+        'id': str(p.id),
+        'username': p.username,
+        'custom_info': p.custom_info,
+        'created_at': p.created_at.isoformat(),
+        'updated_at': p.updated_at.isoformat(),
+        'memory_count': memory_count,
+    }
+
 @require_http_methods(["GET"])
-def user_profile_list_api(request: HttpRequest) -> JsonResponse:
-    """API endpoint to get a list of all user profiles."""
+async def user_profile_list_api(request: HttpRequest) -> JsonResponse:
+    """
+    API endpoint to page through the user profiles, by username. Without
+    ``cursor`` nor ``limit``, every profile in one response, as before
+    pagination, for existing clients.
+    """
     try:
-        profiles = UserProfile.objects.all().order_by('username')
+        if 'cursor' not in request.GET and 'limit' not in request.GET:
+            profiles = UserProfile.objects.annotate(memory_count=Count('memories')).order_by('username')
+            return JsonResponse({'profiles': [profile_json(p, p.memory_count) async for p in profiles]})
+        page = await sync_to_async(keyset_page)(
+            UserProfile.objects.all(), ('username',),
+            request.GET.get('cursor'), page_limit(request.GET.get('limit')),
+        )
+        # Counted for the page only
+        counts = {
+            row['user_id']: row['count']
+            async for row in Memory.objects.filter(user__in=page.items)
+            .values('user_id').annotate(count=Count('id')).order_by()
+        }
         return JsonResponse({
-            'profiles': [{
-                'id': str(p.id),
-                'username': p.username,
-                'custom_info': p.custom_info,
-                'created_at': p.created_at.isoformat(),
-                'updated_at': p.updated_at.isoformat(),
-                'memory_count': p.memories.count()
-            } for p in profiles]
+            'profiles': [profile_json(p, counts.get(p.id, 0)) for p in page],
+            'next_cursor': page.next_cursor,
         })
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=400)
 
 @require_http_methods(["GET"])
-def user_profile_api(request: HttpRequest, username: str) -> JsonResponse:
+async def user_profile_api(request: HttpRequest, username: str) -> JsonResponse:
     """API endpoint to get a specific user profile."""
     try:
-        profile = get_object_or_404(UserProfile, username=username)
+        profile = await aget_object_or_404(UserProfile, username=username)
         return JsonResponse({
             'id': str(profile.id),
             'username': profile.username,
             'custom_info': profile.custom_info,
             'created_at': profile.created_at.isoformat(),
             'updated_at': profile.updated_at.isoformat(),
-            'memory_count': profile.memories.count()
+            'memory_count': await profile.memories.acount()
         })
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=400)
+
+@require_http_methods(["GET"])
+def export_memories(request: HttpRequest) -> HttpResponse:
+    """
+    Stream the memories of a user and/or server as NDJSON, from a
+    server-side cursor: synchronously under WSGI, asynchronously under ASGI.
+    """
+    username = request.GET.get('username')
+    server_id = request.GET.get('server_id')
+    if not username and not server_id:
+        return JsonResponse({'error': 'username or server_id is required'}, status=400)
+    user = None
+    if username:
+        user = get_object_or_404(UserProfile, username=username)
+    embeddings = request.GET.get('embeddings', '1') not in ('0', 'false')
+    memories = export_queryset(user, server_id, embeddings)
+    archived = export_queryset(user, server_id, embeddings, archived=True)
+    # Each server only streams its own kind of iterator, it buffers the other one whole
+    lines = aexport_lines if isinstance(request, ASGIRequest) else export_lines
+    response = StreamingHttpResponse(lines(memories, embeddings, archived), content_type='application/x-ndjson')
+    response['Content-Disposition'] = f'attachment; filename="memories-{username or server_id}.ndjson"'
+    return response
+
+@require_http_methods(["GET"])
+def metrics(request: HttpRequest) -> HttpResponse:
+    """Metrics of all web and worker processes, in the Prometheus text format, for allowed scrapers only."""
+    if not scrape_allowed(request.META.get('REMOTE_ADDR')):
+        return HttpResponse('Forbidden', status=403)
+    return HttpResponse(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')